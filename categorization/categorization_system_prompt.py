@@ -33,8 +33,8 @@ Provide certainty scores (0%-100%) for each classification:
 
 ## Input/Output Format
 
-**Input**: List of up to 5 product names (one per line).
-**Output**: For each product, provide:
+**Input**: List of product names (one per line).
+**Output**: For each product, in the same order, provide:
 `Product Name: Fleischsorte, certainty_fleischsorte (%).
 
 ---
@@ -210,7 +210,7 @@ If you encounter a product, assign it to the correct category using the descript
 
 
 ### Instructions
-    - I will send you at most 5 products at a time.  Each product is on a newline.  For each product, return the categorization.
+    - I will send you a list of products.  Each product is on a newline.  For each product, in the same order, return the categorization.
 
 ### Example
 Mariniertes Hähnchenbrustfilet
@@ -12,3 +12,10 @@ Here are all the products, each separated by a newline character. Provide the cl
 
 """
 
+
+FUSED_CATEGORIZATION_USER_PROMPT = """
+Here are all the products, each separated by a newline character. Provide the category and the classification if it is a grill product or not for every product.
+
+Products:
+
+"""
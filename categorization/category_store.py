@@ -0,0 +1,151 @@
+import time
+
+from llms.models import FinalProductCategory, ProductCategory
+from normalization import normalize_product_name
+from sqlite_store import SQLiteStore
+
+CATEGORY_COLUMNS = [
+    "category",
+    "certainty_fleischsorte",
+    "is_grill",
+    "certainty_is_grill",
+]
+# Reviewers are certain of their corrections
+REVIEWER_CERTAINTY = 100.0
+
+
+def split_final_category(
+    final_category: str, known_category: str | None = None
+) -> tuple[str, bool]:
+    """
+    Turns a FinalProductCategory value back into the category and is_grill. "Kein Grillprodukt"
+    keeps the known category, if it is valid.
+    """
+    if final_category != FinalProductCategory.NO_GRILL_PRODUCT.value:
+        return ProductCategory(final_category).value, True
+    if known_category in {category.value for category in ProductCategory}:
+        return known_category, False
+    return ProductCategory.OTHERS.value, False
+
+
+class CategoryStore(SQLiteStore):
+    """
+    Persistent categories of product names, stored in SQLite.
+
+    The same products appear in the leaflets every week and in several stores, so their names
+    are only sent to the LLM once. Categories from the LLM are stored per prompt version, a
+    changed prompt or model categorizes every name again. Corrections of reviewers are kept
+    independently of the prompt version and always take precedence.
+    """
+
+    def __init__(self, path: str, prompt_version: str):
+        """
+        Parameters:
+            path (str): The SQLite file with the LLM categories per normalized name and prompt version, and the reviewer corrections per name.
+            prompt_version (str): Hash of the prompts and models that produced the categories.
+        """
+        super().__init__(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS categories "
+                "(name TEXT NOT NULL, prompt_version TEXT NOT NULL, category TEXT NOT NULL, "
+                "certainty_fleischsorte REAL, is_grill INTEGER NOT NULL, certainty_is_grill REAL, "
+                "updated REAL NOT NULL, PRIMARY KEY (name, prompt_version))",
+                "CREATE TABLE IF NOT EXISTS corrections "
+                "(name TEXT PRIMARY KEY, category TEXT NOT NULL, is_grill INTEGER NOT NULL, updated REAL NOT NULL)",
+            ],
+        )
+        self.prompt_version = prompt_version
+
+    def __str__(self) -> str:
+        return f"Category store: {self.hits} known product names, {self.misses} new ({self.hit_rate:.0%} hit rate)"
+
+    def get_many(self, product_names: list[str]) -> dict[str, dict]:
+        """
+        Returns the known categories of the product names, by normalized name. Names without a
+        category of the current prompt version or a correction are missing from the result.
+        """
+        names = list({normalize_product_name(name) for name in product_names})
+        with self._lock:
+            found = self._lookup(names)
+            self.hits += len(found)
+            self.misses += len(names) - len(found)
+        return found
+
+    def _lookup(self, names: list[str]) -> dict[str, dict]:
+        found = {}
+        # Chunks stay below the SQLite limit of host parameters
+        for start in range(0, len(names), 500):
+            chunk = names[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for name, *values in self._connection.execute(
+                f"SELECT name, {', '.join(CATEGORY_COLUMNS)} FROM categories "
+                f"WHERE prompt_version = ? AND name IN ({placeholders})",
+                (self.prompt_version, *chunk),
+            ):
+                found[name] = dict(zip(CATEGORY_COLUMNS, values))
+            for name, category, is_grill in self._connection.execute(
+                f"SELECT name, category, is_grill FROM corrections WHERE name IN ({placeholders})",
+                chunk,
+            ):
+                found[name] = {
+                    "category": category,
+                    "certainty_fleischsorte": REVIEWER_CERTAINTY,
+                    "is_grill": is_grill,
+                    "certainty_is_grill": REVIEWER_CERTAINTY,
+                }
+        for categories in found.values():
+            categories["is_grill"] = bool(categories["is_grill"])
+        return found
+
+    def put_many(self, categories: dict[str, dict]) -> None:
+        """Stores the LLM categories of normalized product names for the current prompt version."""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO categories "
+                f"(name, prompt_version, {', '.join(CATEGORY_COLUMNS)}, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        name,
+                        self.prompt_version,
+                        *(values[column] for column in CATEGORY_COLUMNS),
+                        now,
+                    )
+                    for name, values in categories.items()
+                    # Incomplete LLM answers are asked again next time
+                    if all(
+                        values.get(column) is not None for column in CATEGORY_COLUMNS
+                    )
+                ],
+            )
+            self._connection.commit()
+
+    def add_correction(self, product_name: str, final_category: str) -> None:
+        """
+        Stores the category a reviewer chose for a product name.
+
+        Parameters:
+            final_category (str): A FinalProductCategory value, "Kein Grillprodukt" keeps the known category of the name.
+        """
+        name = normalize_product_name(product_name)
+        with self._lock:
+            known = self._lookup([name]).get(name)
+            category, is_grill = split_final_category(
+                final_category, known["category"] if known is not None else None
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO corrections (name, category, is_grill, updated) VALUES (?, ?, ?, ?)",
+                (name, category, int(is_grill), time.time()),
+            )
+            self._connection.commit()
+
+    def get_corrections(self) -> list[tuple[str, str, bool]]:
+        """Returns the (normalized name, category, is_grill) of all corrections of reviewers."""
+        with self._lock:
+            return [
+                (name, category, bool(is_grill))
+                for name, category, is_grill in self._connection.execute(
+                    "SELECT name, category, is_grill FROM corrections ORDER BY updated"
+                )
+            ]
@@ -10,7 +10,7 @@ You specialize in classifying products into if they are a grill product or not.
 If you encounter a product, determine if it is a grill product or not according to the following rules. 
 
 ### Instructions
-    - I will send you at most 5 products at a time.  Each product is on a newline.  For each product, return the classification and the certainty score.
+    - I will send you a list of products.  Each product is on a newline.  For each product, in the same order, return the classification and the certainty score.
     
 ### Certainty Scores
 **`certainty_is_grill`**: Confidence in grilling suitability.
@@ -20,8 +20,8 @@ If you encounter a product, determine if it is a grill product or not according
 
 ## Input/Output Format
 
-**Input**: List of up to 5 product names (one per line).
-**Output**: For each product, provide:
+**Input**: List of product names (one per line).
+**Output**: For each product, in the same order, provide:
 `Product Name: is_grill (yes/no), certainty_is_grill (%)`.
 
 ### Examples
@@ -325,7 +325,7 @@ If you encounter a product, assign it to the correct category using the descript
 
 
 ### Instructions
-    - I will send you at most 5 products at a time.  Each product is on a newline.  For each product, return the categorization.
+    - I will send you a list of products.  Each product is on a newline.  For each product, in the same order, return the categorization.
 
 ### Example
 Mariniertes Hähnchenbrustfilet
@@ -0,0 +1,71 @@
+from categorization.categorization_system_prompt import CATEGORIZATION_SYSTEM_PROMPT
+from categorization.classification_is_grill_system_prompt import (
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GENERAL,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEFLUEGEL,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_SCHWEIN,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_RIND,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMISCHT,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_KAESE,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_FISCH,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_VEGAN,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMUESE,
+    CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_OTHERS,
+)
+
+# The is_grill prompts share the general part, only their category specific guidance is added
+CATEGORY_GUIDANCE = "\n".join(
+    prompt[len(CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GENERAL) :]
+    for prompt in [
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEFLUEGEL,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_SCHWEIN,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_RIND,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMISCHT,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_KAESE,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_FISCH,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_VEGAN,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMUESE,
+        CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_OTHERS,
+    ]
+)
+
+FUSED_CATEGORIZATION_SYSTEM_PROMPT = (
+    CATEGORIZATION_SYSTEM_PROMPT
+    + """
+# Grill Product Classification
+
+## Objective
+After assigning the `Fleischsorte`, decide for the same product whether it is a grill product (`is_grill`),
+using the guidance of the assigned category below.
+
+### Certainty Scores
+**`certainty_is_grill`**: Confidence in grilling suitability.
+   - High: Clear grilling-related labels (90%-100%).
+   - Medium: Partial or ambiguous indicators (60%-89%).
+   - Low: Little to no evidence of grilling suitability (50%-59%).
+
+## Input/Output Format
+
+**Input**: List of product names (one per line).
+**Output**: For each product, in the same order, provide:
+`Product Name: Fleischsorte, certainty_fleischsorte (%), is_grill (yes/no), certainty_is_grill (%)`.
+
+### Example
+
+**Input**:
+1. Spargeln weiss, Spanien/Griechenland/Peru
+2. Naturafarm Schweinsnierstücksteaks, Schweiz
+3. Poulet Flügel BBQ
+4. Grillkäse Halloumi
+5. Naturaplan Bio-Karotten
+
+**Output**:
+1. Grillgemüse, 90%, no, 98%
+2. Schwein, 95%, yes, 85%
+3. Geflügel, 98%, yes, 98%
+4. Käse, 95%, yes, 95%
+5. Grillgemüse, 70%, no, 90%
+
+## Guidance per Category (GERMAN)
+"""
+    + CATEGORY_GUIDANCE
+)
@@ -0,0 +1,368 @@
+"""
+Categorizes product names without the LLM, by their similarity to reviewed product names.
+
+Retrain with `python -m categorization.local_classifier`. It trains on tests/data/category_test.csv,
+the reviewed rows of the results and the corrections of reviewers, saves the model and writes a
+report of how many names would be resolved locally, and how accurately, at several certainties.
+"""
+
+import argparse
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from categorization.category_store import CategoryStore, split_final_category
+from llms.models import FinalProductCategory, ProductCategory
+from normalization import normalize_product_name
+from result_saver import ResultSaver, read_results
+from results_database import RESULTS_DATABASE_FILE_NAME, ResultsDatabase
+from settings import (
+    CATEGORY_STORE_PATH,
+    LOCAL_CLASSIFIER_MIN_CERTAINTY,
+    LOCAL_CLASSIFIER_NEIGHBOURS,
+    LOCAL_CLASSIFIER_PATH,
+    PDF_FILES_DIR,
+)
+
+NGRAM_SIZES = (2, 3, 4)
+CATEGORY_TEST_FILE = "tests/data/category_test.csv"
+NUM_FOLDS = 5
+REPORT_CERTAINTIES = [50, 60, 70, 80, 90, 95]
+# Names at least this similar to the names that voted for a label can be fully certain of it
+FULL_CERTAINTY_SIMILARITY = 0.3
+
+
+def get_ngrams(name: str) -> Counter:
+    """Character n-grams of the normalized name, the padding marks the start and end of words."""
+    text = f" {normalize_product_name(name)} "
+    return Counter(
+        text[i : i + n] for n in NGRAM_SIZES for i in range(len(text) - n + 1)
+    )
+
+
+def get_final_category(category: str, is_grill: bool) -> str:
+    if not is_grill or category == ProductCategory.OTHERS.value:
+        return FinalProductCategory.NO_GRILL_PRODUCT.value
+    return FinalProductCategory(category).value
+
+
+class LocalClassifier:
+    """
+    Nearest neighbour classifier over TF-IDF weighted character n-grams.
+
+    The names most similar to a product name vote on its category and is_grill, weighted by
+    their cosine similarity. The certainty of a vote is the share of the votes for the winner,
+    scaled down if even the closest name that voted for it is not very similar, so a new kind of
+    product is never certain. The training names are kept as a sparse matrix, stored column by column, so
+    a lookup only touches the names that share n-grams with the product name.
+    """
+
+    def __init__(self, neighbours: int = LOCAL_CLASSIFIER_NEIGHBOURS):
+        self.neighbours = neighbours
+        self.vocabulary: dict[str, int] = {}
+        self.idf = np.zeros(0)
+        self.categories = np.array([], dtype=str)
+        self.is_grill = np.array([], dtype=bool)
+        # Column j holds the weights of n-gram j: rows[column_starts[j]:column_starts[j + 1]]
+        self._column_starts = np.zeros(1, dtype=np.int64)
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._weights = np.zeros(0)
+        self.lookups = 0
+        self.resolved = 0
+
+    def __str__(self) -> str:
+        share = self.resolved / self.lookups if self.lookups > 0 else 0
+        return f"Local classifier: {self.resolved} of {self.lookups} new product names resolved locally ({share:.0%})"
+
+    def fit(
+        self, product_names: list[str], categories: list[str], is_grill: list[bool]
+    ) -> "LocalClassifier":
+        documents = [get_ngrams(name) for name in product_names]
+        self.vocabulary = {}
+        rows, columns, counts = [], [], []
+        for row, ngrams in enumerate(documents):
+            for ngram, count in ngrams.items():
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(ngram, len(self.vocabulary)))
+                counts.append(count)
+        rows, columns = np.array(rows, dtype=np.int64), np.array(
+            columns, dtype=np.int64
+        )
+
+        document_frequency = np.bincount(columns, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+        weights = (1 + np.log(np.array(counts, dtype=float))) * self.idf[columns]
+        norms = np.sqrt(np.bincount(rows, weights**2, minlength=len(documents)))
+        weights /= norms[rows]
+
+        order = np.argsort(columns, kind="stable")
+        self._rows, self._weights = rows[order], weights[order]
+        self._column_starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(columns, minlength=len(self.vocabulary)))]
+        )
+        self.categories = np.array(categories, dtype=str)
+        self.is_grill = np.array(is_grill, dtype=bool)
+        return self
+
+    def predict(self, product_names: list[str]) -> list[dict]:
+        """
+        Returns the category columns of every product name, with certainties from 0 to 100 like
+        the LLM. Without training data all certainties are 0.
+        """
+        return [self._predict(name) for name in product_names]
+
+    def resolve(
+        self, product_names: list[str], min_certainty: float
+    ) -> dict[int, dict]:
+        """
+        Returns the category columns of the product names whose category and is_grill both have
+        at least min_certainty, by index. The other names have to go to the LLM.
+        """
+        resolved = {
+            i: prediction
+            for i, prediction in enumerate(self.predict(product_names))
+            if min(
+                prediction["certainty_fleischsorte"], prediction["certainty_is_grill"]
+            )
+            >= min_certainty
+        }
+        self.lookups += len(product_names)
+        self.resolved += len(resolved)
+        return resolved
+
+    def _predict(self, product_name: str) -> dict:
+        similarities = self._get_similarities(product_name)
+        neighbours = np.argsort(-similarities, kind="stable")[: self.neighbours]
+        neighbours = neighbours[similarities[neighbours] > 0]
+        category, certainty_fleischsorte = self._vote(
+            self.categories[neighbours], similarities[neighbours]
+        )
+        is_grill, certainty_is_grill = self._vote(
+            self.is_grill[neighbours], similarities[neighbours]
+        )
+        return {
+            "category": (
+                ProductCategory.OTHERS.value if category is None else str(category)
+            ),
+            "certainty_fleischsorte": certainty_fleischsorte,
+            "is_grill": bool(is_grill),
+            "certainty_is_grill": certainty_is_grill,
+        }
+
+    def _get_similarities(self, product_name: str) -> np.ndarray:
+        """Cosine similarity of the product name to every training name."""
+        similarities = np.zeros(len(self.categories))
+        ngrams = get_ngrams(product_name)
+        if len(ngrams) == 0 or len(self.categories) == 0:
+            return similarities
+        # Unknown n-grams count for the length of the vector with the highest weight
+        unknown_idf = np.log(1 + len(self.categories)) + 1
+        columns, weights = [], []
+        norm = 0.0
+        for ngram, count in ngrams.items():
+            column = self.vocabulary.get(ngram)
+            idf = unknown_idf if column is None else self.idf[column]
+            weight = (1 + np.log(count)) * idf
+            norm += weight**2
+            if column is not None:
+                columns.append(column)
+                weights.append(weight)
+        for column, weight in zip(columns, weights):
+            start, end = self._column_starts[column], self._column_starts[column + 1]
+            similarities[self._rows[start:end]] += weight * self._weights[start:end]
+        return similarities / np.sqrt(norm)
+
+    @staticmethod
+    def _vote(labels: np.ndarray, similarities: np.ndarray) -> tuple:
+        """Returns the label with the most similarity weighted votes and its certainty."""
+        if len(labels) == 0:
+            return None, 0.0
+        votes = {}
+        for label, similarity in zip(labels.tolist(), similarities):
+            votes[label] = votes.get(label, 0.0) + similarity
+        winner = max(votes, key=votes.get)
+        share = votes[winner] / sum(votes.values())
+        closest = similarities[labels == winner].max()
+        return winner, round(
+            float(100 * share * min(1.0, closest / FULL_CERTAINTY_SIMILARITY)), 1
+        )
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        vocabulary = np.empty(len(self.vocabulary), dtype=object)
+        for ngram, column in self.vocabulary.items():
+            vocabulary[column] = ngram
+        np.savez_compressed(
+            path,
+            vocabulary=vocabulary.astype(str),
+            idf=self.idf,
+            categories=self.categories,
+            is_grill=self.is_grill,
+            column_starts=self._column_starts,
+            rows=self._rows,
+            weights=self._weights,
+            neighbours=self.neighbours,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LocalClassifier":
+        with np.load(path, allow_pickle=False) as model:
+            classifier = cls(int(model["neighbours"]))
+            classifier.vocabulary = {
+                ngram: column
+                for column, ngram in enumerate(map(str, model["vocabulary"]))
+            }
+            classifier.idf = model["idf"]
+            classifier.categories = model["categories"]
+            classifier.is_grill = model["is_grill"]
+            classifier._column_starts = model["column_starts"]
+            classifier._rows = model["rows"]
+            classifier._weights = model["weights"]
+        return classifier
+
+
+def load_training_data(pdf_dir: str, category_store_path: str) -> pd.DataFrame:
+    """
+    Collects the product names with a known category and is_grill: the category test, the rows
+    of the results that a reviewer checked and the corrections of reviewers, in this order of
+    precedence from low to high.
+    """
+    test_data = pd.read_csv(CATEGORY_TEST_FILE)
+    frames = [
+        pd.DataFrame(
+            {
+                "name": test_data["extracted_product_name"],
+                "category": test_data["solution_category"],
+                "is_grill": test_data["solution_is_grill"].astype(bool),
+            }
+        )
+    ]
+
+    database_path = os.path.join(pdf_dir, RESULTS_DATABASE_FILE_NAME)
+    if os.path.exists(database_path):
+        # Reviewers edit the results in the database
+        results = ResultsDatabase(database_path).select(["category_checked = 1"])
+    else:
+        results_path = ResultSaver().get_results_path(pdf_dir)
+        results = (
+            read_results(results_path) if results_path is not None else pd.DataFrame()
+        )
+    if "category_checked" in results.columns:
+        results = results[results["category_checked"] == True]
+        known_categories = (
+            results["category"]
+            if "category" in results.columns
+            else pd.Series(None, index=results.index)
+        )
+        reviewed = [
+            split_final_category(final_category, known_category)
+            for final_category, known_category in zip(
+                results["final_category"], known_categories
+            )
+        ]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "name": results["extracted_product_name"].astype(str),
+                    "category": [category for category, _ in reviewed],
+                    "is_grill": [is_grill for _, is_grill in reviewed],
+                }
+            )
+        )
+
+    if os.path.exists(category_store_path):
+        corrections = CategoryStore(category_store_path, "").get_corrections()
+        frames.append(
+            pd.DataFrame(corrections, columns=["name", "category", "is_grill"])
+        )
+
+    data = pd.concat(frames, ignore_index=True)
+    data["normalized_name"] = data["name"].map(normalize_product_name)
+    return data.drop_duplicates("normalized_name", keep="last").reset_index(drop=True)
+
+
+def evaluate(data: pd.DataFrame, neighbours: int) -> dict:
+    """
+    Cross-validates the classifier: for every certainty of REPORT_CERTAINTIES, the share of the
+    names that would be resolved locally and the accuracy of their final category.
+    """
+    folds = np.random.default_rng(0).permutation(len(data)) % NUM_FOLDS
+    predictions = [None] * len(data)
+    for fold in range(NUM_FOLDS):
+        train, test = data[folds != fold], data[folds == fold]
+        classifier = LocalClassifier(neighbours).fit(
+            list(train["name"]), list(train["category"]), list(train["is_grill"])
+        )
+        for i, prediction in zip(test.index, classifier.predict(list(test["name"]))):
+            predictions[i] = prediction
+
+    certainties = np.array(
+        [min(p["certainty_fleischsorte"], p["certainty_is_grill"]) for p in predictions]
+    )
+    correct = np.array(
+        [
+            get_final_category(p["category"], p["is_grill"])
+            == get_final_category(category, is_grill)
+            for p, category, is_grill in zip(
+                predictions, data["category"], data["is_grill"]
+            )
+        ]
+    )
+    report = []
+    for min_certainty in REPORT_CERTAINTIES:
+        resolved = certainties >= min_certainty
+        report.append(
+            {
+                "min_certainty": min_certainty,
+                "resolved_locally": float(resolved.mean()),
+                "accuracy": float(correct[resolved].mean()) if resolved.any() else None,
+            }
+        )
+    return {
+        "training_names": len(data),
+        "folds": NUM_FOLDS,
+        "accuracy_of_all_names": float(correct.mean()),
+        "by_min_certainty": report,
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Retrains the local classifier of product names and reports its accuracy."
+    )
+    parser.add_argument("--pdf-dir", default=PDF_FILES_DIR)
+    parser.add_argument("--category-store", default=CATEGORY_STORE_PATH)
+    parser.add_argument("--output", default=LOCAL_CLASSIFIER_PATH)
+    parser.add_argument("--neighbours", type=int, default=LOCAL_CLASSIFIER_NEIGHBOURS)
+    args = parser.parse_args()
+
+    data = load_training_data(args.pdf_dir, args.category_store)
+    report = evaluate(data, args.neighbours)
+    LocalClassifier(args.neighbours).fit(
+        list(data["name"]), list(data["category"]), list(data["is_grill"])
+    ).save(args.output)
+
+    report_path = os.path.splitext(args.output)[0] + "_report.json"
+    with open(report_path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(
+        f"Trained on {report['training_names']} product names, saved at {args.output}"
+    )
+    print(f"Cross-validated over {report['folds']} folds:")
+    for row in report["by_min_certainty"]:
+        accuracy = "-" if row["accuracy"] is None else f"{row['accuracy']:.1%}"
+        marker = (
+            " (used)" if row["min_certainty"] == LOCAL_CLASSIFIER_MIN_CERTAINTY else ""
+        )
+        print(
+            f"  certainty >= {row['min_certainty']:>3}: {row['resolved_locally']:.1%} "
+            f"resolved locally, {accuracy} accurate{marker}"
+        )
+    print(f"Report saved at {report_path}")
+
+
+if __name__ == "__main__":
+    run()
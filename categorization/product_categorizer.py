@@ -1,8 +1,22 @@
 # categorization/product_categorizer.py
 
+import hashlib
+from typing import Callable
+
 import pandas as pd
 from collections import defaultdict
 
+from categorization.categorization_system_prompt import CATEGORIZATION_SYSTEM_PROMPT
+from categorization.categorization_user_prompt import (
+    CATEGORIZATION_USER_PROMPT,
+    CLASSIFICATION_IS_GRILL_USER_PROMPT,
+    FUSED_CATEGORIZATION_USER_PROMPT,
+)
+from categorization.category_store import CATEGORY_COLUMNS, CategoryStore
+from categorization.local_classifier import LocalClassifier
+from categorization.fused_categorization_system_prompt import (
+    FUSED_CATEGORIZATION_SYSTEM_PROMPT,
+)
 from categorization.classification_is_grill_system_prompt import (
     CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEFLUEGEL,
     CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_SCHWEIN,
@@ -14,35 +28,65 @@ from categorization.classification_is_grill_system_prompt import (
     CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMUESE,
     CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_OTHERS,
 )
-from llms.models import ProductCategory, FinalProductCategory
-from llms.openai_client import OpenAIClient
+from llms.models import (
+    ClassificationIsGrillResponseFormat,
+    FinalProductCategory,
+    ProductCategory,
+)
+from llms.openai_client import TEXT_MODEL, OpenAIClient
+from normalization import normalize_product_name
+from settings import CATEGORIZATION_MAX_BATCH_SIZE, LOCAL_CLASSIFIER_MIN_CERTAINTY
 from utils import get_api_key
 
 
 class ProductCategorizer:
-    def __init__(self):
-        self.categorization_columns = []
-
-    def classify_is_grill_batch(
+    def __init__(
         self,
-        product_names: list[str],
-        category: str,
-        openai_client: OpenAIClient,
-    ) -> list[dict]:
+        category_store: CategoryStore | None = None,
+        fused: bool = False,
+        local_classifier: LocalClassifier | None = None,
+        local_min_certainty: float = LOCAL_CLASSIFIER_MIN_CERTAINTY,
+    ):
         """
-        Classifies a batch of product names for 'is_grill' using a category-specific system prompt.
-
-        For the given category (string), it determines the corresponding system prompt
-        (expected to be defined as CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_{Category in CAPS})
-        and then uses the ProductCategory's classify_products_is_grill() method to perform
-        the classification.
-
         Parameters:
-            product_names (list[str]): List of product names.
-            category (str): The product category (string representation, e.g. "Geflügel").
+            category_store (CategoryStore | None): Known categories of product names, only unknown names are sent to the LLM.
+            fused (bool): Determine the category and 'is_grill' in one request per batch, instead of two steps.
+            local_classifier (LocalClassifier | None): Categorizes unknown names first, only the uncertain ones are sent to the LLM.
+            local_min_certainty (float): Minimum certainty (0-100) of the local classifier to skip the LLM.
+        """
+        self.categorization_columns = []
+        self.category_store = category_store
+        self.fused = fused
+        self.local_classifier = local_classifier
+        self.local_min_certainty = local_min_certainty
 
-        Returns:
-            list[dict]: Each dictionary contains 'is_grill' (bool) and 'certainty_is_grill' (float).
+    @classmethod
+    def get_prompt_version(cls, fused: bool = False) -> str:
+        """Hash of the model and all prompts, the stored categories are only valid for the same hash."""
+        digest = hashlib.sha256()
+        prompts = (
+            [FUSED_CATEGORIZATION_SYSTEM_PROMPT, FUSED_CATEGORIZATION_USER_PROMPT]
+            if fused
+            else [
+                CATEGORIZATION_SYSTEM_PROMPT,
+                CATEGORIZATION_USER_PROMPT,
+                CLASSIFICATION_IS_GRILL_USER_PROMPT,
+                *(
+                    cls.get_is_grill_system_prompt(category.value)
+                    for category in ProductCategory
+                ),
+            ]
+        )
+        for part in [TEXT_MODEL, *prompts]:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def get_is_grill_system_prompt(category: str) -> str:
+        """
+        Returns the system prompt for the 'is_grill' classification of the given category
+        (expected to be defined as CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_{Category in CAPS}).
         """
         # Map the category value to its corresponding system prompt.
         SYSTEM_PROMPT_MAPPING = {
@@ -56,16 +100,14 @@ class ProductCategorizer:
             ProductCategory.GRILLGEMUESE.value: CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_GEMUESE,
             ProductCategory.OTHERS.value: CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_OTHERS,
         }
-        system_prompt = SYSTEM_PROMPT_MAPPING.get(
+        return SYSTEM_PROMPT_MAPPING.get(
             category, CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_OTHERS
         )
 
-        # Call the classification method defined on the enum member.
-        # This method is expected to return a ClassificationIsGrillResponseFormat instance.
-        response = openai_client.classify_products_is_grill(
-            product_names, system_prompt
-        )
-
+    @staticmethod
+    def convert_is_grill_response(
+        response: ClassificationIsGrillResponseFormat,
+    ) -> list[dict]:
         # Extract and convert the results to a list of dictionaries.
         results = []
         for result in response.results:
@@ -77,79 +119,236 @@ class ProductCategorizer:
             )
         return results
 
+    def classify_is_grill_batch(
+        self,
+        product_names: list[str],
+        category: str,
+        openai_client: OpenAIClient,
+    ) -> list[dict]:
+        """
+        Classifies a batch of product names for 'is_grill' using a category-specific system prompt.
+
+        For the given category (string), it determines the corresponding system prompt
+        (expected to be defined as CLASSIFICATION_IS_GRILL_SYSTEM_PROMPT_{Category in CAPS})
+        and then uses the ProductCategory's classify_products_is_grill() method to perform
+        the classification.
+
+        Parameters:
+            product_names (list[str]): List of product names.
+            category (str): The product category (string representation, e.g. "Geflügel").
+
+        Returns:
+            list[dict]: Each dictionary contains 'is_grill' (bool) and 'certainty_is_grill' (float).
+        """
+        # This method is expected to return a ClassificationIsGrillResponseFormat instance.
+        response = openai_client.classify_products_is_grill(
+            product_names, self.get_is_grill_system_prompt(category)
+        )
+        return self.convert_is_grill_response(response)
+
     def categorize_products(
         self, data: pd.DataFrame, openai_client: OpenAIClient
     ) -> pd.DataFrame:
         """
         Categorizes products in two steps:
           1. Batch categorization using OpenAI for determining the product category.
-          2. For each category, group products in batches of up to 5 and use ChatGPT to determine 'is_grill'.
+          2. For each category, group products in batches and use ChatGPT to determine 'is_grill'.
+
+        All batches of a step are handed to the client at once, so a client can send them
+        together (e.g. through the Batch API). Every product name is only categorized once, and
+        names that the category store knows or the local classifier is certain of are not sent at all.
 
         Returns:
             pd.DataFrame: DataFrame with additional columns for 'category',
                         'certainty_fleischsorte', 'is_grill', and 'certainty_is_grill'.
         """
-        product_names = list(data["extracted_product_name"])
-        step_size = 5
+        normalized_names = [
+            normalize_product_name(name) for name in data["extracted_product_name"]
+        ]
+        known_categories = (
+            {}
+            if self.category_store is None
+            else self.category_store.get_many(normalized_names)
+        )
+        # The first spelling of every unknown name is sent to the LLM
+        unknown_names = {}
+        for name, normalized_name in zip(
+            data["extracted_product_name"], normalized_names
+        ):
+            if normalized_name not in known_categories:
+                unknown_names.setdefault(normalized_name, name)
 
-        # Step 1: Batch categorization using OpenAI API for the product category.
-        product_categories: list[ProductCategory] = []
-        for i in range(0, len(product_names), step_size):
-            categorization_results = openai_client.categorize_products(
-                product_names[i : i + step_size]
+        if self.local_classifier is not None and len(unknown_names) > 0:
+            normalized_unknown_names = list(unknown_names.keys())
+            for i, categories in self.local_classifier.resolve(
+                list(unknown_names.values()), self.local_min_certainty
+            ).items():
+                # Not stored, the store only keeps answers of the LLM and reviewers
+                known_categories[normalized_unknown_names[i]] = categories
+                del unknown_names[normalized_unknown_names[i]]
+
+        if len(unknown_names) > 0:
+            new_categories = self.categorize_with_llm(
+                list(unknown_names.values()), openai_client
             )
-            product_categories.extend(categorization_results)
-
-        # Build a list of category results from OpenAI responses.
-        category_results = []
-        for _, results in product_categories:
-            for result in results:
-                category_results.append(
-                    {
-                        "category": result.fleischsorte.value,  # string representation of the category
-                        "certainty_fleischsorte": result.certainty_fleischsorte,
-                    }
-                )
+            if new_categories is None:
+                return data
+            new_categories = dict(zip(unknown_names.keys(), new_categories))
+            if self.category_store is not None:
+                self.category_store.put_many(new_categories)
+            known_categories.update(new_categories)
+
+        # Merge the results with the original DataFrame.
+        res_df = pd.DataFrame(
+            [dict(known_categories[name]) for name in normalized_names],
+            columns=CATEGORY_COLUMNS,
+            index=data.index,
+        )
+        data = pd.concat([data, res_df], axis=1)
+        self.categorization_columns.extend(CATEGORY_COLUMNS)
+
+        self.reduce_categorization_dimensions(data)
+        return data
+
+    def categorize_with_llm(
+        self, product_names: list[str], openai_client: OpenAIClient
+    ) -> list[dict] | None:
+        """
+        Categorizes the product names with the LLM.
+
+        Returns:
+            list[dict] | None: The category columns of every product name, or None if the LLM did not categorize all of them.
+        """
+        if self.fused:
+            return self.categorize_fused_with_llm(product_names, openai_client)
 
-        # Check that the number of category results matches the input data.
-        if len(data.index) != len(category_results):
+        # Step 1: Batch categorization using OpenAI API for the product category.
+        categorization_results = self.request_in_batches(
+            self.split_batches(list(range(len(product_names)))),
+            lambda batches: [
+                response.results
+                for response in openai_client.categorize_products_many(
+                    [[product_names[i] for i in batch] for batch in batches]
+                )
+            ],
+        )
+        if categorization_results is None:
             print(
-                f"Length of the data {len(data.index)} and the assigned categories {len(category_results)} do not match!"
+                f"The categories of the {len(product_names)} products do not match the products!"
             )
-            return data
+            return None
+        category_results = [
+            {
+                "category": categorization_results[i].fleischsorte.value,
+                "certainty_fleischsorte": categorization_results[
+                    i
+                ].certainty_fleischsorte,
+            }
+            for i in range(len(product_names))
+        ]
 
-        # Step 2: Group products by category to classify 'is_grill' in batches.
+        # Step 2: Group products by category to classify 'is_grill' in batches, as every
+        # category has its own system prompt.
         category_groups = defaultdict(list)
-        # Build groups: key = category, value = list of tuples (index, product_name)
         for idx, cat_info in enumerate(category_results):
-            category = cat_info["category"]
-            category_groups[category].append((idx, product_names[idx]))
-
-        # Process each group in batches of up to 5 products.
-        for category, items in category_groups.items():
-            for i in range(0, len(items), step_size):
-                batch = items[i : i + step_size]
-                indices, names = zip(*batch)
-                # Call the placeholder function for the batch.
-                batch_results = self.classify_is_grill_batch(
-                    list(names), category, openai_client
-                )
-                # Assign the results back to the corresponding positions.
-                for idx_item, result in zip(indices, batch_results):
-                    category_results[idx_item]["is_grill"] = result["is_grill"]
-                    category_results[idx_item]["certainty_is_grill"] = result[
-                        "certainty_is_grill"
+            category_groups[cat_info["category"]].append(idx)
+        batches = [
+            batch
+            for indices in category_groups.values()
+            for batch in self.split_batches(indices)
+        ]
+        is_grill_results = self.request_in_batches(
+            batches,
+            lambda batches: [
+                response.results
+                for response in openai_client.classify_products_is_grill_many(
+                    [
+                        (
+                            [product_names[i] for i in batch],
+                            self.get_is_grill_system_prompt(
+                                category_results[batch[0]]["category"]
+                            ),
+                        )
+                        for batch in batches
                     ]
+                )
+            ],
+        )
+        if is_grill_results is None:
+            print(
+                f"The is_grill classifications of the {len(product_names)} products do not match the products!"
+            )
+            return None
+        for idx, result in is_grill_results.items():
+            category_results[idx]["is_grill"] = result.is_grill
+            category_results[idx]["certainty_is_grill"] = result.certainty_is_grill
+        return category_results
 
-        # Merge the results with the original DataFrame.
-        res_df = pd.DataFrame(category_results)
-        data = pd.concat([data, res_df], axis=1)
-        self.categorization_columns.extend(
-            ["category", "certainty_fleischsorte", "is_grill", "certainty_is_grill"]
+    def categorize_fused_with_llm(
+        self, product_names: list[str], openai_client: OpenAIClient
+    ) -> list[dict] | None:
+        """Same as categorize_with_llm, but with one request per batch for both steps."""
+        results = self.request_in_batches(
+            self.split_batches(list(range(len(product_names)))),
+            lambda batches: [
+                response.results
+                for response in openai_client.categorize_products_fused_many(
+                    [[product_names[i] for i in batch] for batch in batches]
+                )
+            ],
         )
+        if results is None:
+            print(
+                f"The categories of the {len(product_names)} products do not match the products!"
+            )
+            return None
+        return [
+            {
+                "category": results[i].fleischsorte.value,
+                "certainty_fleischsorte": results[i].certainty_fleischsorte,
+                "is_grill": results[i].is_grill,
+                "certainty_is_grill": results[i].certainty_is_grill,
+            }
+            for i in range(len(product_names))
+        ]
 
-        self.reduce_categorization_dimensions(data)
-        return data
+    @staticmethod
+    def split_batches(indices: list[int]) -> list[list[int]]:
+        """Splits the indices of the products into batches of CATEGORIZATION_MAX_BATCH_SIZE."""
+        return [
+            indices[i : i + CATEGORIZATION_MAX_BATCH_SIZE]
+            for i in range(0, len(indices), CATEGORIZATION_MAX_BATCH_SIZE)
+        ]
+
+    @staticmethod
+    def request_in_batches(
+        batches: list[list[int]],
+        request_many: Callable[[list[list[int]]], list[list]],
+    ) -> dict | None:
+        """
+        Sends all batches at once and matches the results back to the products by position. The
+        LLM answers with a list of results, if it has the wrong length the batch is split in half
+        and asked again, as the results cannot be assigned to the products.
+
+        Parameters:
+            request_many (Callable[[list[list[int]]], list[list]]): Sends the batches and returns the results of each one.
+
+        Returns:
+            dict | None: The result of every product index, or None if a single product did not get exactly one result.
+        """
+        results = {}
+        while batches:
+            mismatched = []
+            for batch, batch_results in zip(batches, request_many(batches)):
+                if len(batch_results) == len(batch):
+                    results.update(zip(batch, batch_results))
+                elif len(batch) > 1:
+                    middle = len(batch) // 2
+                    mismatched.extend([batch[:middle], batch[middle:]])
+                else:
+                    return None
+            batches = mismatched
+        return results
 
     def reduce_categorization_dimensions(self, data):
         data["final_category"] = data.apply(
@@ -0,0 +1,121 @@
+import json
+import os
+from typing import Callable, Dict
+
+import pandas as pd
+
+from pdf_manifest import get_file_hash
+from utils import atomic_write
+
+COMBINE_MANIFEST_FILE_NAME = "combine_manifest.json"
+COMBINE_CACHE_FILE_NAME = "combine_cache.parquet"
+# Directory of the results that a row of the cache came from
+SOURCE_COLUMN = "_source"
+
+
+class CombineManifest:
+    """
+    Records which results files the combined results were built from: the path, size,
+    modification time and hash of every file, with a columnar copy of their combined rows.
+
+    When the results are combined again, only the files that changed are read, the rows of all
+    other files come from the copy. If the size and modification time of a file are unchanged,
+    not even its content is read.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        file_name: str = COMBINE_MANIFEST_FILE_NAME,
+        cache_file_name: str = COMBINE_CACHE_FILE_NAME,
+    ):
+        self.path = os.path.join(output_dir, file_name)
+        self.cache_path = os.path.join(output_dir, cache_file_name)
+        self.output_dir = output_dir
+        self.files_read = 0
+        self.files_reused = 0
+
+    def __str__(self) -> str:
+        return f"Combined results: {self.files_read} results files read, {self.files_reused} reused"
+
+    def load(self) -> dict | None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+        return manifest if os.path.exists(self.cache_path) else None
+
+    def combine(
+        self,
+        results_paths: Dict[str, str],
+        read: Callable[[str], pd.DataFrame],
+        write: Callable[[pd.DataFrame, str], None],
+    ) -> pd.DataFrame:
+        """
+        Combines the results files in the order of results_paths, reading only the ones that
+        changed since the last call.
+
+        Parameters:
+            results_paths (Dict[str, str]): The results file of every directory, by directory.
+            read (Callable[[str], pd.DataFrame]): Reads a results file.
+            write (Callable[[pd.DataFrame, str], None]): Writes the copy of the combined rows to a Parquet file.
+        """
+        manifest = self.load() or {"results": {}}
+        entries = {}
+        unchanged = []
+        for directory, results_path in results_paths.items():
+            stat = os.stat(results_path)
+            entry = {
+                "path": os.path.relpath(results_path, self.output_dir),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+            previous = manifest["results"].get(directory)
+            if previous is not None and previous["path"] == entry["path"]:
+                if (previous["size"], previous["mtime_ns"]) == (
+                    entry["size"],
+                    entry["mtime_ns"],
+                ):
+                    entry["sha256"] = previous["sha256"]
+                    unchanged.append(directory)
+                elif get_file_hash(results_path) == previous["sha256"]:
+                    # Same content, e.g. copied: the next check is fast again
+                    entry["sha256"] = previous["sha256"]
+                    unchanged.append(directory)
+            entries[directory] = entry
+
+        self.files_reused += len(unchanged)
+        if len(unchanged) == len(results_paths) == len(manifest["results"]):
+            if entries != manifest["results"]:
+                self._write({"results": entries})
+            return pd.read_parquet(self.cache_path).drop(columns=SOURCE_COLUMN)
+
+        frames = []
+        if unchanged:
+            cached = pd.read_parquet(self.cache_path)
+            frames.append(cached[cached[SOURCE_COLUMN].isin(unchanged)])
+        for directory, results_path in results_paths.items():
+            if directory in unchanged:
+                continue
+            self.files_read += 1
+            entries[directory]["sha256"] = get_file_hash(results_path)
+            frames.append(read(results_path).assign(**{SOURCE_COLUMN: directory}))
+
+        combined = pd.concat(frames, ignore_index=True)
+        # The rows of a directory keep their order, the directories are in the given order
+        order = {directory: index for index, directory in enumerate(results_paths)}
+        combined = combined.sort_values(
+            SOURCE_COLUMN,
+            key=lambda sources: sources.astype(str).map(order),
+            kind="stable",
+        ).reset_index(drop=True)
+        with atomic_write(self.cache_path) as temporary_cache_path:
+            write(combined, temporary_cache_path)
+        self._write({"results": entries})
+        return combined.drop(columns=SOURCE_COLUMN)
+
+    def _write(self, manifest: dict) -> None:
+        with atomic_write(self.path) as temporary_path:
+            with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
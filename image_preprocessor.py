@@ -0,0 +1,120 @@
+import io
+import math
+from typing import Tuple
+
+from PIL import Image
+
+# The vision models fit "high" detail images into a 2048x2048 square and then scale the
+# shortest side down to 768 pixels, "low" detail images are scaled to fit 512x512.
+# Anything larger is only uploaded to be thrown away.
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_MAX_SHORT_SIDE = 768
+LOW_DETAIL_MAX_SIDE = 512
+# Image tokens: a base amount, plus per 512px tile in high detail
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_DETAILS = ("high", "low", "auto")
+IMAGE_FORMATS = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+IMAGE_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+
+class ImagePreprocessor:
+    """
+    Prepares the rendered pages for the upload to the vision model: scales them down to the
+    resolution the model actually uses and encodes them compactly.
+    """
+
+    def __init__(
+        self,
+        image_format: str = "PNG",
+        quality: int = 85,
+        detail: str = "high",
+        resize: bool = True,
+    ):
+        """
+        Parameters:
+            image_format (str): PNG, JPEG or WEBP.
+            quality (int): Quality of JPEG and WEBP images, from 1 to 100. PNG is lossless.
+            detail (str): Detail setting of the vision model: high, low or auto.
+            resize (bool): Whether to scale the images down to the effective resolution of the model.
+        """
+        image_format = image_format.upper()
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(
+                f"Unsupported image format {image_format}, use one of {list(IMAGE_FORMATS)}."
+            )
+        if detail not in IMAGE_DETAILS:
+            raise ValueError(
+                f"Unsupported detail {detail}, use one of {list(IMAGE_DETAILS)}."
+            )
+        self.image_format = image_format
+        self.quality = quality
+        self.detail = detail
+        self.resize = resize
+
+    @property
+    def mime_type(self) -> str:
+        return IMAGE_FORMATS[self.image_format]
+
+    @property
+    def extension(self) -> str:
+        return IMAGE_EXTENSIONS[self.image_format]
+
+    @property
+    def settings(self) -> dict:
+        """Everything that changes the encoded images, to tell them apart from full size renders."""
+        return {
+            "image_format": self.image_format,
+            "quality": self.quality,
+            "detail": self.detail,
+            "resize": self.resize,
+        }
+
+    def get_target_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Returns the size the model scales an image of the given size to. Never upscales."""
+        if self.detail == "low":
+            factor = LOW_DETAIL_MAX_SIDE / max(width, height)
+        else:
+            # "auto" lets the model choose, so keep enough for high detail
+            factor = min(
+                HIGH_DETAIL_MAX_SIDE / max(width, height),
+                HIGH_DETAIL_MAX_SHORT_SIDE / min(width, height),
+            )
+        if factor >= 1:
+            return width, height
+        return max(1, round(width * factor)), max(1, round(height * factor))
+
+    def count_image_tokens(self, width: int, height: int) -> int:
+        """Returns the prompt tokens the model bills for an image of the given size."""
+        if self.detail == "low":
+            return IMAGE_BASE_TOKENS
+        width, height = self.get_target_size(width, height)
+        tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+        return IMAGE_BASE_TOKENS + tiles * IMAGE_TILE_TOKENS
+
+    def prepare(self, image_data: bytes) -> bytes:
+        """
+        Returns the image, resized and encoded in the configured format.
+
+        Images that would not change are returned as they are.
+        """
+        image = Image.open(io.BytesIO(image_data))
+        target_size = self.get_target_size(*image.size) if self.resize else image.size
+        if target_size == image.size and image.format == self.image_format:
+            return image_data
+        return self.encode(image)
+
+    def encode(self, image: Image.Image) -> bytes:
+        """Resizes and encodes a decoded image, e.g. a freshly rendered page."""
+        target_size = self.get_target_size(*image.size) if self.resize else image.size
+        if target_size != image.size:
+            image = image.resize(target_size, Image.Resampling.LANCZOS)
+        if self.image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        if self.image_format == "PNG":
+            image.save(output, format="PNG", optimize=True)
+        else:
+            image.save(output, format=self.image_format, quality=self.quality)
+        return output.getvalue()
@@ -0,0 +1,35 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils import atomic_write
+
+
+class AsyncImageWriter:
+    """
+    Writes encoded images to disk in a background thread, so that rendering and uploading
+    never wait for the (slow) storage. The images are only needed for the review UI.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: list[Future] = []
+
+    def write(self, image_path: str, image_data: bytes) -> None:
+        self._futures.append(self._executor.submit(self._write, image_path, image_data))
+
+    def close(self) -> None:
+        """Waits until all images are written, and raises the first error, if any."""
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
+    @staticmethod
+    def _write(image_path: str, image_data: bytes) -> None:
+        if os.path.exists(image_path):
+            # The page was read from disk, not rendered
+            return
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        # Half an image would be taken for a rendered page on the next run
+        with atomic_write(image_path) as temporary_path:
+            with open(temporary_path, "wb") as image_file:
+                image_file.write(image_data)
@@ -1,24 +1,114 @@
 # leaflet_processing/leaflet_reader.py
 
-import glob
+import hashlib
+import io
 import os
-from typing import List
+import re
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
 
 from natsort import natsorted
 import pypdfium2 as pdfium
-from PyPDF2 import PdfReader
 
 from file_downloaders import Downloader
+from image_preprocessor import ImagePreprocessor
+from pdf_manifest import PdfManifest, get_file_hash
+from utils import get_all_image_paths, read_image
+
+RENDER_SCALE = 4
+PAGES_PER_RENDER_TASK = 1
+
+
+class RenderedPage(NamedTuple):
+    image_path: str
+    # Only set if the page was rendered to memory or read from disk
+    image_data: bytes | None
+    # Not set for images that existed already
+    image_hash: str | None
+    image_size: int | None
+
+
+def render_pdf_pages(
+    pdf_path: str, output_dir: str, page_indices: List[int], scale: float
+) -> List[RenderedPage]:
+    """
+    Renders the given pages of a PDF into PNG images.
+
+    This runs inside a worker process, and pdfium is not thread-safe, so every call
+    opens its own document.
+
+    Parameters:
+        pdf_path (str): Path to the PDF file.
+        output_dir (str): Path to where the images will be written.
+        page_indices (List[int]): Zero-based indices of the pages to render.
+        scale (float): Render scale, 1 is 72 dpi.
+
+    Returns:
+        List[RenderedPage]: The written images, in the order of page_indices.
+    """
+    pages = []
+    for image_path, image_data, image_hash, image_size in render_pdf_pages_to_memory(
+        pdf_path, output_dir, page_indices, scale, None
+    ):
+        with open(image_path, "wb") as image_file:
+            image_file.write(image_data)
+        pages.append(RenderedPage(image_path, None, image_hash, image_size))
+    return pages
+
+
+def render_pdf_pages_to_memory(
+    pdf_path: str,
+    output_dir: str,
+    page_indices: List[int],
+    scale: float,
+    image_preprocessor: ImagePreprocessor | None,
+) -> List[RenderedPage]:
+    """
+    Same as render_pdf_pages, but returns the encoded images instead of writing them.
+
+    Parameters:
+        image_preprocessor (ImagePreprocessor | None): Resizes and encodes the pages for the upload, None keeps full size PNGs.
+
+    Returns:
+        List[RenderedPage]: The images with the path they would be saved at, in the order of page_indices.
+    """
+    pdf_name, _ = os.path.splitext(os.path.basename(pdf_path))
+    extension = "png" if image_preprocessor is None else image_preprocessor.extension
+    pdf_doc = pdfium.PdfDocument(pdf_path)
+    pages = []
+    try:
+        for i in page_indices:
+            image = pdf_doc[i].render(scale=scale).to_pil()
+            if image_preprocessor is None:
+                output = io.BytesIO()
+                image.save(output, format="PNG")
+                image_data = output.getvalue()
+            else:
+                image_data = image_preprocessor.encode(image)
+            pages.append(
+                RenderedPage(
+                    os.path.join(output_dir, f"{pdf_name}_{i + 1}.{extension}"),
+                    image_data,
+                    hashlib.sha256(image_data).hexdigest(),
+                    len(image_data),
+                )
+            )
+    finally:
+        pdf_doc.close()
+    return pages
 
 
 class LeafletReader:
 
-    def __init__(self, file_downloader: Downloader):
+    def __init__(self, file_downloader: Downloader, num_render_workers: int = 1):
         """
         Parameters:
             file_downloader (Downloader): Responsible for downloading the files
+            num_render_workers (int): Number of processes used to render PDF pages, 1 renders in this process.
         """
         self.file_downloader = file_downloader
+        self.num_render_workers = max(1, num_render_workers)
 
     def download_leaflets(self, pdf_dir: str) -> None:
         """
@@ -42,32 +132,222 @@ class LeafletReader:
         Returns:
             List[str]: List of image paths.
         """
-        if not overwrite_images:
-            # Note: Streamlit would require: reader = PdfReader(io.BytesIO(pdf_path.read()))
-            reader = PdfReader(pdf_path)
-            png_files = glob.glob(f"{output_dir}/*.png")
-            png_files = [os.path.basename(f) for f in png_files]
-            pdf_name, _ = os.path.splitext(os.path.basename(pdf_path))
+        return self.convert_pdfs_to_images([(pdf_path, output_dir)], overwrite_images)[
+            pdf_path
+        ]
 
-            expected_image_names = set(
-                [f"{pdf_name}_{i + 1}.png" for i in range(len(reader.pages))]
-            )
-            if len(expected_image_names - set(png_files)) == 0:
-                print(
-                    f"Found PNG images for {pdf_path}. Skipping conversion from PDF to images."
+    def convert_pdfs_to_images(
+        self, pdf_jobs: List[Tuple[str, str]], overwrite_images=False
+    ) -> Dict[str, List[str]]:
+        """
+        Splits several PDFs into individual images. The pages of all PDFs are spread
+        over num_render_workers processes.
+
+        Parameters:
+            pdf_jobs (List[Tuple[str, str]]): Pairs of (PDF path, output directory).
+            overwrite_images (bool): If False, skips the conversion of a PDF, if enough images are found.
+
+        Returns:
+            Dict[str, List[str]]: The image paths for every PDF path.
+        """
+        image_paths = {pdf_path: [] for pdf_path, _ in pdf_jobs}
+        for pdf_path, paths, _ in self.iter_pdfs_to_images(pdf_jobs, overwrite_images):
+            image_paths[pdf_path].extend(paths)
+        return {pdf_path: natsorted(paths) for pdf_path, paths in image_paths.items()}
+
+    def iter_pdfs_to_images(
+        self, pdf_jobs: List[Tuple[str, str]], overwrite_images=False
+    ) -> Iterator[Tuple[str, List[str], int]]:
+        """
+        Same as convert_pdfs_to_images, but yields the images as soon as they are rendered,
+        in page order. At most two page ranges per worker are rendered ahead of the consumer.
+
+        Yields:
+            Tuple[str, List[str], int]: PDF path, the new image paths and the total number of pages of that PDF.
+        """
+        for pdf_path, pages, num_pages in self._iter_rendered_pages(
+            pdf_jobs, overwrite_images, "png", None, False, render_pdf_pages, ()
+        ):
+            yield pdf_path, [page.image_path for page in pages], num_pages
+
+    def iter_pdfs_to_buffers(
+        self,
+        pdf_jobs: List[Tuple[str, str]],
+        image_preprocessor: ImagePreprocessor | None = None,
+    ) -> Iterator[Tuple[str, List[Tuple[str, bytes]], int]]:
+        """
+        Same as iter_pdfs_to_images, but the pages are encoded in the render workers and yielded
+        in memory, without writing them to disk. Images that already exist on disk are read instead.
+
+        Parameters:
+            image_preprocessor (ImagePreprocessor | None): Resizes and encodes the pages for the upload, None keeps full size PNGs.
+
+        Yields:
+            Tuple[str, List[Tuple[str, bytes]], int]: PDF path, the (image path, encoded image) of the new pages and the total number of pages of that PDF.
+        """
+        for pdf_path, pages, num_pages in self._iter_rendered_pages(
+            pdf_jobs,
+            False,
+            "png" if image_preprocessor is None else image_preprocessor.extension,
+            None if image_preprocessor is None else image_preprocessor.settings,
+            True,
+            render_pdf_pages_to_memory,
+            (image_preprocessor,),
+        ):
+            yield pdf_path, [
+                (page.image_path, page.image_data) for page in pages
+            ], num_pages
+
+    def _iter_rendered_pages(
+        self,
+        pdf_jobs: List[Tuple[str, str]],
+        overwrite_images: bool,
+        extension: str,
+        preprocessing: dict | None,
+        read_existing_images: bool,
+        render_function: Callable,
+        render_args: tuple,
+    ) -> Iterator[Tuple[str, List[RenderedPage], int]]:
+        """
+        Runs render_function(pdf_path, output_dir, page_indices, scale, *render_args) for all PDFs
+        that have no images yet, and yields its results in page order. PDFs whose images all exist
+        are yielded first, with the existing images, which are only read if read_existing_images is set.
+
+        Once all pages of a PDF are rendered, its manifest is written to the output directory. Pages
+        that were preprocessed for the upload are recorded with the preprocessing settings, so that
+        they are not taken for full size renders later, e.g. to cut tiles from.
+        """
+        render_tasks = []
+        num_pages_per_pdf = {}
+        for pdf_path, output_dir in pdf_jobs:
+            if not overwrite_images:
+                existing_images = self._find_existing_images(
+                    pdf_path, output_dir, extension, preprocessing
                 )
-                return natsorted(png_files)
+                if existing_images is not None:
+                    print(
+                        f"Found {extension.upper()} images for {pdf_path}. Skipping conversion from PDF to images."
+                    )
+                    yield pdf_path, [
+                        RenderedPage(
+                            path,
+                            read_image(path) if read_existing_images else None,
+                            None,
+                            None,
+                        )
+                        for path in existing_images
+                    ], len(existing_images)
+                    continue
 
-        print(f"Converting {pdf_path} to images.")
-        os.makedirs(output_dir, exist_ok=True)
+            print(f"Converting {pdf_path} to images.")
+            os.makedirs(output_dir, exist_ok=True)
+            # Disk and memory mode use different formats, a directory must only hold one render
+            self._remove_rendered_images(pdf_path, output_dir)
+            num_pages = self._count_pages(pdf_path)
+            num_pages_per_pdf[pdf_path] = num_pages
+            for start in range(0, num_pages, PAGES_PER_RENDER_TASK):
+                page_indices = list(
+                    range(start, min(start + PAGES_PER_RENDER_TASK, num_pages))
+                )
+                render_tasks.append(
+                    (pdf_path, output_dir, page_indices, RENDER_SCALE, *render_args)
+                )
+
+        output_dirs = dict(pdf_jobs)
+        rendered_pages = defaultdict(list)
+
+        def finish(pdf_path: str, pages: List[RenderedPage]):
+            rendered_pages[pdf_path].extend(pages)
+            if len(rendered_pages[pdf_path]) == num_pages_per_pdf[pdf_path]:
+                PdfManifest(output_dirs[pdf_path]).save(
+                    pdf_path,
+                    RENDER_SCALE,
+                    extension,
+                    {
+                        os.path.basename(page.image_path): (
+                            page.image_hash,
+                            page.image_size,
+                        )
+                        for page in rendered_pages.pop(pdf_path)
+                    },
+                    preprocessing,
+                )
+            return pdf_path, pages, num_pages_per_pdf[pdf_path]
+
+        if self.num_render_workers == 1 or len(render_tasks) <= 1:
+            for task in render_tasks:
+                yield finish(task[0], render_function(*task))
+            return
 
+        with ProcessPoolExecutor(max_workers=self.num_render_workers) as executor:
+            in_flight = deque()
+            for task in render_tasks:
+                in_flight.append((task[0], executor.submit(render_function, *task)))
+                if len(in_flight) >= 2 * self.num_render_workers:
+                    pdf_path, future = in_flight.popleft()
+                    yield finish(pdf_path, future.result())
+            while in_flight:
+                pdf_path, future = in_flight.popleft()
+                yield finish(pdf_path, future.result())
+
+    @staticmethod
+    def _count_pages(pdf_path: str) -> int:
         pdf_doc = pdfium.PdfDocument(pdf_path)
-        paths = []
+        try:
+            return len(pdf_doc)
+        finally:
+            pdf_doc.close()
+
+    @staticmethod
+    def _remove_rendered_images(pdf_path: str, output_dir: str) -> None:
+        """Deletes the page images of earlier renders of the PDF, in any format."""
+        pdf_name, _ = os.path.splitext(os.path.basename(pdf_path))
+        page_image = re.compile(rf"{re.escape(pdf_name)}_\d+")
+        for image_path in get_all_image_paths(output_dir):
+            image_name, _ = os.path.splitext(os.path.basename(image_path))
+            if page_image.fullmatch(image_name):
+                os.remove(image_path)
 
-        for i, page in enumerate(pdf_doc):
-            image = page.render(scale=4).to_pil()
-            output_filename = os.path.join(output_dir, f"{pdf_name}_{i + 1}.png")
-            image.save(output_filename, format="PNG")
-            paths.append(output_filename)
+    @classmethod
+    def _find_existing_images(
+        cls,
+        pdf_path: str,
+        output_dir: str,
+        extension: str = "png",
+        preprocessing: dict | None = None,
+    ) -> List[str] | None:
+        """
+        Returns the already converted images of the PDF, or None if any page is missing.
+
+        The manifest of the output directory answers this without parsing the PDF. Directories
+        rendered before there were manifests are checked against the page count of the PDF once,
+        and get a manifest if all images are there, those are full size renders.
+        """
+        manifest = PdfManifest(output_dir)
+        image_paths = manifest.find_images(
+            pdf_path, RENDER_SCALE, extension, preprocessing
+        )
+        if (
+            image_paths is not None
+            or manifest.load() is not None
+            or preprocessing is not None
+        ):
+            return image_paths
 
-        return natsorted(paths)
+        pdf_name, _ = os.path.splitext(os.path.basename(pdf_path))
+        image_paths = [
+            os.path.join(output_dir, f"{pdf_name}_{i + 1}.{extension}")
+            for i in range(cls._count_pages(pdf_path))
+        ]
+        if not all(os.path.exists(path) for path in image_paths):
+            return None
+        manifest.save(
+            pdf_path,
+            RENDER_SCALE,
+            extension,
+            {
+                os.path.basename(path): (get_file_hash(path), os.path.getsize(path))
+                for path in image_paths
+            },
+        )
+        return image_paths
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from openai import NotFoundError
+from openai.types import CompletionUsage
+
+from image_preprocessor import ImagePreprocessor
+from telemetry import Telemetry
+from utils import atomic_write
+from .models import (
+    Results,
+    ClassificationIsGrillResponseFormat,
+    CategorizationResponseFormat,
+    FusedCategorizationResponseFormat,
+)
+from .openai_client import OpenAIClient
+from .response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# Limits of the Batch API for a single input file
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+FINAL_BATCH_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchOpenAIClient(OpenAIClient):
+    """
+    OpenAIClient that sends many requests at once through the OpenAI Batch API.
+
+    Batches cost half of the synchronous requests and have their own rate limit, but can take
+    up to 24 hours. Requests that are cached are not submitted, requests that fail inside the
+    batch are sent synchronously instead.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        work_dir: str,
+        poll_interval_secs: float,
+        cache: ResponseCache | None = None,
+        telemetry: Telemetry | None = None,
+        client=None,
+        image_preprocessor: ImagePreprocessor | None = None,
+    ):
+        """
+        Parameters:
+            api_key (str): The OpenAI API key.
+            work_dir (str): Directory for the JSONL files that are uploaded.
+            poll_interval_secs (float): Seconds between two status checks of a batch.
+            cache (ResponseCache | None): If given, responses are looked up there before submitting them.
+            telemetry (Telemetry | None): If given, the requests that are sent directly are recorded.
+            client: Replaces the OpenAI client, e.g. with a local stand-in for the batch endpoints.
+            image_preprocessor (ImagePreprocessor | None): Resizes and encodes the images before the upload.
+        """
+        super().__init__(api_key, cache, telemetry, client, image_preprocessor)
+        self.work_dir = work_dir
+        self.poll_interval_secs = poll_interval_secs
+
+    def extract_many(self, images: List[bytes]) -> List[Results]:
+        return self._request_many(
+            [self.build_extraction_request(image_data) for image_data in images],
+            "extract",
+        )
+
+    def validate_product_data_many(
+        self, validations: List[Tuple[Results, bytes, int]]
+    ) -> List[Results]:
+        """Runs validate_product_data for every (products, image, seed), in one batch."""
+        return self._request_many(
+            [
+                self.build_validation_request(products, image, seed)
+                for products, image, seed in validations
+            ],
+            "validate_product_data",
+        )
+
+    def categorize_products_many(
+        self, product_batches: List[List[str]]
+    ) -> List[CategorizationResponseFormat]:
+        return self._request_many(
+            [
+                self.build_categorization_request(products)
+                for products in product_batches
+            ],
+            "categorize_products",
+        )
+
+    def categorize_products_fused_many(
+        self, product_batches: List[List[str]]
+    ) -> List[FusedCategorizationResponseFormat]:
+        return self._request_many(
+            [
+                self.build_fused_categorization_request(products)
+                for products in product_batches
+            ],
+            "categorize_products_fused",
+        )
+
+    def classify_products_is_grill_many(
+        self, product_batches: List[Tuple[List[str], str]]
+    ) -> List[ClassificationIsGrillResponseFormat]:
+        return self._request_many(
+            [
+                self.build_classification_is_grill_request(products, system_prompt)
+                for products, system_prompt in product_batches
+            ],
+            "classify_products_is_grill",
+        )
+
+    def _request_many(self, requests: List[dict], method: str) -> list:
+        """
+        Returns the responses to all requests, in order. Only requests that are not cached are submitted.
+        """
+        responses = [None] * len(requests)
+        lines = {}
+        for i, request in enumerate(requests):
+            if self.cache is not None:
+                responses[i] = self.cache.get(
+                    self.request_key(request), request["response_format"]
+                )
+            if responses[i] is None:
+                lines[i] = json.dumps(
+                    {
+                        "custom_id": str(i),
+                        "method": "POST",
+                        "url": BATCH_ENDPOINT,
+                        "body": self.request_body(request),
+                    }
+                )
+
+        for chunk in self._split_into_batches(lines):
+            contents = self._run_batch([lines[i] for i in chunk], method)
+            for i in chunk:
+                content = contents.get(str(i))
+                if content is None:
+                    logger.warning(
+                        "Request %d did not succeed in the batch, sending it directly.",
+                        i,
+                    )
+                    responses[i] = self._parse(requests[i], method)
+                else:
+                    responses[i] = requests[i]["response_format"].model_validate_json(
+                        content
+                    )
+                # A refusal has no parsed response, it is asked again next time
+                if self.cache is not None and responses[i] is not None:
+                    self.cache.put(self.request_key(requests[i]), responses[i])
+        return responses
+
+    @staticmethod
+    def _split_into_batches(lines: dict[int, str]) -> List[List[int]]:
+        """Splits the requests so that no input file exceeds the limits of the Batch API."""
+        batches = []
+        current, current_bytes = [], 0
+        for i, line in lines.items():
+            line_bytes = len(line.encode("utf-8")) + 1
+            if current and (
+                len(current) >= MAX_REQUESTS_PER_BATCH
+                or current_bytes + line_bytes > MAX_BATCH_FILE_BYTES
+            ):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(i)
+            current_bytes += line_bytes
+        if current:
+            batches.append(current)
+        return batches
+
+    def _run_batch(self, lines: List[str], method: str) -> dict[str, str]:
+        """
+        Uploads the JSONL lines as one batch, waits until it is finished and returns the
+        message content of every successful request by its custom_id.
+
+        The id of the submitted batch is kept in the work dir until the batch is finished, so
+        that a restart with the same requests polls that batch instead of paying for a new one.
+        """
+        start = time.perf_counter()
+        os.makedirs(self.work_dir, exist_ok=True)
+        input_content = "\n".join(lines) + "\n"
+        digest = hashlib.sha256(input_content.encode("utf-8")).hexdigest()
+        input_path = os.path.join(self.work_dir, f"batch_{digest}.jsonl")
+        state_path = os.path.join(self.work_dir, f"batch_{digest}.json")
+
+        batch = self._resume_batch(state_path)
+        if batch is None:
+            with open(input_path, "w", encoding="utf-8") as input_file:
+                input_file.write(input_content)
+            with open(input_path, "rb") as input_file:
+                batch_file = self.client.files.create(file=input_file, purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=BATCH_COMPLETION_WINDOW,
+            )
+            self._write_batch_state(
+                state_path, {"batch_id": batch.id, "input_file_id": batch_file.id}
+            )
+            logger.info("Submitted batch %s with %d requests.", batch.id, len(lines))
+
+        while batch.status not in FINAL_BATCH_STATES:
+            time.sleep(self.poll_interval_secs)
+            batch = self.client.batches.retrieve(batch.id)
+            logger.info("Batch %s is %s.", batch.id, batch.status)
+
+        if batch.status in ("failed", "cancelled"):
+            self._remove_batch_files(input_path, state_path)
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}.")
+
+        contents = self._read_batch_output(batch, method, start)
+        self._remove_batch_files(input_path, state_path)
+        return contents
+
+    def _read_batch_output(self, batch, method: str, start: float) -> dict[str, str]:
+        """Returns the message content of every successful request of a finished batch by its custom_id."""
+        # Expired batches still return the requests that were finished in time
+        contents = {}
+        if batch.output_file_id is None:
+            return contents
+        output = self.client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            if self.telemetry is not None:
+                self.telemetry.record_call(
+                    method,
+                    body.get("model", ""),
+                    time.perf_counter() - start,
+                    (
+                        CompletionUsage.model_validate(body["usage"])
+                        if body.get("usage")
+                        else None
+                    ),
+                    retries=0,
+                    batch=True,
+                )
+            message = body["choices"][0]["message"]
+            if message.get("content"):
+                contents[record["custom_id"]] = message["content"]
+        return contents
+
+    def _resume_batch(self, state_path: str):
+        """
+        Returns the batch that an earlier run submitted for the same requests, or None if there is
+        none that can still deliver results.
+        """
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, encoding="utf-8") as state_file:
+                batch_id = json.load(state_file)["batch_id"]
+            batch = self.client.batches.retrieve(batch_id)
+        except (json.JSONDecodeError, KeyError, NotFoundError):
+            logger.warning(
+                "Could not resume the batch of %s, submitting it again.", state_path
+            )
+            return None
+        if batch.status in ("failed", "cancelled"):
+            return None
+        logger.info("Resuming batch %s, which is %s.", batch.id, batch.status)
+        return batch
+
+    @staticmethod
+    def _write_batch_state(state_path: str, state: dict) -> None:
+        with atomic_write(state_path) as temporary_path:
+            with open(temporary_path, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+
+    @staticmethod
+    def _remove_batch_files(*paths: str) -> None:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
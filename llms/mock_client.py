@@ -1,6 +1,14 @@
+import json
+from types import SimpleNamespace
 from typing import List
 from unittest.mock import MagicMock
 
+from categorization.categorization_user_prompt import (
+    CATEGORIZATION_USER_PROMPT,
+    CLASSIFICATION_IS_GRILL_USER_PROMPT,
+    FUSED_CATEGORIZATION_USER_PROMPT,
+)
+
 from .openai_client import OpenAIClient
 from .models import (
     Results,
@@ -10,6 +18,8 @@ from .models import (
     CategorizationResponseFormat,
     ClassificationIsGrillResult,
     ClassificationIsGrillResponseFormat,
+    FusedCategorizationResult,
+    FusedCategorizationResponseFormat,
 )
 
 
@@ -19,12 +29,20 @@ class MockLLM:
         self._client.extract = MagicMock(return_value=self._results())
         self._client.validate_product_data = MagicMock(return_value=self._results())
         self._client.validate_product_data = MagicMock(return_value=self._results())
+        self._client.validate_product_data_repeated = MagicMock(
+            side_effect=lambda products, image, count, first=None, enough=None: [
+                self._results() for _ in range(count)
+            ]
+        )
         self._client.categorize_products = MagicMock(
             side_effect=self._categorization_results
         )
         self._client.classify_products_is_grill = MagicMock(
             side_effect=self._categorization_grill_results
         )
+        self._client.categorize_products_fused = MagicMock(
+            side_effect=self._fused_categorization_results
+        )
         self._num_items_seen = 0
 
     def _results(self) -> Results:
@@ -61,7 +79,7 @@ class MockLLM:
         return CategorizationResponseFormat(results=results)
 
     def _categorization_grill_results(
-        self, products: List[str], system_prompt: str
+        self, products: List[str], _system_prompt: str
     ) -> ClassificationIsGrillResponseFormat:
         results = []
         for _ in products:
@@ -75,6 +93,108 @@ class MockLLM:
             self._num_items_seen += 1
         return ClassificationIsGrillResponseFormat(results=results)
 
+    def _fused_categorization_results(
+        self, products: List[str]
+    ) -> FusedCategorizationResponseFormat:
+        results = []
+        for _ in products:
+            results.append(
+                FusedCategorizationResult(
+                    fleischsorte=list(ProductCategory)[
+                        self._num_items_seen % len(ProductCategory)
+                    ],
+                    certainty_fleischsorte=(self._num_items_seen % len(ProductCategory))
+                    * 10,
+                    is_grill=self._num_items_seen % 2,
+                    certainty_is_grill=(self._num_items_seen % len(ProductCategory))
+                    * 10,
+                )
+            )
+            self._num_items_seen += 1
+        return FusedCategorizationResponseFormat(results=results)
+
+    def respond(self, body: dict):
+        """Answers the JSON body of a chat completion with the mocked result of its response format."""
+        response_format = body["response_format"]["json_schema"]["name"]
+        user_prompt = body["messages"][-1]["content"]
+        if response_format == CategorizationResponseFormat.__name__:
+            return self.categorize_products(
+                user_prompt[len(CATEGORIZATION_USER_PROMPT) :].split("\n")
+            )
+        if response_format == FusedCategorizationResponseFormat.__name__:
+            return self.categorize_products_fused(
+                user_prompt[len(FUSED_CATEGORIZATION_USER_PROMPT) :].split("\n")
+            )
+        if response_format == ClassificationIsGrillResponseFormat.__name__:
+            return self.classify_products_is_grill(
+                user_prompt[len(CLASSIFICATION_IS_GRILL_USER_PROMPT) :].split("\n"),
+                body["messages"][0]["content"],
+            )
+        return self.extract(None)
+
     def __getattr__(self, name):
         # Delegate attribute access to the MagicMock
         return getattr(self._client, name)
+
+
+# Its endpoints are the files and batches attributes, like on the OpenAI client
+class MockBatchEndpoints:  # pylint: disable=too-few-public-methods
+    """
+    Local stand-in for the files and batches endpoints of the OpenAI client.
+    Batches finish on the first status check and answer with the results of MockLLM.
+    """
+
+    def __init__(self):
+        self.files = SimpleNamespace(
+            create=self._create_file, content=self._get_file_content
+        )
+        self.batches = SimpleNamespace(
+            create=self._create_batch, retrieve=self._retrieve_batch
+        )
+        self._files: dict[str, bytes] = {}
+        self._batches: dict[str, SimpleNamespace] = {}
+        self._llm = MockLLM()
+
+    def _create_file(self, file, purpose: str) -> SimpleNamespace:
+        file_id = f"file-{len(self._files)}"
+        self._files[file_id] = file.read()
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _get_file_content(self, file_id: str) -> SimpleNamespace:
+        return SimpleNamespace(text=self._files[file_id].decode("utf-8"))
+
+    def _create_batch(self, input_file_id: str, **_options) -> SimpleNamespace:
+        # The endpoint and completion window do not matter, the batch finishes on the first check
+        batch = SimpleNamespace(
+            id=f"batch-{len(self._batches)}",
+            status="in_progress",
+            input_file_id=input_file_id,
+            output_file_id=None,
+        )
+        self._batches[batch.id] = batch
+        return batch
+
+    def _retrieve_batch(self, batch_id: str) -> SimpleNamespace:
+        batch = self._batches[batch_id]
+        if batch.status == "in_progress":
+            output_lines = []
+            for line in self._files[batch.input_file_id].decode("utf-8").splitlines():
+                request = json.loads(line)
+                content = self._llm.respond(request["body"]).model_dump_json()
+                output_lines.append(
+                    json.dumps(
+                        {
+                            "custom_id": request["custom_id"],
+                            "response": {
+                                "status_code": 200,
+                                "body": {
+                                    "choices": [{"message": {"content": content}}]
+                                },
+                            },
+                        }
+                    )
+                )
+            batch.output_file_id = f"file-{len(self._files)}"
+            self._files[batch.output_file_id] = "\n".join(output_lines).encode("utf-8")
+            batch.status = "completed"
+        return batch
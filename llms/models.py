@@ -77,6 +77,7 @@ class CategorizationResult(BaseModel):
         float  # Certainty percentage for Fleischsorte classification (0-100)
     )
 
+
 class ClassificationIsGrillResult(BaseModel):
     is_grill: bool  # Whether the product is considered a grill product
     certainty_is_grill: (
@@ -87,5 +88,18 @@ class ClassificationIsGrillResult(BaseModel):
 class CategorizationResponseFormat(BaseModel):
     results: List[CategorizationResult]  # List of categorization results (max 5)
 
+
 class ClassificationIsGrillResponseFormat(BaseModel):
-    results: List[ClassificationIsGrillResult]
\ No newline at end of file
+    results: List[ClassificationIsGrillResult]
+
+
+# Output of the fused mode: category and is_grill in one answer
+class FusedCategorizationResult(BaseModel):
+    fleischsorte: ProductCategory
+    certainty_fleischsorte: float  # Certainty percentage (0-100)
+    is_grill: bool
+    certainty_is_grill: float  # Certainty percentage (0-100)
+
+
+class FusedCategorizationResponseFormat(BaseModel):
+    results: List[FusedCategorizationResult]
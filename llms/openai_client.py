@@ -1,12 +1,28 @@
 import base64
+import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI, RateLimitError
+from openai import APITimeoutError, OpenAI, RateLimitError
+from openai.lib._parsing._completions import type_to_response_format_param
 
 from categorization.categorization_system_prompt import CATEGORIZATION_SYSTEM_PROMPT
 from categorization.categorization_user_prompt import (
     CATEGORIZATION_USER_PROMPT,
     CLASSIFICATION_IS_GRILL_USER_PROMPT,
+    FUSED_CATEGORIZATION_USER_PROMPT,
+)
+from categorization.fused_categorization_system_prompt import (
+    FUSED_CATEGORIZATION_SYSTEM_PROMPT,
+)
+from image_preprocessor import ImagePreprocessor
+from telemetry import Telemetry, submit_with_labels
+from settings import (
+    MAX_LLM_CONCURRENCY,
+    RATE_LIMIT_REQUESTS_PER_MINUTE,
+    RATE_LIMIT_TOKENS_PER_MINUTE,
 )
 from validation.validation_system_prompt import VALIDATION_SYSTEM_PROMPT
 from validation.validation_user_prompt import VALIDATION_USER_PROMPT
@@ -14,15 +30,18 @@ from .models import (
     Results,
     ClassificationIsGrillResponseFormat,
     CategorizationResponseFormat,
+    FusedCategorizationResponseFormat,
 )
+from .rate_limiter import AdaptiveRateLimiter, wait_for_rate_limit
+from .response_cache import ResponseCache
 from tenacity import (
+    RetryError,
     retry,
     stop_after_attempt,
-    wait_fixed,
     retry_if_exception_type,
     before_sleep_log,
 )
-from typing import List
+from typing import Callable, List, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,41 +49,329 @@ logger = logging.getLogger(__name__)
 IMAGE_MODEL = "gpt-4o"
 TEXT_MODEL = "gpt-4o-mini"
 NUM_RETRY_ATTEMPTS = 5
-RETRY_WAIT_IN_SECS = 60
+# Rough token estimates used to reserve quota before the usage of a response is known
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 1105
+LOW_DETAIL_IMAGE_TOKEN_ESTIMATE = 85
+COMPLETION_TOKEN_ESTIMATE = 1000
 OPENAI_PROMPT = "You are a helpful assistant that will help me extract information from leaflets of various Swiss grocery stores. For every product in the image I upload, extract the following content: the name of the product, the original price, the discounted price, the percentage discount (if available), discount details (if available)."
 
 
+def get_error_label(exception: Exception) -> str:
+    """Name of the exception, or of the last attempt's exception once tenacity gives up."""
+    if isinstance(exception, RetryError):
+        last_exception = exception.last_attempt.exception()
+        if last_exception is not None:
+            exception = last_exception
+    return type(exception).__name__
+
+
 class OpenAIClient:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        cache: ResponseCache | None = None,
+        telemetry: Telemetry | None = None,
+        client=None,
+        image_preprocessor: ImagePreprocessor | None = None,
+    ):
+        """
+        Parameters:
+            api_key (str): The OpenAI API key.
+            cache (ResponseCache | None): If given, responses are looked up there before calling the API.
+            telemetry (Telemetry | None): If given, latency, token usage and retries of every call are recorded.
+            client: Replaces the OpenAI client, e.g. with a simulated backend.
+            image_preprocessor (ImagePreprocessor | None): Resizes and encodes the images before the upload, defaults to high detail PNGs.
+        """
+        self.client = OpenAI(api_key=api_key) if client is None else client
+        self.image_preprocessor = image_preprocessor or ImagePreprocessor()
+        self.cache = cache
+        self.telemetry = telemetry
+        self._attempts = threading.local()
+        self._rate_limiters: dict[str, AdaptiveRateLimiter] = {}
+        self._rate_limiters_lock = threading.Lock()
+
+    def get_rate_limiter(self, model: str) -> AdaptiveRateLimiter:
+        """Every model has its own quota, so it gets its own limiter."""
+        with self._rate_limiters_lock:
+            if model not in self._rate_limiters:
+                self._rate_limiters[model] = AdaptiveRateLimiter(
+                    RATE_LIMIT_REQUESTS_PER_MINUTE,
+                    RATE_LIMIT_TOKENS_PER_MINUTE,
+                    MAX_LLM_CONCURRENCY,
+                )
+            return self._rate_limiters[model]
 
     def extract(self, image_data: bytes) -> Results:
         """
         Extracts product information from an image by encoding it and sending it to the OpenAI API.
         """
-        encoded_image = self._encode_image(image_data)
-        return self._get_data_from_image(encoded_image)
+        return self._request(self.build_extraction_request(image_data), "extract")
 
-    def _encode_image(self, image_data: bytes) -> str:
+    def validate_product_data(
+        self, products: Results, image: bytes, seed: int = 0
+    ) -> Results:
         """
-        Encodes an image into a base64 string for API transmission.
+        Validates the extracted products on the image. Validations with different seeds are
+        independent answers, also in the response cache.
+        """
+        return self._request(
+            self.build_validation_request(products, image, seed),
+            "validate_product_data",
+        )
+
+    def validate_product_data_repeated(
+        self,
+        products: Results,
+        image: bytes,
+        count: int,
+        first: int | None = None,
+        enough: Callable[[List[Results]], bool] | None = None,
+    ) -> List[Results | None]:
+        """
+        Runs count independent validations of the products concurrently, the image is only
+        encoded once for all of them.
+
+        Parameters:
+            first (int | None): If given with enough, only the first validations are sent at first.
+            enough (Callable[[List[Results | None]], bool] | None): Decides on the results of the first validations whether the others are still needed.
+
+        Returns:
+            List[Results | None]: The validations that were sent, in order, None for the ones the model refused.
+            Fewer than count if the first validations were enough.
+        """
+        requests = [
+            (request,)
+            for request in self.build_validation_requests(products, image, count)
+        ]
+        if first is None or enough is None or first >= count:
+            return self._run_concurrently(self._request_validation, requests)
+        results = self._run_concurrently(self._request_validation, requests[:first])
+        if enough(results):
+            return results
+        return results + self._run_concurrently(
+            self._request_validation, requests[first:]
+        )
+
+    def _request_validation(self, request: dict) -> Results:
+        return self._request(request, "validate_product_data")
+
+    def categorize_products(self, products: List[str]) -> CategorizationResponseFormat:
+        """
+        Sends prompt to OpenAI to get product categorization for products
+        :param products: product data
+        :return: product categorization data
+        """
+        return self._request(
+            self.build_categorization_request(products), "categorize_products"
+        )
+
+    def classify_products_is_grill(
+        self, products: List[str], system_prompt: str
+    ) -> ClassificationIsGrillResponseFormat:
+        """
+        Sends prompt to OpenAI to get product classification is_grill for products
+        :param products: product data
+        :param system_prompt: category specific system prompt
+        :return: product categorization data
+        """
+        return self._request(
+            self.build_classification_is_grill_request(products, system_prompt),
+            "classify_products_is_grill",
+        )
+
+    def categorize_products_fused(
+        self, products: List[str]
+    ) -> FusedCategorizationResponseFormat:
+        """
+        Categorizes the products and classifies whether they are grill products in one request.
+        """
+        return self._request(
+            self.build_fused_categorization_request(products),
+            "categorize_products_fused",
+        )
+
+    def categorize_products_many(
+        self, product_batches: List[List[str]]
+    ) -> List[CategorizationResponseFormat]:
+        """Runs categorize_products for every batch of products, concurrently."""
+        return self._run_concurrently(
+            self.categorize_products, [(products,) for products in product_batches]
+        )
+
+    def classify_products_is_grill_many(
+        self, product_batches: List[Tuple[List[str], str]]
+    ) -> List[ClassificationIsGrillResponseFormat]:
+        """Runs classify_products_is_grill for every (products, system prompt) pair, concurrently."""
+        return self._run_concurrently(self.classify_products_is_grill, product_batches)
+
+    def categorize_products_fused_many(
+        self, product_batches: List[List[str]]
+    ) -> List[FusedCategorizationResponseFormat]:
+        """Runs categorize_products_fused for every batch of products, concurrently."""
+        return self._run_concurrently(
+            self.categorize_products_fused,
+            [(products,) for products in product_batches],
+        )
+
+    @staticmethod
+    def _run_concurrently(function: Callable, arguments: List[tuple]) -> list:
+        """
+        Calls the function with each of the argument tuples and returns the results in the same
+        order. The rate limiters of the models decide how many requests are actually in flight.
+        """
+        if len(arguments) <= 1:
+            return [function(*args) for args in arguments]
+        with ThreadPoolExecutor(
+            max_workers=min(len(arguments), MAX_LLM_CONCURRENCY)
+        ) as executor:
+            futures = [
+                submit_with_labels(executor, function, *args) for args in arguments
+            ]
+            return [future.result() for future in futures]
+
+    def _request(self, request: dict, method: str):
+        """
+        Returns the cached response for the request, or sends it to OpenAI.
+        """
+        if self.cache is None:
+            return self._parse(request, method)
+        return self.cache.get_or_compute(
+            self.request_key(request),
+            request["response_format"],
+            lambda: self._parse(request, method),
+        )
+
+    def _parse(self, request: dict, method: str):
+        """
+        Sends the request to OpenAI and returns the parsed structured data.
         """
-        return base64.b64encode(image_data).decode("utf-8")
+        self._attempts.count = 0
+        start = time.perf_counter()
+        try:
+            response = self._send(request)
+        except Exception as e:
+            if self.telemetry is not None:
+                self.telemetry.record_call(
+                    method,
+                    request["model"],
+                    time.perf_counter() - start,
+                    None,
+                    retries=max(self._attempts.count - 1, 0),
+                    error=get_error_label(e),
+                )
+            raise
+        if self.telemetry is not None:
+            self.telemetry.record_call(
+                method,
+                request["model"],
+                time.perf_counter() - start,
+                response.usage,
+                retries=self._attempts.count - 1,
+            )
+
+        # Extract and parse the response
+        return response.choices[0].message.parsed
 
     @retry(
-        retry=retry_if_exception_type(RateLimitError),
+        retry=retry_if_exception_type((RateLimitError, APITimeoutError)),
         stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
+        wait=wait_for_rate_limit,
         before_sleep=before_sleep_log(logger, logging.INFO),
     )
-    def _get_data_from_image(self, base64_image: str) -> Results:
+    def _send(self, request: dict):
+        """
+        Sends the request within the rate limit of its model and returns the chat completion.
+        """
+        self._attempts.count += 1
+        rate_limiter = self.get_rate_limiter(request["model"])
+        with rate_limiter.acquire(self.estimate_tokens(request)) as reserved_tokens:
+            try:
+                raw_response = (
+                    self.client.beta.chat.completions.with_raw_response.parse(**request)
+                )
+            except RateLimitError as e:
+                rate_limiter.on_rate_limited(e.response.headers)
+                raise
+            response = raw_response.parse()
+            rate_limiter.on_success(
+                raw_response.headers,
+                reserved_tokens,
+                response.usage.total_tokens if response.usage else None,
+            )
+        return response
+
+    @staticmethod
+    def estimate_tokens(request: dict) -> int:
+        """Estimates prompt and completion tokens of a request, before sending it."""
+        tokens = COMPLETION_TOKEN_ESTIMATE
+        for message in request["messages"]:
+            content = message["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            for part in content:
+                if part["type"] == "text":
+                    tokens += len(part["text"]) // CHARS_PER_TOKEN
+                elif part["image_url"].get("detail") == "low":
+                    tokens += LOW_DETAIL_IMAGE_TOKEN_ESTIMATE
+                else:
+                    tokens += IMAGE_TOKEN_ESTIMATE
+        return tokens
+
+    @staticmethod
+    def request_body(request: dict) -> dict:
+        """
+        Converts a request into the JSON body of a chat completion, with the response
+        format as JSON schema.
+        """
+        return {
+            **request,
+            "response_format": type_to_response_format_param(
+                request["response_format"]
+            ),
+        }
+
+    @staticmethod
+    def request_key(request: dict) -> str:
+        """
+        Cache key of a request: covers the model, the prompts, the image, the seed and the response schema.
+        """
+        return ResponseCache.make_key(
+            json.dumps(OpenAIClient.request_body(request), sort_keys=True)
+        )
+
+    def _encode_image(self, image_data: bytes) -> str:
         """
-        Sends the base64-encoded image to OpenAI and receives extracted data.
-        Results: Parsed structured data containing product information.
+        Encodes an image into a base64 string for API transmission.
+        """
+        if self.telemetry is None:
+            return base64.b64encode(image_data).decode("utf-8")
+        with self.telemetry.stage("encode"):
+            return base64.b64encode(image_data).decode("utf-8")
+
+    def _preprocess_image(self, image_data: bytes) -> bytes:
+        if self.telemetry is None:
+            return self.image_preprocessor.prepare(image_data)
+        with self.telemetry.stage("preprocess"):
+            return self.image_preprocessor.prepare(image_data)
+
+    def build_image_content(self, image_data: bytes) -> dict:
+        """
+        Returns the message content part for an image, resized and encoded by the image preprocessor.
         """
-        response = self.client.beta.chat.completions.parse(
-            model=IMAGE_MODEL,
-            messages=[
+        encoded_image = self._encode_image(self._preprocess_image(image_data))
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{self.image_preprocessor.mime_type};base64,{encoded_image}",
+                "detail": self.image_preprocessor.detail,
+            },
+        }
+
+    def build_extraction_request(self, image_data: bytes) -> dict:
+        return {
+            "model": IMAGE_MODEL,
+            "messages": [
                 {
                     "role": "user",
                     "content": [
@@ -72,63 +379,79 @@ class OpenAIClient:
                             "type": "text",
                             "text": OPENAI_PROMPT,
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            },
-                        },
+                        self.build_image_content(image_data),
                     ],
                 }
             ],
-            response_format=Results,
-        )
+            "response_format": Results,
+        }
 
-        # Extract and parse the response
-        return response.choices[0].message.parsed
+    def build_validation_request(
+        self, products: Results, image: bytes, seed: int = 0
+    ) -> dict:
+        return {
+            "model": IMAGE_MODEL,
+            "messages": [
+                {"role": "system", "content": VALIDATION_SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": self.build_product_data_validation_prompt(products),
+                        },
+                        self.build_image_content(image),
+                    ],
+                },
+            ],
+            "response_format": Results,
+            "seed": seed,
+        }
 
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
-        before_sleep=before_sleep_log(logger, logging.INFO),
-    )
-    def categorize_products(self, products: List[str]) -> CategorizationResponseFormat:
+    def build_validation_requests(
+        self, products: Results, image: bytes, count: int
+    ) -> List[dict]:
         """
-        Sends prompt to OpenAI to get product categorization for products
-        :param products: product data
-        :return: product categorization data
+        Returns count validation requests that share one encoding of the image. Every request has
+        its own seed, so that the validations are independent answers and are cached separately.
         """
+        request = self.build_validation_request(products, image)
+        return [{**request, "seed": index} for index in range(count)]
 
-        response = self.client.beta.chat.completions.parse(
-            model=TEXT_MODEL,
-            messages=[
+    def build_categorization_request(self, products: List[str]) -> dict:
+        return {
+            "model": TEXT_MODEL,
+            "messages": [
                 {"role": "system", "content": CATEGORIZATION_SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": self.build_product_categorization_prompt(products),
                 },
             ],
-            response_format=CategorizationResponseFormat,
-            temperature=0.5,
-        )
+            "response_format": CategorizationResponseFormat,
+            "temperature": 0.5,
+        }
 
-        # Extract and parse the response
-        return response.choices[0].message.parsed
+    def build_fused_categorization_request(self, products: List[str]) -> dict:
+        return {
+            "model": TEXT_MODEL,
+            "messages": [
+                {"role": "system", "content": FUSED_CATEGORIZATION_SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": self.build_product_fused_categorization_prompt(products),
+                },
+            ],
+            "response_format": FusedCategorizationResponseFormat,
+            "temperature": 0.5,
+        }
 
-    def classify_products_is_grill(
+    def build_classification_is_grill_request(
         self, products: List[str], system_prompt: str
-    ) -> ClassificationIsGrillResponseFormat:
-        """
-        Sends prompt to OpenAI to get product classification is_grill for products
-        :param products: product data
-        :param system_prompt: category specific system prompt
-        :return: product categorization data
-        """
-
-        response = self.client.beta.chat.completions.parse(
-            model=TEXT_MODEL,
-            messages=[
+    ) -> dict:
+        return {
+            "model": TEXT_MODEL,
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {
                     "role": "user",
@@ -137,17 +460,18 @@ class OpenAIClient:
                     ),
                 },
             ],
-            response_format=ClassificationIsGrillResponseFormat,
-            temperature=0.5,
-        )
-
-        # Extract and parse the response
-        return response.choices[0].message.parsed
+            "response_format": ClassificationIsGrillResponseFormat,
+            "temperature": 0.5,
+        }
 
     @staticmethod
     def build_product_categorization_prompt(products: List[str]) -> str:
         return CATEGORIZATION_USER_PROMPT + "\n".join(products)
 
+    @staticmethod
+    def build_product_fused_categorization_prompt(products: List[str]) -> str:
+        return FUSED_CATEGORIZATION_USER_PROMPT + "\n".join(products)
+
     @staticmethod
     def build_product_classification_is_grill_prompt(products: List[str]) -> str:
         return CLASSIFICATION_IS_GRILL_USER_PROMPT + "\n".join(products)
@@ -155,37 +479,3 @@ class OpenAIClient:
     @staticmethod
     def build_product_data_validation_prompt(products: Results) -> str:
         return VALIDATION_USER_PROMPT + "\n" + products.__str__()
-
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
-        before_sleep=before_sleep_log(logger, logging.INFO),
-    )
-    def validate_product_data(self, products: Results, image: bytes) -> Results:
-        encoded_image = self._encode_image(image)
-        response = self.client.beta.chat.completions.parse(
-            model=IMAGE_MODEL,
-            messages=[
-                {"role": "system", "content": VALIDATION_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": self.build_product_data_validation_prompt(products),
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{encoded_image}"
-                            },
-                        },
-                    ],
-                },
-            ],
-            response_format=Results,
-        )
-
-        # Extract and parse the response
-        return response.choices[0].message.parsed
@@ -0,0 +1,184 @@
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Mapping
+
+from tenacity import RetryCallState, wait_random_exponential
+
+SECONDS_PER_MINUTE = 60
+# Fallback when a 429 has no retry-after header
+_exponential_backoff = wait_random_exponential(multiplier=2, max=60)
+
+
+def parse_duration(value: str | None) -> float | None:
+    """
+    Parses the durations used in the OpenAI rate limit headers ("20ms", "1.5s", "6m0s")
+    or a plain number of seconds.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    factors = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * factors[unit] for number, unit in parts)
+
+
+def get_retry_after(headers: Mapping[str, str] | None) -> float | None:
+    """Returns the number of seconds the server asks us to wait, if any."""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        return float(retry_after_ms) / 1000
+    return parse_duration(headers.get("retry-after"))
+
+
+def wait_for_rate_limit(retry_state: RetryCallState) -> float:
+    """
+    Tenacity wait strategy: waits as long as the retry-after header asks for (plus a bit of jitter),
+    otherwise falls back to jittered exponential backoff.
+    """
+    exception = retry_state.outcome.exception() if retry_state.outcome else None
+    response = getattr(exception, "response", None)
+    retry_after = get_retry_after(getattr(response, "headers", None))
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    return _exponential_backoff(retry_state)
+
+
+class AdaptiveRateLimiter:
+    """
+    Client-side rate limiter for one model, shared by all threads that call it.
+
+    Requests and tokens per minute are tracked with token buckets that are corrected with the
+    x-ratelimit-* headers of every response. The number of concurrent requests adapts with
+    AIMD: it grows by one per window of successful requests and is halved on every 429.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_concurrency: int,
+        initial_concurrency: int = 2,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(min(initial_concurrency, max_concurrency))
+        self.rate_limited_count = 0
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._available_requests = requests_per_minute
+        self._available_tokens = tokens_per_minute
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+
+    @contextmanager
+    def acquire(self, estimated_tokens: int) -> Iterator[float]:
+        """
+        Blocks until the request fits into the concurrency limit and the remaining quota.
+        Yields the number of tokens that were reserved, to be passed to on_success.
+        """
+        with self._condition:
+            while True:
+                self._refill()
+                wait_time = self._blocked_until - time.monotonic()
+                if wait_time <= 0:
+                    wait_time = self._time_until_available(estimated_tokens)
+                if wait_time <= 0 and self._in_flight < int(self.concurrency_limit):
+                    break
+                # Woken up early when a request finishes
+                self._condition.wait(timeout=max(wait_time, 0.05))
+            self._available_requests -= 1
+            # A request larger than the whole budget reserves the budget, not more
+            reserved_tokens = min(estimated_tokens, self.tokens_per_minute)
+            self._available_tokens -= reserved_tokens
+            self._in_flight += 1
+        try:
+            yield reserved_tokens
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(
+        self,
+        headers: Mapping[str, str],
+        reserved_tokens: float,
+        used_tokens: int | None,
+    ) -> None:
+        """Additive increase, and synchronizes the quota with the rate limit headers."""
+        with self._condition:
+            self.concurrency_limit = min(
+                self.max_concurrency,
+                self.concurrency_limit + 1 / self.concurrency_limit,
+            )
+            if used_tokens is not None:
+                # Give back what acquire reserved too much (or take what it missed)
+                self._available_tokens += reserved_tokens - used_tokens
+            self._apply_headers(headers)
+            self._condition.notify_all()
+
+    def on_rate_limited(self, headers: Mapping[str, str] | None) -> None:
+        """Multiplicative decrease, and pauses all requests for the retry-after time."""
+        with self._condition:
+            self.rate_limited_count += 1
+            self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            retry_after = get_retry_after(headers)
+            if retry_after is not None:
+                self._blocked_until = max(
+                    self._blocked_until, time.monotonic() + retry_after
+                )
+            if headers is not None:
+                self._apply_headers(headers)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_refill) / SECONDS_PER_MINUTE
+        self._last_refill = now
+        self._available_requests = min(
+            self.requests_per_minute,
+            self._available_requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute,
+            self._available_tokens + elapsed_minutes * self.tokens_per_minute,
+        )
+
+    def _time_until_available(self, estimated_tokens: int) -> float:
+        missing_requests = 1 - self._available_requests
+        missing_tokens = min(estimated_tokens, self.tokens_per_minute) - (
+            self._available_tokens
+        )
+        return max(
+            missing_requests / self.requests_per_minute * SECONDS_PER_MINUTE,
+            missing_tokens / self.tokens_per_minute * SECONDS_PER_MINUTE,
+            0,
+        )
+
+    def _apply_headers(self, headers: Mapping[str, str]) -> None:
+        """The server knows our real quota, our own estimate can only be more optimistic."""
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if limit_requests is not None:
+            self.requests_per_minute = float(limit_requests)
+        if limit_tokens is not None:
+            self.tokens_per_minute = float(limit_tokens)
+        if remaining_requests is not None:
+            self._available_requests = min(
+                self._available_requests, float(remaining_requests)
+            )
+        if remaining_tokens is not None:
+            self._available_tokens = min(
+                self._available_tokens, float(remaining_tokens)
+            )
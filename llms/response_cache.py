@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from typing import Callable, Type, TypeVar
+
+from pydantic import BaseModel
+
+from sqlite_store import SQLiteStore
+
+ResponseT = TypeVar("ResponseT", bound=BaseModel)
+
+
+class ResponseCache(SQLiteStore):
+    """
+    Persistent cache for parsed LLM responses, stored in SQLite.
+
+    The key is a hash of everything that determines the response (model, prompts, image bytes
+    and response schema), so a changed prompt or image never returns a stale answer.
+    Identical requests that run at the same time only call the API once.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int):
+        """
+        Parameters:
+            path (str): The SQLite file with the responses as JSON, by request hash, and when they were last used.
+            max_size_bytes (int): Least recently used responses are evicted above this size.
+        """
+        super().__init__(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)",
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)",
+            ],
+        )
+        self.max_size_bytes = max_size_bytes
+        self._in_flight: dict[str, threading.Event] = {}
+
+    @staticmethod
+    def make_key(*parts: str | bytes) -> str:
+        """Hashes all parts of a request into a cache key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+            # The length prefix keeps ("ab", "c") and ("a", "bc") apart
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get_or_compute(
+        self,
+        key: str,
+        response_format: Type[ResponseT],
+        compute: Callable[[], ResponseT],
+    ) -> ResponseT:
+        """
+        Returns the cached response for key, or calls compute and caches its result.
+        If another thread is already computing the same key, waits for its result instead.
+        """
+        while True:
+            with self._lock:
+                value = self._get(key)
+                if value is not None:
+                    self.hits += 1
+                    return response_format.model_validate_json(value)
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    break
+            # Another thread computes this key, if it fails we try again ourselves
+            event.wait()
+
+        try:
+            response = compute()
+            with self._lock:
+                self.misses += 1
+                if response is not None:
+                    self._put(key, response.model_dump_json())
+            return response
+        finally:
+            with self._lock:
+                self._in_flight.pop(key).set()
+
+    def get(self, key: str, response_format: Type[ResponseT]) -> ResponseT | None:
+        """Returns the cached response for key, or None (counted as a miss)."""
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return response_format.model_validate_json(value)
+
+    def put(self, key: str, response: BaseModel) -> None:
+        with self._lock:
+            self._put(key, response.model_dump_json())
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._total_size()
+
+    def __str__(self) -> str:
+        return f"LLM cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate)"
+
+    def _get(self, key: str) -> str | None:
+        row = self._connection.execute(
+            "SELECT value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._connection.commit()
+        return row[0]
+
+    def _put(self, key: str, value: str) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, len(value.encode("utf-8")), time.time()),
+        )
+        self._evict()
+        self._connection.commit()
+
+    def _total_size(self) -> int:
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def _evict(self) -> None:
+        """Deletes the least recently used responses until the cache fits into max_size_bytes."""
+        excess = self._total_size() - self.max_size_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        keys = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if freed >= excess:
+                break
+            keys.append((key,))
+            freed += size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", keys)
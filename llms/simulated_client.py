@@ -0,0 +1,142 @@
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import httpx
+from openai import APITimeoutError, RateLimitError
+from openai.types import CompletionUsage
+
+from .mock_client import MockLLM
+from .openai_client import (
+    CHARS_PER_TOKEN,
+    COMPLETION_TOKEN_ESTIMATE,
+    IMAGE_MODEL,
+    TEXT_MODEL,
+    OpenAIClient,
+)
+
+SIMULATED_URL = "https://api.openai.com/v1/chat/completions"
+
+
+@dataclass
+class LatencyProfile:
+    """Latency of one model: log-normal around the median, sigma controls the tail."""
+
+    median_secs: float
+    sigma: float
+
+
+# Roughly what we see for a leaflet page (gpt-4o) and a batch of product names (gpt-4o-mini)
+DEFAULT_LATENCY_PROFILES = {
+    IMAGE_MODEL: LatencyProfile(median_secs=8.0, sigma=0.4),
+    TEXT_MODEL: LatencyProfile(median_secs=2.0, sigma=0.3),
+}
+
+
+class SimulatedOpenAI:
+    """
+    Stand-in for the OpenAI client that answers chat completions with the results of MockLLM,
+    but takes as long as the real API and fails the same way.
+
+    Every call sleeps for a latency drawn from the profile of its model, reports token usage and
+    can fail with a 429 (with a retry-after-ms header) or a timeout. The draws are seeded by the
+    request and its attempt number, so a run is reproducible regardless of thread scheduling.
+    """
+
+    def __init__(
+        self,
+        latency_profiles: dict[str, LatencyProfile] | None = None,
+        rate_limit_probability: float = 0.0,
+        timeout_probability: float = 0.0,
+        retry_after_secs: float = 2.0,
+        timeout_secs: float = 60.0,
+        time_scale: float = 1.0,
+        seed: int = 0,
+    ):
+        """
+        Parameters:
+            latency_profiles (dict[str, LatencyProfile] | None): Latency per model, defaults to DEFAULT_LATENCY_PROFILES.
+            rate_limit_probability (float): Probability that a call is answered with a 429.
+            timeout_probability (float): Probability that a call times out after timeout_secs.
+            retry_after_secs (float): Wait time that is sent with a 429.
+            timeout_secs (float): How long a call hangs before it times out.
+            time_scale (float): Multiplies all latencies and wait times, e.g. 0.1 for a quick benchmark.
+            seed (int): Seed of the random draws.
+        """
+        self.latency_profiles = latency_profiles or DEFAULT_LATENCY_PROFILES
+        self.rate_limit_probability = rate_limit_probability
+        self.timeout_probability = timeout_probability
+        self.retry_after_secs = retry_after_secs
+        self.timeout_secs = timeout_secs
+        self.time_scale = time_scale
+        self.seed = seed
+        self.outcomes = Counter()
+        self.beta = SimpleNamespace(
+            chat=SimpleNamespace(
+                completions=SimpleNamespace(
+                    with_raw_response=SimpleNamespace(parse=self._parse)
+                )
+            )
+        )
+        self._llm = MockLLM()
+        self._attempts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _parse(self, **request) -> SimpleNamespace:
+        key = OpenAIClient.request_key(request)
+        with self._lock:
+            attempt = self._attempts[key]
+            self._attempts[key] += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        profile = self.latency_profiles[request["model"]]
+
+        outcome = rng.random()
+        if outcome < self.rate_limit_probability:
+            self._count("rate_limited")
+            raise RateLimitError(
+                "Simulated rate limit",
+                response=httpx.Response(
+                    429,
+                    headers={
+                        "retry-after-ms": str(
+                            int(self.retry_after_secs * self.time_scale * 1000)
+                        )
+                    },
+                    request=httpx.Request("POST", SIMULATED_URL),
+                ),
+                body=None,
+            )
+        if outcome < self.rate_limit_probability + self.timeout_probability:
+            time.sleep(self.timeout_secs * self.time_scale)
+            self._count("timeout")
+            raise APITimeoutError(request=httpx.Request("POST", SIMULATED_URL))
+
+        time.sleep(
+            rng.lognormvariate(math.log(profile.median_secs), profile.sigma)
+            * self.time_scale
+        )
+        with self._lock:
+            # MockLLM counts the products it has seen, which is not thread-safe
+            parsed = self._llm.respond(OpenAIClient.request_body(request))
+        prompt_tokens = (
+            OpenAIClient.estimate_tokens(request) - COMPLETION_TOKEN_ESTIMATE
+        )
+        completion_tokens = len(parsed.model_dump_json()) // CHARS_PER_TOKEN
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))],
+            usage=CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+        self._count("ok")
+        return SimpleNamespace(headers={}, parse=lambda: completion)
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.outcomes[outcome] += 1
@@ -1,25 +1,60 @@
 import os
-import time
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import pandas as pd
 import streamlit as st
 
+from categorization.category_store import CategoryStore
+from categorization.local_classifier import LocalClassifier
 from categorization.product_categorizer import ProductCategorizer
 from file_downloaders import NoopDownloader
+from image_preprocessor import IMAGE_DETAILS, IMAGE_FORMATS, ImagePreprocessor
 from leaflet_reader import LeafletReader
+from page_journal import PageJournal
+from page_reuse_index import PageReuseIndex
+from page_tiler import PageTiler
+from pipeline_stages import batch_process_all_directories, stream_all_directories
+from llms.batch_client import BatchOpenAIClient
 from llms.openai_client import OpenAIClient
-from llms.mock_client import MockLLM
+from llms.mock_client import MockBatchEndpoints, MockLLM
+from llms.models import Results
+from llms.response_cache import ResponseCache
 from result_saver import ResultSaver
-from settings import NUMBER_OF_CHATGPT_VALIDATIONS
+from results_database import RESULTS_DATABASE_FILE_NAME, ResultsDatabase
+from settings import (
+    BATCH_POLL_INTERVAL_SECS,
+    CACHE_DIR,
+    CATEGORY_STORE_PATH,
+    DUPLICATE_NAME_SIMILARITY,
+    IMAGE_DETAIL,
+    IMAGE_FORMAT,
+    IMAGE_QUALITY,
+    LLM_CACHE_MAX_BYTES,
+    LOCAL_CLASSIFIER_MIN_CERTAINTY,
+    LOCAL_CLASSIFIER_PATH,
+    MAX_CONCURRENCY,
+    MAX_TRUNCATION_SPLITS,
+    NUMBER_OF_CHATGPT_VALIDATIONS,
+    PAGE_HASH_SIZE,
+    PAGE_REUSE_BLOCK_SIZE,
+    PAGE_REUSE_MAX_BLOCK_DIFFERENCE,
+    PAGE_REUSE_MAX_DISTANCE,
+    PAGE_REUSE_THUMBNAIL_SIZE,
+    RENDER_WORKERS,
+    TILE_COLUMNS,
+    TILE_OVERLAP,
+    TILE_ROWS,
+)
 import utils
 from utils import log_message
-from validation.validation_comparison import compare_validation
-import uuid
-
-
-SLEEP_TIME = 0  # TODO: test that we're not being rate limited using their API key
+from telemetry import Telemetry
+from validation.validation_comparison import (
+    compare_validation,
+    is_plausible,
+    validations_agree,
+)
 
 
 class Pipeline:
@@ -29,26 +64,137 @@ class Pipeline:
         leaflet_reader: LeafletReader,
         pdf_dir: str = "pdf-files",
         display_mode: bool = False,
+        llm_backend=None,
     ) -> None:
+        """
+        Parameters:
+            llm_backend: Replaces the OpenAI client that sends the requests, e.g. with llms.simulated_client.SimulatedOpenAI.
+        """
         self.args = args
         self.pdf_dir = pdf_dir
         self.display_mode = display_mode
         self.leaflet_reader = leaflet_reader
-        self.openai_client = (
-            MockLLM()
-            if self.args["use_test_client"]
-            else OpenAIClient(api_key=utils.get_api_key())
+        self.telemetry = Telemetry()
+        self.response_cache = (
+            None
+            if self.args.get("no_cache")
+            else ResponseCache(
+                os.path.join(CACHE_DIR, "llm_responses.sqlite"), LLM_CACHE_MAX_BYTES
+            )
+        )
+        self.image_preprocessor = ImagePreprocessor(
+            image_format=self.args.get("image_format", IMAGE_FORMAT),
+            quality=self.args.get("image_quality", IMAGE_QUALITY),
+            detail=self.args.get("image_detail", IMAGE_DETAIL),
         )
+        if self.args.get("batch_mode"):
+            self.openai_client = (
+                BatchOpenAIClient(
+                    api_key="fake-key",
+                    work_dir=os.path.join(CACHE_DIR, "batches"),
+                    poll_interval_secs=0,
+                    telemetry=self.telemetry,
+                    client=MockBatchEndpoints(),
+                    image_preprocessor=self.image_preprocessor,
+                )
+                if self.args["use_test_client"]
+                else BatchOpenAIClient(
+                    api_key=utils.get_api_key() if llm_backend is None else "fake-key",
+                    work_dir=os.path.join(CACHE_DIR, "batches"),
+                    poll_interval_secs=BATCH_POLL_INTERVAL_SECS,
+                    cache=self.response_cache,
+                    telemetry=self.telemetry,
+                    client=llm_backend,
+                    image_preprocessor=self.image_preprocessor,
+                )
+            )
+        else:
+            self.openai_client = (
+                MockLLM()
+                if self.args["use_test_client"]
+                else OpenAIClient(
+                    api_key=utils.get_api_key() if llm_backend is None else "fake-key",
+                    cache=self.response_cache,
+                    telemetry=self.telemetry,
+                    client=llm_backend,
+                    image_preprocessor=self.image_preprocessor,
+                )
+            )
         self.result_saver = ResultSaver(
-            overwrite_results=self.args["overwrite_results"]
+            overwrite_results=self.args["overwrite_results"],
+            excel_export=not self.args.get("no_excel", False),
+        )
+        # Categories of the test client must not end up in the store of real runs
+        self.category_store = (
+            None
+            if self.args.get("no_category_store") or self.args["use_test_client"]
+            else CategoryStore(
+                CATEGORY_STORE_PATH,
+                ProductCategorizer.get_prompt_version(
+                    self.args.get("fused_categorization", False)
+                ),
+            )
         )
-        self.categorizer = ProductCategorizer()
+        self.local_classifier = None
+        if self.args.get("local_classifier"):
+            if os.path.exists(LOCAL_CLASSIFIER_PATH):
+                self.local_classifier = LocalClassifier.load(LOCAL_CLASSIFIER_PATH)
+            else:
+                log_message(
+                    f"No local classifier at {LOCAL_CLASSIFIER_PATH}, train it with: python -m categorization.local_classifier",
+                    self.display_mode,
+                )
+        self.categorizer = ProductCategorizer(
+            self.category_store,
+            self.args.get("fused_categorization", False),
+            self.local_classifier,
+            self.args.get("local_min_certainty", LOCAL_CLASSIFIER_MIN_CERTAINTY),
+        )
+        self.max_concurrency = max(1, self.args.get("max_concurrency", MAX_CONCURRENCY))
+        if self.args.get("in_memory") and not self.args.get("streaming"):
+            log_message(
+                "Rendering in memory is only supported in streaming mode, pages are written to disk.",
+                display_mode=False,
+            )
+        self.page_index = (
+            PageReuseIndex(
+                os.path.join(CACHE_DIR, "page_reuse_index.sqlite"),
+                self.args.get("page_reuse_max_distance", PAGE_REUSE_MAX_DISTANCE),
+                PAGE_HASH_SIZE,
+                PAGE_REUSE_THUMBNAIL_SIZE,
+                PAGE_REUSE_BLOCK_SIZE,
+                PAGE_REUSE_MAX_BLOCK_DIFFERENCE,
+            )
+            if self.args.get("reuse_pages")
+            else None
+        )
+        self.adaptive_validation = self.args.get("adaptive_validation", False)
+        if self.adaptive_validation and self.args.get("batch_mode"):
+            log_message(
+                "Adaptive validation is not supported in batch mode, all validations are sent.",
+                display_mode=False,
+            )
+        self.page_tiler = None
+        if self.args.get("tiling"):
+            if self.args.get("batch_mode"):
+                log_message(
+                    "Tiling is not supported in batch mode, pages are extracted whole.",
+                    display_mode=False,
+                )
+            else:
+                self.page_tiler = PageTiler(
+                    TILE_ROWS,
+                    TILE_COLUMNS,
+                    TILE_OVERLAP,
+                    MAX_TRUNCATION_SPLITS,
+                    DUPLICATE_NAME_SIMILARITY,
+                )
 
     def append_metadata(self, df: pd.DataFrame):
         df["date_collected"] = datetime.now().strftime("%Y-%m-%d")
         df["calendar_week"] = datetime.now().isocalendar().week
 
-    def process_pdfs(self):
+    def combined_results_should_be_kept(self) -> bool:
         if self.result_saver.results_exist_and_should_be_kept(self.pdf_dir):
             log_message(
                 f"Already found a results file: [{os.path.join(self.pdf_dir, self.result_saver.output_file_name)}], nothing to do.",
@@ -58,8 +204,20 @@ class Pipeline:
                 "If you'd like new results, delete or rename the results file and rerun the script.",
                 display_mode=False,
             )
+            return True
+        return False
+
+    def process_pdfs(self):
+        if self.combined_results_should_be_kept():
             return False
 
+        with self.telemetry.stage("render"):
+            self.leaflet_reader.convert_pdfs_to_images(self.get_pdf_jobs())
+        return True
+
+    def get_pdf_jobs(self) -> list[tuple[str, str]]:
+        """Returns (PDF path, output directory) for every PDF that has no results yet."""
+        pdf_jobs = []
         for filename in os.listdir(self.pdf_dir):
             if filename.endswith(".pdf"):
                 pdf_path = os.path.join(self.pdf_dir, filename)
@@ -72,30 +230,67 @@ class Pipeline:
                     )
                     continue
                 log_message(f"Processing {pdf_path}.", display_mode=False)
-                self.leaflet_reader.convert_pdf_to_images(pdf_path, output_dir)
-        return True
-
-    def process_all_directories(self):
-        all_directories = [
-            entry.path for entry in os.scandir(self.pdf_dir) if entry.is_dir()
+                pdf_jobs.append((pdf_path, output_dir))
+        return pdf_jobs
+
+    def get_image_directories(self) -> list[tuple[str, str]]:
+        """Returns (directory, output directory) for every directory with images to process."""
+        image_directories = [
+            (entry.path, entry.path)
+            for entry in os.scandir(self.pdf_dir)
+            if entry.is_dir()
         ]
-        for directory in all_directories:
-            self.process_directory(
-                directory,
-                directory,
-            )
-        # For any images that were added individually
+        # For any images that were added individually. The same directory on every run, so
+        # that its page journal lets an interrupted run resume
         if len(utils.get_all_image_paths(self.pdf_dir)) > 0:
-            self.process_directory(
-                self.pdf_dir, os.path.join(self.pdf_dir, f"images_{uuid.uuid4()}")
+            pdf_dir_name = os.path.basename(os.path.normpath(self.pdf_dir))
+            image_directories.append(
+                (self.pdf_dir, os.path.join(self.pdf_dir, f"images_{pdf_dir_name}"))
             )
+        return image_directories
+
+    def process_all_directories(self):
+        for directory, output_dir in self.get_image_directories():
+            self.process_directory(directory, output_dir)
 
     def main(self) -> pd.DataFrame | None:
         self.leaflet_reader.download_leaflets(self.pdf_dir)
-        if self.process_pdfs():
-            self.process_all_directories()
-            return self.result_saver.save_results(self.pdf_dir)
-        return None
+        # Only opened after the download, which can replace everything in pdf_dir, the database included
+        self.result_saver.database = ResultsDatabase(
+            os.path.join(self.pdf_dir, RESULTS_DATABASE_FILE_NAME)
+        )
+        self.result_saver.start_run(self.pdf_dir, self.args)
+        if self.args.get("streaming"):
+            if self.combined_results_should_be_kept():
+                return None
+            stream_all_directories(self)
+        elif self.process_pdfs():
+            if self.args.get("batch_mode"):
+                batch_process_all_directories(self)
+            else:
+                self.process_all_directories()
+        else:
+            return None
+        if self.response_cache is not None:
+            log_message(str(self.response_cache), display_mode=False)
+        if self.category_store is not None:
+            log_message(str(self.category_store), display_mode=False)
+        if self.local_classifier is not None:
+            log_message(str(self.local_classifier), display_mode=False)
+        if self.page_index is not None:
+            log_message(str(self.page_index), display_mode=False)
+            log_message(
+                f"Page reuse report saved at: {self.page_index.write_report(self.pdf_dir)}",
+                display_mode=False,
+            )
+        with self.telemetry.stage("save"):
+            results = self.result_saver.save_results(self.pdf_dir)
+        json_path, prometheus_path = self.telemetry.write_reports(self.pdf_dir)
+        log_message(
+            f"Telemetry saved at: {json_path} and {prometheus_path}",
+            display_mode=False,
+        )
+        return results
 
     def process_directory(self, directory: str, output_dir: str):
         """Processes a directory by extracting product data, validating it, and optionally categorizing products."""
@@ -104,91 +299,251 @@ class Pipeline:
             log_message(
                 f"Results already exist for {directory}, skipping...", self.display_mode
             )
-            return True, pd.read_csv(os.path.join(directory, "results.csv"))
+            return True, self.result_saver.load(directory)
 
         log_message(f"Processing {directory} ...", self.display_mode)
 
         image_paths = utils.get_all_image_paths(directory)
+        journal = PageJournal(output_dir)
+        if len(journal) > 0:
+            log_message(
+                f"Resuming {directory}, {len(journal)} pages are already in the journal.",
+                self.display_mode,
+            )
+        extracted_df = self.save_extracted_results(
+            directory, output_dir, self.process_images(image_paths, journal)
+        )
+        journal.remove()
+        return self.categorize_results(directory, extracted_df, output_dir)
+
+    def save_extracted_results(
+        self, directory: str, output_dir: str, page_results: list[tuple[list, list]]
+    ) -> pd.DataFrame:
+        """Combines the results of process_image (in page order) into a DataFrame, compares the validations and saves it."""
         all_products = []
         all_validation_results = [[] for _ in range(NUMBER_OF_CHATGPT_VALIDATIONS)]
 
-        if self.display_mode:
-            progress_bar = st.progress(0)
-
-        # Process images and extract data
-        for index, image_path in enumerate(image_paths):
-            extracted_products, validation_results = self.process_image(image_path)
+        for extracted_products, validation_results in page_results:
             all_products.extend(extracted_products)
 
             for i in range(NUMBER_OF_CHATGPT_VALIDATIONS):
                 all_validation_results[i].extend(validation_results[i])
 
-            if self.display_mode:
-                progress_bar.progress((index + 1) / len(image_paths))
-
         extracted_df = self.create_results_dataframe(
             all_products, all_validation_results
         )
 
         if NUMBER_OF_CHATGPT_VALIDATIONS > 0:
-            compare_validation(extracted_df)
+            compare_validation(extracted_df, NUMBER_OF_CHATGPT_VALIDATIONS)
 
-        output_path = self.result_saver.save(extracted_df, output_dir)
+        with self.telemetry.stage("save"):
+            output_path = self.result_saver.save(extracted_df, output_dir)
         log_message(
             f"Results from {directory} saved at: {output_path}", self.display_mode
         )
+        return extracted_df
 
-        return self.categorize_results(directory, extracted_df, output_dir)
+    def process_images(
+        self, image_paths: list[str], journal: PageJournal
+    ) -> list[tuple[list, list]]:
+        """
+        Runs process_image for all images that are not in the journal yet, with at most
+        max_concurrency requests in flight.
 
-    def process_image(self, image_path):
-        """Processes a single image, extracts product data, and validates it."""
+        Returns:
+            list[tuple[list, list]]: The results of process_image, in the order of image_paths.
+        """
+        if self.display_mode:
+            progress_bar = st.progress(0)
+
+        if self.max_concurrency == 1:
+            results = []
+            for index, image_path in enumerate(image_paths):
+                results.append(self.process_journaled_image(image_path, journal))
+                if self.display_mode:
+                    progress_bar.progress((index + 1) / len(image_paths))
+            return results
+
+        results = [None] * len(image_paths)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self.process_journaled_image, image_path, journal
+                ): index
+                for index, image_path in enumerate(image_paths)
+            }
+            # Streamlit can only be updated from this thread, not from the workers
+            for completed, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if self.display_mode:
+                    progress_bar.progress((completed + 1) / len(image_paths))
+        return results
+
+    def process_journaled_image(
+        self, image_path: str, journal: PageJournal, image_data: bytes | None = None
+    ) -> tuple[list, list]:
+        """Returns the journaled results of the image, or processes it and adds it to the journal."""
+        if image_data is None:
+            image_data = utils.read_image(image_path)
+        page_result = journal.get(image_path, image_data)
+        if page_result is None:
+            page_result = self.process_image(image_path, image_data)
+            journal.append(image_path, page_result, image_data)
+        return page_result
+
+    def process_image(self, image_path, image_data: bytes | None = None):
+        """
+        Processes a single image, extracts product data, and validates it.
+        The image is read from image_path, unless it is already given as image_data.
+        """
 
         log_message(f"Extracting data from {image_path}", display_mode=False)
 
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
-            response = self.openai_client.extract(image_data)
-            time.sleep(SLEEP_TIME)
+        if image_data is None:
+            image_data = utils.read_image(image_path)
+        with self.telemetry.labels(
+            leaflet=os.path.basename(os.path.dirname(image_path)),
+            page=os.path.basename(image_path),
+        ):
+            page_hash, reused = self.find_reused_page(image_path, image_data)
+            if reused is not None:
+                response, reused_from = reused
+            else:
+                reused_from = None
+                with self.telemetry.stage("extract"):
+                    response = (
+                        self.openai_client.extract(image_data)
+                        if self.page_tiler is None
+                        else self.page_tiler.extract(self.openai_client, image_data)
+                    )
+                self.index_page(image_path, page_hash, response)
 
-            validation_results = [
-                self.validate_product_data(response, image_data, i)
-                for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)
-            ]
+            validation_results, validations_sent = self.validate_page(
+                response, image_data
+            )
 
         extracted_products = [
-            self.enrich_product_data(product, image_path)
+            self.enrich_product_data(product, image_path, reused_from, validations_sent)
             for product in response.all_products
         ]
 
         return extracted_products, validation_results
 
-    def validate_product_data(self, response, image_data, validation_index):
-        """Runs a single validation cycle for extracted product data."""
+    def validate_page(
+        self, response: Results, image_data: bytes
+    ) -> tuple[list[list[dict]], int]:
+        """
+        Runs all validations of the extracted products of a page concurrently.
+
+        With adaptive validation, a page that passes the plausibility check is not validated, and
+        the other validations are only sent if the first ones, a majority, disagree with the
+        extraction. Validations that were not sent repeat the extracted products, so the
+        comparison keeps its columns, but they do not vote (see validations_sent).
+
+        Returns:
+            tuple[list[list[dict]], int]: The products of each validation, and how many validations were sent.
+        """
+        if NUMBER_OF_CHATGPT_VALIDATIONS == 0:
+            return [], 0
+        extracted_products = [product.model_dump() for product in response.all_products]
+        if self.adaptive_validation and is_plausible(response):
+            log_message("Skipping validation of a plausible page", display_mode=False)
+            return [extracted_products for _ in range(NUMBER_OF_CHATGPT_VALIDATIONS)], 0
 
-        log_message(f"Running validation: {validation_index + 1}", display_mode=False)
-
-        validation_response = self.openai_client.validate_product_data(
-            response, image_data
+        log_message(
+            f"Running {NUMBER_OF_CHATGPT_VALIDATIONS} validations", display_mode=False
         )
-        time.sleep(SLEEP_TIME)
+        with self.telemetry.stage("validate"):
+            validation_responses = self.openai_client.validate_product_data_repeated(
+                response,
+                image_data,
+                NUMBER_OF_CHATGPT_VALIDATIONS,
+                first=(
+                    NUMBER_OF_CHATGPT_VALIDATIONS // 2 + 1
+                    if self.adaptive_validation
+                    else None
+                ),
+                enough=lambda first_responses: validations_agree(
+                    extracted_products,
+                    [
+                        self.get_validated_products(validation_response)
+                        for validation_response in first_responses
+                    ],
+                ),
+            )
 
+        validation_results = [
+            self.get_validated_products(validation_response)
+            for validation_response in validation_responses
+        ]
+        return validation_results + [
+            extracted_products
+            for _ in range(NUMBER_OF_CHATGPT_VALIDATIONS - len(validation_results))
+        ], len(validation_results)
+
+    @staticmethod
+    def get_validated_products(validation_response: Results | None) -> list[dict]:
+        # A validation that the model refused counts as one without any products
+        if validation_response is None:
+            return []
         return [
             validation.model_dump()
             for validation in (validation_response.all_products or [])
         ]  # returns list of dictionaries with extracted data
 
-    def enrich_product_data(self, product, image_path):
+    def find_reused_page(self, image_path: str, image_data: bytes):
+        """
+        Looks the page up in the page reuse index, if enabled.
+
+        Returns:
+            tuple: The hash of the page (None if the index is disabled), and the products and name of
+            the known page it matches (None if there is none).
+        """
+        if self.page_index is None:
+            return None, None
+        page_hash = self.page_index.get_hash(image_data)
+        reused = self.page_index.find(get_page_name(image_path), page_hash)
+        if reused is not None:
+            log_message(
+                f"Reusing the products of {reused[1]} for {image_path}",
+                display_mode=False,
+            )
+        return page_hash, reused
+
+    def index_page(self, image_path: str, page_hash, response) -> None:
+        if self.page_index is not None:
+            self.page_index.add(get_page_name(image_path), page_hash, response)
+
+    def enrich_product_data(
+        self,
+        product,
+        image_path,
+        reused_from: str | None = None,
+        validations_sent: int = NUMBER_OF_CHATGPT_VALIDATIONS,
+    ):
         """Adds additional metadata to extracted product data."""
-        return {
+        enriched_product = {
             **product.model_dump(),
             "folder": os.path.basename(os.path.dirname(image_path)),
             "page_number": os.path.basename(image_path),
         }
+        if self.page_index is not None:
+            # The page that the products were copied from, None if they were extracted
+            enriched_product["reused_from"] = reused_from
+        if NUMBER_OF_CHATGPT_VALIDATIONS > 0:
+            # Fewer if the page was plausible or the first validations agreed, the others
+            # repeat the extraction and are no independent votes
+            enriched_product["validations_sent"] = validations_sent
+        return enriched_product
 
     def create_results_dataframe(self, all_products, all_validation_results):
         """Creates and combines extracted and validated results into a single DataFrame."""
 
-        extracted_df = pd.DataFrame(all_products).add_prefix("extracted_")
+        extracted_df = (
+            pd.DataFrame(all_products)
+            .add_prefix("extracted_")
+            .rename(columns={"extracted_validations_sent": "validations_sent"})
+        )
 
         for i, validation_data in enumerate(all_validation_results):
             validation_df = pd.DataFrame(validation_data).add_prefix(
@@ -205,18 +560,33 @@ class Pipeline:
             return True, extracted_df
 
         log_message(f"Categorizing products for {directory}", display_mode=False)
-        categorized_df = self.categorizer.categorize_products(
-            extracted_df, self.openai_client
+        with self.telemetry.labels(
+            leaflet=os.path.basename(output_dir)
+        ), self.telemetry.stage("categorize"):
+            categorized_df = self.categorizer.categorize_products(
+                extracted_df, self.openai_client
+            )
+        return True, self.save_categorized_results(
+            directory, categorized_df, output_dir
         )
+
+    def save_categorized_results(
+        self, directory: str, categorized_df: pd.DataFrame, output_dir: str
+    ) -> pd.DataFrame:
         self.append_metadata(categorized_df)
 
-        output_path = self.result_saver.save(categorized_df, output_dir)
+        with self.telemetry.stage("save"):
+            output_path = self.result_saver.save(categorized_df, output_dir)
         log_message(
             f"Categorized results from {directory} saved at: {output_path}",
             self.display_mode,
         )
 
-        return True, categorized_df
+        return categorized_df
+
+
+def get_page_name(image_path: str) -> str:
+    return f"{os.path.basename(os.path.dirname(image_path))}/{os.path.basename(image_path)}"
 
 
 def parse_arguments():
@@ -238,13 +608,121 @@ def parse_arguments():
         action="store_true",
         help="Overwrite existing results if they exist.",
     )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Maximum number of pages sent to the LLM at the same time, 1 processes pages one by one.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the LLM, instead of reusing responses to identical earlier requests.",
+    )
+    parser.add_argument(
+        "--no-category-store",
+        action="store_true",
+        help="Send every product name to the LLM for categorization, instead of reusing the categories of earlier runs and reviewer corrections.",
+    )
+    parser.add_argument(
+        "--fused-categorization",
+        action="store_true",
+        help="Determine the category and whether a product is a grill product in one request, instead of two.",
+    )
+    parser.add_argument(
+        "--local-classifier",
+        action="store_true",
+        help="Categorize product names with the local classifier first, only uncertain names are sent to the LLM.",
+    )
+    parser.add_argument(
+        "--local-min-certainty",
+        type=float,
+        default=LOCAL_CLASSIFIER_MIN_CERTAINTY,
+        help="Minimum certainty (0-100) of the local classifier to skip the LLM.",
+    )
+    execution_mode = parser.add_mutually_exclusive_group()
+    execution_mode.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Overlap rendering, extraction and categorization instead of running them one after another.",
+    )
+    execution_mode.add_argument(
+        "--batch-mode",
+        action="store_true",
+        help="Send all requests through the OpenAI Batch API, at half the cost but with up to 24h delay.",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=RENDER_WORKERS,
+        help="Number of processes used to render the PDF pages to images.",
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=list(IMAGE_FORMATS),
+        default=IMAGE_FORMAT,
+        help="Format in which the pages are uploaded to the LLM.",
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=IMAGE_QUALITY,
+        help="Quality of JPEG and WEBP uploads, from 1 to 100.",
+    )
+    parser.add_argument(
+        "--image-detail",
+        choices=IMAGE_DETAILS,
+        default=IMAGE_DETAIL,
+        help="Detail setting of the vision model. Pages are scaled down to the resolution it uses.",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="With --streaming, send the rendered pages to the LLM straight from memory.",
+    )
+    parser.add_argument(
+        "--no-save-images",
+        action="store_true",
+        help="With --in-memory, do not write the pages to disk. The review UI needs them.",
+    )
+    parser.add_argument(
+        "--reuse-pages",
+        action="store_true",
+        help="Reuse the products of near-identical pages from earlier runs instead of extracting them again. "
+        "The prices of a reused page are not read again, a page is only reused if no part of it visibly changed.",
+    )
+    parser.add_argument(
+        "--page-reuse-max-distance",
+        type=int,
+        default=PAGE_REUSE_MAX_DISTANCE,
+        help=f"Maximum number of differing bits (of {PAGE_HASH_SIZE ** 2}) between the hashes of two pages to compare their content.",
+    )
+    parser.add_argument(
+        "--tiling",
+        action="store_true",
+        help="Extract dense pages from overlapping tiles, and split pages whose response is cut off.",
+    )
+    parser.add_argument(
+        "--no-excel",
+        action="store_true",
+        help="Only save the results as Parquet, without exporting the combined results to Excel.",
+    )
+    parser.add_argument(
+        "--adaptive-validation",
+        action="store_true",
+        help="Do not validate plausible pages, and stop validating a page once a majority agrees with the extraction. The validations_sent column shows how many validations a page actually got.",
+    )
     # This does convert the dashes to underscores
     return vars(parser.parse_args())
 
 
 if __name__ == "__main__":
+    arguments = parse_arguments()
     pipeline = Pipeline(
-        args=parse_arguments(),
-        leaflet_reader=LeafletReader(file_downloader=NoopDownloader()),
+        args=arguments,
+        leaflet_reader=LeafletReader(
+            file_downloader=NoopDownloader(),
+            num_render_workers=arguments["render_workers"],
+        ),
     )
     pipeline.main()
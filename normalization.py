@@ -0,0 +1,25 @@
+"""Normalized forms of the extracted product values, so that the same value is recognized again."""
+
+import re
+
+# The first number of a price or discount, with a decimal point or comma
+NUMBER_PATTERN = r"(\d+(?:[.,]\d+)?)"
+
+
+def normalize_product_name(name: str) -> str:
+    """Lower case words only, so that "Coop  Naturafarm Bratwurst," and "coop naturafarm bratwurst" are the same product."""
+    return " ".join(re.findall(r"\w+", str(name).lower()))
+
+
+def parse_number(value) -> float | None:
+    """The first number in a price or discount, None if it has none."""
+    if value is None:
+        return None
+    match = re.search(NUMBER_PATTERN, str(value))
+    return float(match.group(1).replace(",", ".")) if match else None
+
+
+def normalize_price(price: str | None) -> str | None:
+    """Turns "3.–", "3.00" and "3,00 CHF" into "3.00", so that the same price is found again."""
+    number = parse_number(price)
+    return None if number is None else f"{number:.2f}"
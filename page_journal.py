@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+
+from pdf_manifest import get_file_hash
+from settings import NUMBER_OF_CHATGPT_VALIDATIONS
+
+
+def get_image_hash(image_path: str, image_data: bytes | None = None) -> str | None:
+    if image_data is not None:
+        return hashlib.sha256(image_data).hexdigest()
+    try:
+        return get_file_hash(image_path)
+    except OSError:
+        return None
+
+
+class PageJournal:
+    """
+    Append-only journal of the pages of one directory that were already extracted and validated.
+
+    Every finished page is written as one JSON line, so if the run crashes (e.g. because the
+    rate limit retries are exhausted), a restart only has to process the missing pages.
+    Each line has the hash of the page image, a page that was rendered differently since it was
+    journaled is processed again.
+    """
+
+    def __init__(self, output_dir: str, file_name: str = "page_journal.jsonl"):
+        self.path = os.path.join(output_dir, file_name)
+        self._lock = threading.Lock()
+        self._pages = self._load()
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def get(
+        self, image_path: str, image_data: bytes | None = None
+    ) -> tuple[list, list] | None:
+        """
+        Returns the journaled (extracted products, validation results) of the page, if any and
+        the image did not change since. The image is read from image_path, unless it is given as
+        image_data.
+        """
+        journaled = self._pages.get(os.path.basename(image_path))
+        if journaled is None:
+            return None
+        image_hash, page_result = journaled
+        # Records of older versions have no hash
+        if image_hash is None or image_hash != get_image_hash(image_path, image_data):
+            return None
+        return page_result
+
+    def append(
+        self,
+        image_path: str,
+        page_result: tuple[list, list],
+        image_data: bytes | None = None,
+    ) -> None:
+        extracted_products, validation_results = page_result
+        record = {
+            "page": os.path.basename(image_path),
+            "sha256": get_image_hash(image_path, image_data),
+            "products": extracted_products,
+            "validations": validation_results,
+        }
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as journal_file:
+                journal_file.write(json.dumps(record) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._pages[record["page"]] = (record["sha256"], page_result)
+
+    def remove(self) -> None:
+        """Deletes the journal, once the results of the directory are saved it is not needed anymore."""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._pages = {}
+
+    def _load(self) -> dict[str, tuple[str | None, tuple[list, list]]]:
+        pages = {}
+        if not os.path.exists(self.path):
+            return pages
+        with open(self.path, encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be incomplete if the process was killed while writing it
+                    continue
+                # Pages validated with a different number of validations are processed again
+                if len(record["validations"]) == NUMBER_OF_CHATGPT_VALIDATIONS:
+                    pages[record["page"]] = (
+                        record.get("sha256"),
+                        (record["products"], record["validations"]),
+                    )
+        return pages
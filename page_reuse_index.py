@@ -0,0 +1,260 @@
+import io
+import json
+import os
+import time
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image
+
+from llms.models import Results
+from sqlite_store import SQLiteStore
+
+
+def get_dhash(image_data: bytes, hash_size: int) -> np.ndarray:
+    """
+    Difference hash of an image: the image is shrunk to (hash_size + 1) x hash_size grey values
+    and every bit says whether a pixel is brighter than its right neighbour. Re-encoding,
+    rescaling and small rendering differences change only a few bits.
+
+    Returns:
+        np.ndarray: The hash_size * hash_size bits, packed into bytes.
+    """
+    image = (
+        Image.open(io.BytesIO(image_data))
+        .convert("L")
+        .resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    )
+    pixels = np.asarray(image, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def get_thumbnail(image_data: bytes, size: int) -> np.ndarray:
+    """The grey values of the image, scaled so that its longer side has size pixels."""
+    image = Image.open(io.BytesIO(image_data)).convert("L")
+    factor = size / max(image.size)
+    image = image.resize(
+        (max(1, round(image.width * factor)), max(1, round(image.height * factor))),
+        Image.Resampling.BOX,
+    )
+    return np.asarray(image, dtype=np.uint8)
+
+
+def get_max_block_difference(
+    thumbnail: np.ndarray, other_thumbnail: np.ndarray, block_size: int
+) -> float:
+    """
+    The largest mean difference of the grey values of two thumbnails over a block of
+    block_size x block_size pixels. A changed digit is a large difference in a few blocks,
+    while re-encoding changes all blocks a little. Infinite if the sizes differ.
+    """
+    if thumbnail.shape != other_thumbnail.shape:
+        return float("inf")
+    height = thumbnail.shape[0] // block_size * block_size
+    width = thumbnail.shape[1] // block_size * block_size
+    if height == 0 or width == 0:
+        return float(
+            np.abs(thumbnail.astype(np.int16) - other_thumbnail.astype(np.int16)).max()
+        )
+    differences = np.abs(
+        thumbnail[:height, :width].astype(np.int16)
+        - other_thumbnail[:height, :width].astype(np.int16)
+    )
+    return float(
+        differences.reshape(
+            height // block_size, block_size, width // block_size, block_size
+        )
+        .mean(axis=(1, 3))
+        .max()
+    )
+
+
+class PageHash(NamedTuple):
+    dhash: np.ndarray
+    # Compared before the products of a page with a matching hash are reused
+    thumbnail: np.ndarray
+
+
+class PageReuseIndex(SQLiteStore):
+    """
+    Index of the pages extracted in earlier runs, by perceptual hash, with their extracted products.
+
+    Retailers reuse pages (brand ads, recurring offers) week after week. A new page that is
+    within max_distance bits of a known page gets the products of that page, instead of being
+    extracted again.
+
+    The hash of a whole page barely changes when only a price changes, so it only finds the
+    candidates. Their thumbnails are compared block by block, and a page is only reused if no
+    block differs by more than max_block_difference grey levels. The prices of a reused page
+    are not read again, so a price change that is too small for this check is not noticed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_distance: int,
+        hash_size: int,
+        thumbnail_size: int,
+        block_size: int,
+        max_block_difference: float,
+    ):
+        """
+        Parameters:
+            path (str): The SQLite file with the hash, thumbnail and extracted products of every indexed page.
+            max_distance (int): Maximum Hamming distance of the hashes of two pages to compare them.
+            hash_size (int): The hashes have hash_size * hash_size bits.
+            thumbnail_size (int): Longer side in pixels of the thumbnails that are compared.
+            block_size (int): Side in pixels of the blocks of the thumbnails that are compared.
+            max_block_difference (float): Maximum mean difference of the grey values of a block to reuse the products.
+        """
+        super().__init__(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS pages "
+                "(page TEXT PRIMARY KEY, hash BLOB NOT NULL, products TEXT NOT NULL, created REAL NOT NULL, "
+                "thumbnail BLOB)"
+            ],
+        )
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.thumbnail_size = thumbnail_size
+        self.block_size = block_size
+        self.max_block_difference = max_block_difference
+        self.reused_pages: list[dict] = []
+        self.changed_pages: list[dict] = []
+        self.lookups = 0
+        columns = [
+            column
+            for _, column, *_ in self._connection.execute("PRAGMA table_info(pages)")
+        ]
+        if "thumbnail" not in columns:
+            # Pages indexed without a thumbnail cannot be checked, so they are not reused
+            self._connection.execute("ALTER TABLE pages ADD COLUMN thumbnail BLOB")
+        self._connection.commit()
+        # All hashes are kept in memory, a lookup compares them all at once
+        rows = self._connection.execute(
+            "SELECT page, hash FROM pages WHERE length(hash) = ? AND thumbnail IS NOT NULL",
+            (hash_size * hash_size // 8,),
+        ).fetchall()
+        self._pages = [page for page, _ in rows]
+        self._hashes = np.array(
+            [np.frombuffer(page_hash, dtype=np.uint8) for _, page_hash in rows],
+            dtype=np.uint8,
+        ).reshape(len(rows), hash_size * hash_size // 8)
+
+    def __str__(self) -> str:
+        return (
+            f"Page reuse: {len(self.reused_pages)} of {self.lookups} pages reused "
+            f"({self.get_reuse_rate() * 100:.1f}%), {len(self._pages)} pages indexed"
+        )
+
+    def get_hash(self, image_data: bytes) -> PageHash:
+        return PageHash(
+            get_dhash(image_data, self.hash_size),
+            get_thumbnail(image_data, self.thumbnail_size),
+        )
+
+    def find(self, page: str, page_hash: PageHash) -> Tuple[Results, str] | None:
+        """
+        Returns the products and the name of the most similar known page whose hash is close
+        enough and whose thumbnail has no changed block.
+
+        Parameters:
+            page (str): Name of the new page, for the report.
+        """
+        with self._lock:
+            self.lookups += 1
+            if len(self._pages) == 0:
+                return None
+            distances = np.unpackbits(
+                np.bitwise_xor(self._hashes, page_hash.dhash), axis=1
+            ).sum(axis=1)
+            candidates = np.flatnonzero(distances <= self.max_distance)
+            for candidate in candidates[
+                np.argsort(distances[candidates], kind="stable")
+            ]:
+                source = self._pages[candidate]
+                products, thumbnail = self._connection.execute(
+                    "SELECT products, thumbnail FROM pages WHERE page = ?", (source,)
+                ).fetchone()
+                block_difference = get_max_block_difference(
+                    page_hash.thumbnail, self._decode(thumbnail), self.block_size
+                )
+                if block_difference > self.max_block_difference:
+                    self.changed_pages.append(
+                        {
+                            "page": page,
+                            "similar_to": source,
+                            "distance": int(distances[candidate]),
+                            "block_difference": block_difference,
+                        }
+                    )
+                    continue
+                self.reused_pages.append(
+                    {
+                        "page": page,
+                        "reused_from": source,
+                        "distance": int(distances[candidate]),
+                        "block_difference": block_difference,
+                    }
+                )
+                return Results.model_validate_json(products), source
+        return None
+
+    def add(self, page: str, page_hash: PageHash, products: Results) -> None:
+        """Adds an extracted page, replacing an earlier extraction of the same page."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages (page, hash, products, created, thumbnail) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    page,
+                    page_hash.dhash.tobytes(),
+                    products.model_dump_json(),
+                    time.time(),
+                    self._encode(page_hash.thumbnail),
+                ),
+            )
+            self._connection.commit()
+            if page in self._pages:
+                self._hashes[self._pages.index(page)] = page_hash.dhash
+            else:
+                self._pages.append(page)
+                self._hashes = np.vstack([self._hashes, page_hash.dhash])
+
+    @staticmethod
+    def _encode(thumbnail: np.ndarray) -> bytes:
+        output = io.BytesIO()
+        Image.fromarray(thumbnail, mode="L").save(output, format="PNG")
+        return output.getvalue()
+
+    @staticmethod
+    def _decode(thumbnail: bytes) -> np.ndarray:
+        return np.asarray(Image.open(io.BytesIO(thumbnail)), dtype=np.uint8)
+
+    def get_reuse_rate(self) -> float:
+        return len(self.reused_pages) / self.lookups if self.lookups > 0 else 0.0
+
+    def write_report(self, output_dir: str, name: str = "page_reuse") -> str:
+        """
+        Writes the reuse rate and every reused page with its source page as JSON.
+
+        Returns:
+            str: Path of the report.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        report_path = os.path.join(output_dir, f"{name}.json")
+        with self._lock:
+            report = {
+                "pages_checked": self.lookups,
+                "pages_reused": len(self.reused_pages),
+                "reuse_rate": self.get_reuse_rate(),
+                "max_distance": self.max_distance,
+                "max_block_difference": self.max_block_difference,
+                "reused_pages": list(self.reused_pages),
+                # Pages with a matching hash whose content changed, e.g. a price
+                "changed_pages": list(self.changed_pages),
+            }
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+        return report_path
@@ -0,0 +1,208 @@
+import io
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from typing import List, Tuple
+
+from openai import LengthFinishReasonError
+from PIL import Image
+
+from llms.models import GroceryProduct, Results
+from llms.openai_client import OpenAIClient
+from normalization import normalize_price, normalize_product_name
+from telemetry import submit_with_labels
+
+logger = logging.getLogger(__name__)
+
+# Shorter names are too ambiguous to be merged just because one starts with the other
+MIN_PREFIX_LENGTH = 5
+# (left, upper, right, lower) in pixels
+Box = Tuple[int, int, int, int]
+
+
+class ProductIndex:
+    """
+    Collects the products of all tiles of a page and merges the ones that were extracted twice
+    from the overlap of two tiles.
+
+    Products are indexed by price, so a new product is only compared by name with the products
+    that have the same price, or no price at all. Products of the same tile are never merged,
+    as a tile can show several variants of a product at the same price.
+    """
+
+    def __init__(self, name_similarity: float):
+        self.name_similarity = name_similarity
+        self.products: List[GroceryProduct] = []
+        self._names: List[str] = []
+        self._tiles: List[int] = []
+        self._by_price = defaultdict(list)
+
+    def add(self, product: GroceryProduct, tile: int) -> None:
+        name = normalize_product_name(product.product_name)
+        price = normalize_price(product.discount_price or product.original_price)
+        candidates = (
+            range(len(self.products))
+            if price is None
+            else self._by_price[price] + self._by_price[None]
+        )
+        # Merge with the most similar product, so that similar variants find their own duplicate
+        best_match, best_similarity = None, self.name_similarity
+        for i in candidates:
+            if self._tiles[i] == tile:
+                continue
+            similarity = self._get_similarity(name, self._names[i], best_similarity)
+            if similarity >= best_similarity:
+                best_match, best_similarity = i, similarity
+        if best_match is not None:
+            self.products[best_match] = self._merge(self.products[best_match], product)
+            if len(name) > len(self._names[best_match]):
+                self._names[best_match] = name
+            return
+        self._by_price[price].append(len(self.products))
+        self.products.append(product)
+        self._names.append(name)
+        self._tiles.append(tile)
+
+    @staticmethod
+    def _get_similarity(name: str, other: str, minimum: float) -> float:
+        """Similarity of two names from 0 to 1, or 0 if it is certainly below the minimum."""
+        if name == other:
+            return 1.0
+        # Names cut off at the edge of a tile are prefixes of the full name
+        if min(len(name), len(other)) >= MIN_PREFIX_LENGTH and (
+            name.startswith(other) or other.startswith(name)
+        ):
+            return 1.0
+        # The quick upper bounds skip most of the expensive comparisons
+        matcher = SequenceMatcher(None, name, other)
+        if matcher.real_quick_ratio() < minimum or matcher.quick_ratio() < minimum:
+            return 0.0
+        return matcher.ratio()
+
+    @staticmethod
+    def _merge(product: GroceryProduct, duplicate: GroceryProduct) -> GroceryProduct:
+        """Keeps the fields of the more complete product and fills its gaps from the other one."""
+        first, second = product.model_dump(), duplicate.model_dump()
+        if sum(v is not None for v in second.values()) > sum(
+            v is not None for v in first.values()
+        ):
+            first, second = second, first
+        if len(second["product_name"]) > len(first["product_name"]):
+            first["product_name"] = second["product_name"]
+        return GroceryProduct(
+            **{
+                key: value if value is not None else second[key]
+                for key, value in first.items()
+            }
+        )
+
+
+class PageTiler:
+    """
+    Extracts the products of a page from overlapping tiles instead of the whole page.
+
+    Tiles are extracted concurrently and contain fewer products, so their responses are shorter
+    and faster. Tiles whose response is cut off at the token limit are split in half and
+    extracted again.
+    """
+
+    def __init__(
+        self,
+        rows: int,
+        columns: int,
+        overlap: float,
+        max_truncation_splits: int,
+        name_similarity: float,
+    ):
+        """
+        Parameters:
+            rows (int): Number of tile rows.
+            columns (int): Number of tile columns.
+            overlap (float): How far a tile reaches into its neighbours, as a share of its size.
+            max_truncation_splits (int): How often a truncated tile is split again before giving up.
+            name_similarity (float): Minimum similarity of the names of two products with the same price to merge them.
+        """
+        self.rows = max(1, rows)
+        self.columns = max(1, columns)
+        self.overlap = overlap
+        self.max_truncation_splits = max_truncation_splits
+        self.name_similarity = name_similarity
+
+    def get_tile_boxes(
+        self, width: int, height: int, rows: int, columns: int
+    ) -> List[Box]:
+        """Returns the boxes of a rows x columns grid over the image, in reading order."""
+        tile_width, tile_height = width / columns, height / rows
+        margin_x, margin_y = tile_width * self.overlap, tile_height * self.overlap
+        return [
+            (
+                max(0, round(column * tile_width - margin_x)),
+                max(0, round(row * tile_height - margin_y)),
+                min(width, round((column + 1) * tile_width + margin_x)),
+                min(height, round((row + 1) * tile_height + margin_y)),
+            )
+            for row in range(rows)
+            for column in range(columns)
+        ]
+
+    def split(self, image: Image.Image, rows: int, columns: int) -> List[bytes]:
+        """Crops the image into overlapping tiles and returns them as PNGs."""
+        tiles = []
+        for box in self.get_tile_boxes(*image.size, rows, columns):
+            output = io.BytesIO()
+            image.crop(box).save(output, format="PNG")
+            tiles.append(output.getvalue())
+        return tiles
+
+    def extract(self, openai_client: OpenAIClient, image_data: bytes) -> Results:
+        """
+        Extracts all products of the page tile by tile and merges the duplicates from the overlaps.
+        """
+        tiles = self.split(Image.open(io.BytesIO(image_data)), self.rows, self.columns)
+        with ThreadPoolExecutor(max_workers=len(tiles)) as executor:
+            futures = [
+                submit_with_labels(
+                    executor,
+                    self._extract_tile,
+                    openai_client,
+                    tile,
+                    self.max_truncation_splits,
+                )
+                for tile in tiles
+            ]
+            tile_products = [
+                products for future in futures for products in future.result()
+            ]
+
+        index = ProductIndex(self.name_similarity)
+        for tile, products in enumerate(tile_products):
+            for product in products:
+                index.add(product, tile)
+        return Results(all_products=index.products)
+
+    def _extract_tile(
+        self, openai_client: OpenAIClient, tile: bytes, splits_left: int
+    ) -> List[List[GroceryProduct]]:
+        """Returns the products of the tile, or of each of its halves if it had to be split."""
+        try:
+            return [openai_client.extract(tile).all_products]
+        except LengthFinishReasonError:
+            if splits_left == 0:
+                raise
+            image = Image.open(io.BytesIO(tile))
+            width, height = image.size
+            logger.info(
+                "Response for a %dx%d tile was truncated, splitting it in half.",
+                width,
+                height,
+            )
+            # Split across the longer side, so the halves stay roughly square
+            halves = (
+                self.split(image, 1, 2) if width > height else self.split(image, 2, 1)
+            )
+            return [
+                products
+                for half in halves
+                for products in self._extract_tile(openai_client, half, splits_left - 1)
+            ]
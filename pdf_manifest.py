@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+from utils import atomic_write
+
+MANIFEST_FILE_NAME = "manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PdfManifest:
+    """
+    Records what was rendered from a PDF into its output directory: the hash, size and
+    modification time of the PDF, its page count, the render scale, how the page images were
+    preprocessed for the upload and the hash of every page image.
+
+    It answers whether the images of a PDF can be reused without parsing the PDF. If the size and
+    modification time of the PDF are unchanged, not even its content is read.
+    """
+
+    def __init__(self, output_dir: str, file_name: str = MANIFEST_FILE_NAME):
+        self.path = os.path.join(output_dir, file_name)
+        self.output_dir = output_dir
+
+    def load(self) -> dict | None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def find_images(
+        self,
+        pdf_path: str,
+        scale: float,
+        extension: str,
+        preprocessing: dict | None = None,
+    ) -> List[str] | None:
+        """
+        Returns the image paths of all pages, if they were rendered from this PDF with the same
+        scale, format and preprocessing and all of them still exist, otherwise None.
+
+        Parameters:
+            preprocessing (dict | None): Settings of the ImagePreprocessor the pages were encoded with, None for full size renders.
+        """
+        manifest = self.load()
+        if (
+            manifest is None
+            or manifest.get("scale") != scale
+            or manifest.get("extension") != extension
+            # Manifests without it may be from preprocessed pages, which are rendered again once
+            or "preprocessing" not in manifest
+            or manifest["preprocessing"] != preprocessing
+        ):
+            return None
+
+        stat = os.stat(pdf_path)
+        pdf_changed = (stat.st_size, stat.st_mtime_ns) != (
+            manifest.get("pdf_size"),
+            manifest.get("pdf_mtime_ns"),
+        )
+        if pdf_changed and get_file_hash(pdf_path) != manifest.get("pdf_sha256"):
+            return None
+
+        image_paths = []
+        for image_name, page in manifest["pages"].items():
+            image_path = os.path.join(self.output_dir, image_name)
+            try:
+                if os.path.getsize(image_path) != page["size"]:
+                    return None
+            except OSError:
+                return None
+            image_paths.append(image_path)
+        if len(image_paths) != manifest["page_count"]:
+            return None
+        if pdf_changed:
+            # Same content, e.g. unpacked from a new upload: the next check is fast again
+            manifest["pdf_size"], manifest["pdf_mtime_ns"] = (
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+            self._write(manifest)
+        return image_paths
+
+    def save(
+        self,
+        pdf_path: str,
+        scale: float,
+        extension: str,
+        pages: Dict[str, tuple[str, int]],
+        preprocessing: dict | None = None,
+    ) -> None:
+        """
+        Parameters:
+            pages (Dict[str, tuple[str, int]]): Hash and size of every page image, by file name, in page order.
+            preprocessing (dict | None): Settings of the ImagePreprocessor the pages were encoded with, None for full size renders.
+        """
+        stat = os.stat(pdf_path)
+        manifest = {
+            "pdf_sha256": get_file_hash(pdf_path),
+            "pdf_size": stat.st_size,
+            "pdf_mtime_ns": stat.st_mtime_ns,
+            "page_count": len(pages),
+            "scale": scale,
+            "extension": extension,
+            "preprocessing": preprocessing,
+            "pages": {
+                image_name: {"sha256": image_hash, "size": size}
+                for image_name, (image_hash, size) in pages.items()
+            },
+        }
+        self._write(manifest)
+
+    def _write(self, manifest: dict) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        with atomic_write(self.path) as temporary_path:
+            with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
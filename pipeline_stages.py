@@ -0,0 +1,529 @@
+"""
+Alternative ways to run the pipeline over all directories: as overlapping streaming stages, or
+through the Batch API. Both work on a Pipeline and use its per-page and per-directory steps.
+"""
+
+import os
+import queue
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import pandas as pd
+import streamlit as st
+
+from image_writer import AsyncImageWriter
+from page_journal import PageJournal
+from settings import (
+    NUMBER_OF_CHATGPT_VALIDATIONS,
+    STREAM_QUEUE_SIZE,
+    STREAMING_CATEGORIZATION_BATCH_SIZE,
+)
+import utils
+from utils import log_message
+
+if TYPE_CHECKING:
+    from main_pipeline import Pipeline
+
+
+_STAGE_DONE = object()  # Sentinel that tells the next streaming stage to stop
+
+
+@dataclass
+class _StreamQueues:
+    """The bounded queues that connect the streaming stages."""
+
+    pages: queue.Queue = field(
+        default_factory=lambda: queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    )
+    results: queue.Queue = field(
+        default_factory=lambda: queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    )
+    categories: queue.Queue = field(
+        default_factory=lambda: queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    )
+    # Not bounded, the main thread only empties it between two page results
+    categorized: queue.Queue = field(default_factory=queue.Queue)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+@dataclass
+class _StreamedDirectory:
+    """Progress of one directory, as seen by the main thread of the streaming run."""
+
+    directory: str
+    num_pages: int
+    journal: PageJournal
+    page_results: dict = field(default_factory=dict)
+    extracted_df: pd.DataFrame | None = None
+
+
+def stream_all_directories(pipeline: "Pipeline") -> None:
+    """
+    Processes all PDFs and image directories as overlapping stages connected by bounded queues:
+    render -> extract and validate -> categorize. A page is sent to the LLM while the next pages
+    are still rendering, and products are categorized as soon as enough product names exist.
+    """
+    pdf_jobs = pipeline.get_pdf_jobs()
+    pdf_output_dirs = {
+        os.path.join(pipeline.pdf_dir, os.path.splitext(filename)[0])
+        for filename in os.listdir(pipeline.pdf_dir)
+        if filename.endswith(".pdf")
+    }
+    # The images of the PDFs are queued by the render stage as they are rendered
+    image_directories = [
+        (directory, output_dir)
+        for directory, output_dir in pipeline.get_image_directories()
+        if directory not in pdf_output_dirs
+    ]
+
+    image_writer = (
+        AsyncImageWriter()
+        if pipeline.args.get("in_memory") and not pipeline.args.get("no_save_images")
+        else None
+    )
+    queues = _StreamQueues()
+    stages = [
+        threading.Thread(
+            target=_render_stage,
+            args=(pipeline, pdf_jobs, image_directories, queues, image_writer),
+            daemon=True,
+        )
+    ] + [
+        threading.Thread(target=_extract_stage, args=(pipeline, queues), daemon=True)
+        for _ in range(pipeline.max_concurrency)
+    ]
+    if not pipeline.args["no_categorize"]:
+        stages.append(
+            threading.Thread(
+                target=_categorize_stage, args=(pipeline, queues), daemon=True
+            )
+        )
+    for stage in stages:
+        stage.start()
+
+    errors = _StreamCollector(pipeline, queues).run()
+
+    for stage in stages:
+        stage.join()
+    if image_writer is not None:
+        image_writer.close()
+    if errors:
+        raise errors[0]
+
+
+class _StreamCollector:
+    """
+    Runs on the main thread of a streaming run: collects the page results, saves every directory
+    once all its pages are done, and saves its categories once the categorize stage returns them.
+    Streamlit can only be updated from this thread, not from the stages.
+    """
+
+    def __init__(self, pipeline: "Pipeline", queues: _StreamQueues):
+        self.pipeline = pipeline
+        self.queues = queues
+        self.directories: dict[str, _StreamedDirectory] = {}
+        self.pages_done = 0
+        self.pages_total = 0
+        self.errors: list[Exception] = []
+        self.progress_bar = st.progress(0) if pipeline.display_mode else None
+
+    @property
+    def categorize(self) -> bool:
+        return not self.pipeline.args["no_categorize"]
+
+    def run(self) -> list[Exception]:
+        """Returns the errors of all stages, once every extract worker is done."""
+        workers_done = 0
+        while workers_done < self.pipeline.max_concurrency:
+            kind, *message = self.queues.results.get()
+            if kind == "done":
+                workers_done += 1
+            elif kind == "error":
+                self.fail(message[0])
+            elif kind == "directory":
+                self.add_directory(*message)
+            elif kind == "page" and not self.queues.cancelled.is_set():
+                self.add_page(*message)
+            if self.categorize:
+                self.save_categorized_directories(block=False)
+
+        if self.categorize:
+            self.queues.categories.put(_STAGE_DONE)
+            if not self.queues.cancelled.is_set():
+                self.save_categorized_directories(block=True)
+        return self.errors
+
+    def fail(self, error: Exception) -> None:
+        self.errors.append(error)
+        self.queues.cancelled.set()
+
+    def add_directory(
+        self, directory: str, output_dir: str, num_pages: int, journal: PageJournal
+    ) -> None:
+        log_message(f"Processing {directory} ...", self.pipeline.display_mode)
+        if len(journal) > 0:
+            log_message(
+                f"Resuming {directory}, {len(journal)} pages are already in the journal.",
+                self.pipeline.display_mode,
+            )
+        self.directories[output_dir] = _StreamedDirectory(directory, num_pages, journal)
+        self.pages_total += num_pages
+
+    def add_page(
+        self,
+        output_dir: str,
+        page_index: int,
+        num_pages: int,
+        page_result: tuple[list, list],
+    ) -> None:
+        streamed = self.directories[output_dir]
+        streamed.page_results[page_index] = page_result
+        self.pages_done += 1
+        if self.progress_bar is not None:
+            self.progress_bar.progress(self.pages_done / self.pages_total)
+
+        extracted_products, _ = page_result
+        if self.categorize and len(extracted_products) > 0:
+            self.queues.categories.put(
+                (
+                    "products",
+                    output_dir,
+                    page_index,
+                    [product["product_name"] for product in extracted_products],
+                )
+            )
+        if len(streamed.page_results) < num_pages:
+            return
+        streamed.extracted_df = self.pipeline.save_extracted_results(
+            streamed.directory,
+            output_dir,
+            [streamed.page_results[i] for i in range(num_pages)],
+        )
+        streamed.page_results = {}
+        streamed.journal.remove()
+        if self.categorize:
+            self.queues.categories.put(("flush", output_dir))
+        else:
+            del self.directories[output_dir]
+
+    def save_categorized_directories(self, block: bool) -> None:
+        while any(
+            streamed.extracted_df is not None for streamed in self.directories.values()
+        ):
+            try:
+                output_dir, category_df = self.queues.categorized.get(block=block)
+            except queue.Empty:
+                return
+            if isinstance(category_df, Exception):
+                self.fail(category_df)
+                return
+            streamed = self.directories.pop(output_dir)
+            self.pipeline.save_categorized_results(
+                streamed.directory,
+                pd.concat([streamed.extracted_df, category_df], axis=1),
+                output_dir,
+            )
+
+
+def _render_stage(
+    pipeline: "Pipeline",
+    pdf_jobs: list[tuple[str, str]],
+    image_directories: list[tuple[str, str]],
+    queues: _StreamQueues,
+    image_writer: AsyncImageWriter | None,
+) -> None:
+    """
+    Renders the PDFs and queues their pages, followed by the pages of the image directories.
+
+    In memory mode, the rendered pages are queued as encoded images, and only written to disk
+    by the image_writer, if given.
+    """
+    journals = {}
+
+    def queue_pages(directory, output_dir, pages, num_pages, first_index):
+        if first_index == 0:
+            # Announced before the first page, so it always arrives before the page results
+            journals[output_dir] = PageJournal(output_dir)
+            queues.results.put(
+                ("directory", directory, output_dir, num_pages, journals[output_dir])
+            )
+        for offset, (image_path, image_data) in enumerate(pages):
+            queues.pages.put(
+                (
+                    output_dir,
+                    first_index + offset,
+                    num_pages,
+                    image_path,
+                    image_data,
+                    journals[output_dir],
+                )
+            )
+
+    try:
+        _render_pdfs(pipeline, pdf_jobs, queues, image_writer, queue_pages)
+        for directory, output_dir in image_directories:
+            image_paths = utils.get_all_image_paths(directory)
+            if len(image_paths) > 0 and not queues.cancelled.is_set():
+                queue_pages(
+                    directory,
+                    output_dir,
+                    [(path, None) for path in image_paths],
+                    len(image_paths),
+                    0,
+                )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        queues.results.put(("error", e))
+    finally:
+        for _ in range(pipeline.max_concurrency):
+            queues.pages.put(_STAGE_DONE)
+
+
+def _render_pdfs(
+    pipeline: "Pipeline",
+    pdf_jobs: list[tuple[str, str]],
+    queues: _StreamQueues,
+    image_writer: AsyncImageWriter | None,
+    queue_pages,
+) -> None:
+    """Renders the PDFs and passes their pages to queue_pages as soon as they are rendered."""
+    output_dirs = dict(pdf_jobs)
+    pages_queued = defaultdict(int)
+    rendered_pages = _iter_rendered_pages(pipeline, pdf_jobs)
+    while True:
+        # Only the rendering is timed, not the wait for a free slot in the page queue
+        with pipeline.telemetry.stage("render"):
+            rendered = next(rendered_pages, None)
+        if rendered is None:
+            return
+        pdf_path, pages, num_pages = rendered
+        if queues.cancelled.is_set():
+            return
+        if image_writer is not None:
+            for image_path, image_data in pages:
+                image_writer.write(image_path, image_data)
+        output_dir = output_dirs[pdf_path]
+        queue_pages(output_dir, output_dir, pages, num_pages, pages_queued[pdf_path])
+        pages_queued[pdf_path] += len(pages)
+
+
+def _iter_rendered_pages(pipeline: "Pipeline", pdf_jobs: list[tuple[str, str]]):
+    """
+    Yields (PDF path, [(image path, image data)], number of pages) as the pages are rendered.
+    The image data is None if the pages were written to disk.
+    """
+    if pipeline.args.get("in_memory"):
+        return pipeline.leaflet_reader.iter_pdfs_to_buffers(
+            pdf_jobs,
+            # Tiles are cut from the full page, so it must not be scaled down yet
+            pipeline.image_preprocessor if pipeline.page_tiler is None else None,
+        )
+    return (
+        (pdf_path, [(path, None) for path in paths], num_pages)
+        for pdf_path, paths, num_pages in pipeline.leaflet_reader.iter_pdfs_to_images(
+            pdf_jobs
+        )
+    )
+
+
+def _extract_stage(pipeline: "Pipeline", queues: _StreamQueues) -> None:
+    """Runs process_journaled_image on queued pages until the render stage is done."""
+    while True:
+        task = queues.pages.get()
+        if task is _STAGE_DONE:
+            queues.results.put(("done",))
+            return
+        if queues.cancelled.is_set():
+            continue
+        output_dir, page_index, num_pages, image_path, image_data, journal = task
+        try:
+            queues.results.put(
+                (
+                    "page",
+                    output_dir,
+                    page_index,
+                    num_pages,
+                    pipeline.process_journaled_image(image_path, journal, image_data),
+                )
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            queues.results.put(("error", e))
+
+
+def _categorize_stage(pipeline: "Pipeline", queues: _StreamQueues) -> None:
+    """
+    Categorizes product names in batches as they arrive. On a "flush" message, the remaining
+    names of that directory are categorized and all its categories are returned in page order.
+    """
+    pending = defaultdict(list)
+    categorized = defaultdict(list)
+
+    def categorize_pending(output_dir):
+        keys, names = zip(*pending.pop(output_dir))
+        with pipeline.telemetry.labels(
+            leaflet=os.path.basename(output_dir)
+        ), pipeline.telemetry.stage("categorize"):
+            category_df = pipeline.categorizer.categorize_products(
+                pd.DataFrame({"extracted_product_name": list(names)}),
+                pipeline.openai_client,
+            ).drop(columns=["extracted_product_name"])
+        category_df.index = pd.MultiIndex.from_tuples(keys)
+        categorized[output_dir].append(category_df)
+
+    while True:
+        message = queues.categories.get()
+        if message is _STAGE_DONE:
+            return
+        if queues.cancelled.is_set():
+            continue
+        kind, output_dir, *payload = message
+        try:
+            if kind == "products":
+                page_index, names = payload
+                pending[output_dir].extend(
+                    ((page_index, i), name) for i, name in enumerate(names)
+                )
+                if len(pending[output_dir]) >= STREAMING_CATEGORIZATION_BATCH_SIZE:
+                    categorize_pending(output_dir)
+            elif kind == "flush":
+                if pending[output_dir]:
+                    categorize_pending(output_dir)
+                pending.pop(output_dir, None)
+                frames = categorized.pop(output_dir, [])
+                category_df = (
+                    pd.concat(frames).sort_index().reset_index(drop=True)
+                    if frames
+                    else pd.DataFrame()
+                )
+                queues.categorized.put((output_dir, category_df))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            queues.categorized.put((output_dir, e))
+
+
+def batch_process_all_directories(pipeline: "Pipeline") -> None:
+    """
+    Processes all directories through the Batch API: the pages of all directories are
+    extracted in one batch and validated in another, then all products are categorized together.
+    """
+    directories = pipeline.get_image_directories()
+    image_paths = {
+        output_dir: utils.get_all_image_paths(directory)
+        for directory, output_dir in directories
+    }
+    journals = {output_dir: PageJournal(output_dir) for _, output_dir in directories}
+    missing_pages = [
+        (output_dir, image_path)
+        for _, output_dir in directories
+        for image_path in image_paths[output_dir]
+        if journals[output_dir].get(image_path) is None
+    ]
+
+    log_message(
+        f"Submitting {len(missing_pages)} pages to the Batch API ...",
+        pipeline.display_mode,
+    )
+    for (output_dir, image_path), page_result in zip(
+        missing_pages,
+        _batch_process_pages(pipeline, [path for _, path in missing_pages]),
+    ):
+        journals[output_dir].append(image_path, page_result)
+
+    extracted_dfs = []
+    for directory, output_dir in directories:
+        if len(image_paths[output_dir]) == 0:
+            continue
+        extracted_df = pipeline.save_extracted_results(
+            directory,
+            output_dir,
+            [journals[output_dir].get(path) for path in image_paths[output_dir]],
+        )
+        journals[output_dir].remove()
+        extracted_dfs.append((directory, output_dir, extracted_df))
+
+    if pipeline.args["no_categorize"] or len(extracted_dfs) == 0:
+        return
+
+    log_message("Categorizing products of all directories", display_mode=False)
+    with pipeline.telemetry.stage("categorize"):
+        categorized_df = pipeline.categorizer.categorize_products(
+            pd.concat([df for _, _, df in extracted_dfs], ignore_index=True),
+            pipeline.openai_client,
+        )
+    start = 0
+    for directory, output_dir, extracted_df in extracted_dfs:
+        pipeline.save_categorized_results(
+            directory,
+            categorized_df.iloc[start : start + len(extracted_df)].reset_index(
+                drop=True
+            ),
+            output_dir,
+        )
+        start += len(extracted_df)
+
+
+def _batch_process_pages(
+    pipeline: "Pipeline", image_paths: list[str]
+) -> list[tuple[list, list]]:
+    """Extracts and validates the pages in two batches, and returns the results of every page like process_image."""
+    images = [utils.read_image(image_path) for image_path in image_paths]
+    responses, reused_from = _batch_extract_pages(pipeline, image_paths, images)
+    with pipeline.telemetry.stage("validate"):
+        validation_responses = pipeline.openai_client.validate_product_data_many(
+            [
+                (response, image_data, seed)
+                for response, image_data in zip(responses, images)
+                for seed in range(NUMBER_OF_CHATGPT_VALIDATIONS)
+            ]
+        )
+
+    page_results = []
+    for page_index, image_path in enumerate(image_paths):
+        page_validations = validation_responses[
+            page_index
+            * NUMBER_OF_CHATGPT_VALIDATIONS : (page_index + 1)
+            * NUMBER_OF_CHATGPT_VALIDATIONS
+        ]
+        page_results.append(
+            (
+                [
+                    pipeline.enrich_product_data(
+                        product, image_path, reused_from[page_index]
+                    )
+                    for product in responses[page_index].all_products
+                ],
+                [
+                    pipeline.get_validated_products(validation_response)
+                    for validation_response in page_validations
+                ],
+            )
+        )
+    return page_results
+
+
+def _batch_extract_pages(
+    pipeline: "Pipeline", image_paths: list[str], images: list[bytes]
+) -> tuple[list, list[str | None]]:
+    """
+    Extracts the pages that cannot be reused in one batch.
+
+    Returns:
+        tuple[list, list[str | None]]: The response of every page, and the name of the page it was reused from.
+    """
+    reused_pages = [
+        pipeline.find_reused_page(image_path, image_data)
+        for image_path, image_data in zip(image_paths, images)
+    ]
+    extract_indices = [
+        i for i, (_, reused) in enumerate(reused_pages) if reused is None
+    ]
+    with pipeline.telemetry.stage("extract"):
+        extracted = pipeline.openai_client.extract_many(
+            [images[i] for i in extract_indices]
+        )
+    responses = [reused[0] if reused else None for _, reused in reused_pages]
+    reused_from = [reused[1] if reused else None for _, reused in reused_pages]
+    for i, response in zip(extract_indices, extracted):
+        responses[i] = response
+        pipeline.index_page(image_paths[i], reused_pages[i][0], response)
+    return responses, reused_from
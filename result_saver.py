@@ -1,44 +1,150 @@
 import glob
 import os
+import threading
 
 import pandas as pd
 
+from combine_manifest import CombineManifest
+from results_database import ResultsDatabase
+
+RESULTS_FILE_NAME = "results.parquet"
+EXCEL_FILE_NAME = "results.xlsx"
+# Written by earlier versions, still read so that their results are kept
+LEGACY_RESULTS_FILE_NAME = "results.csv"
+# Few distinct values that repeat on every row
+CATEGORICAL_COLUMNS = [
+    "extracted_folder",
+    "extracted_page_number",
+    "category",
+    "final_category",
+]
+
+
+def read_results(path: str) -> pd.DataFrame:
+    """Reads a results file, Parquet or the CSV of earlier versions."""
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    return pd.read_parquet(path)
+
+
+def write_results(results: pd.DataFrame, path: str) -> None:
+    """
+    Writes the results to a Parquet file, with categorical columns for the folder, page and
+    categories. Columns with values of several types, e.g. a number edited as text, are stored
+    as text.
+    """
+    results = results.copy()
+    for column in results.columns:
+        if results[column].dtype != object:
+            continue
+        values = results[column].dropna()
+        if values.map(type).nunique() > 1:
+            results[column] = values.astype(str).reindex(results.index)
+    for column in CATEGORICAL_COLUMNS:
+        if column in results.columns:
+            results[column] = results[column].astype("category")
+    results.to_parquet(path, index=False)
+
 
 class ResultSaver:
-    def __init__(self, overwrite_results: bool = False):
-        self.output_file_name = "results.xlsx"
+    def __init__(
+        self,
+        overwrite_results: bool = False,
+        excel_export: bool = True,
+        database: ResultsDatabase | None = None,
+    ):
+        """
+        Parameters:
+            overwrite_results (bool): Process directories again that already have results.
+            excel_export (bool): Also save the combined results as Excel file.
+            database (ResultsDatabase | None): If given, the results of every directory are also saved there.
+        """
+        self.output_file_name = RESULTS_FILE_NAME
         self.overwrite_results = overwrite_results
+        self.excel_export = excel_export
+        self.database = database
+        self.run_id = None
+        self._run = None
+        self._run_lock = threading.Lock()
+
+    def start_run(self, pdf_dir: str, arguments: dict) -> None:
+        """
+        The results saved from now on belong to a new run. It is only recorded in the database
+        when the first results are saved, so runs that skip everything leave no trace.
+        """
+        with self._run_lock:
+            self._run = (pdf_dir, arguments)
+            self.run_id = None
+
+    def get_run_id(self) -> int | None:
+        """The id of the current run in the database, which is recorded on the first call."""
+        with self._run_lock:
+            if self.run_id is None and self._run is not None:
+                self.run_id = self.database.start_run(*self._run)
+            return self.run_id
 
     def save_results(self, output_dir: str) -> pd.DataFrame:
         combined_results = self.combine_results_from_all_subdirectories(output_dir)
-        combined_results_filename = self.save(combined_results, output_dir)
+        combined_results_filename = os.path.join(output_dir, self.output_file_name)
+        write_results(combined_results, combined_results_filename)
         print(
             f"Combined results from all files in {output_dir} saved at: {combined_results_filename}"
         )
+        if self.database is not None and "extracted_folder" in combined_results:
+            # Results of runs before the database existed
+            missing_results = combined_results[
+                ~combined_results["extracted_folder"]
+                .astype(str)
+                .isin(self.database.get_folders())
+            ]
+            self.database.replace_folders(missing_results, None)
+            print(self.database)
+        if self.excel_export:
+            excel_file_path = self.export_excel(combined_results, output_dir)
+            print(f"Combined results exported to: {excel_file_path}")
         return combined_results
 
+    def get_results_path(self, output_dir: str) -> str | None:
+        """The results file of the directory, None if it has none."""
+        for file_name in [self.output_file_name, LEGACY_RESULTS_FILE_NAME]:
+            results_path = os.path.join(output_dir, file_name)
+            if os.path.exists(results_path) and os.path.getsize(results_path) > 0:
+                return results_path
+        return None
+
     def results_exist(self, output_dir: str) -> bool:
-        results_path = os.path.join(output_dir, self.output_file_name)
-        return os.path.exists(results_path) and os.path.getsize(results_path) > 0
+        return self.get_results_path(output_dir) is not None
+
+    def load(self, output_dir: str) -> pd.DataFrame:
+        return read_results(self.get_results_path(output_dir))
 
     def save(self, categorized_df: pd.DataFrame, output_dir: str) -> str:
         """
-        Saves a pandas df to an Excel file.
+        Saves a pandas df to a Parquet file, and replaces the results of its folders in the database.
 
         Parameters:
             categorized_df (pd.DataFrame): The pandas df.
         Returns:
-            str: File path to the saved Excel file.
+            str: File path to the saved Parquet file.
         """
         os.makedirs(output_dir, exist_ok=True)
 
-        # Define the file name with a timestamp
-        excel_file_path = os.path.join(output_dir, self.output_file_name)
-        categorized_df.to_excel(excel_file_path, index=False)
+        results_file_path = os.path.join(output_dir, self.output_file_name)
+        write_results(categorized_df, results_file_path)
+        if self.database is not None:
+            self.database.replace_folders(categorized_df, self.get_run_id())
+        return results_file_path
 
-        # Note that this is really just for debugging - I think eventually we can use only Excel
-        csv_file_path = os.path.join(output_dir, "results.csv")
-        categorized_df.to_csv(csv_file_path, index=False)
+    @staticmethod
+    def export_excel(categorized_df: pd.DataFrame, output_dir: str) -> str:
+        """
+        Saves a pandas df to an Excel file, which is slow, so only for the final results.
+
+        Returns:
+            str: File path to the saved Excel file.
+        """
+        excel_file_path = os.path.join(output_dir, EXCEL_FILE_NAME)
+        categorized_df.to_excel(excel_file_path, index=False)
         return excel_file_path
 
     def results_exist_and_should_be_kept(self, results_directory: str):
@@ -51,9 +157,29 @@ class ResultSaver:
     def combine_results_from_all_subdirectories(
         self, parent_directory: str
     ) -> pd.DataFrame:
-        all_results_files = glob.glob(
-            f"{parent_directory}/*/**/{self.output_file_name}", recursive=True
-        )
-        return pd.concat(
-            [pd.read_excel(file) for file in all_results_files], ignore_index=True
+        """
+        Combines the results of all subdirectories. The combine manifest in parent_directory
+        keeps a copy of the combined results, so only the results that changed are read.
+        """
+        results_directories = {
+            os.path.dirname(file)
+            for file_name in [self.output_file_name, LEGACY_RESULTS_FILE_NAME]
+            for file in glob.glob(
+                f"{parent_directory}/*/**/{file_name}", recursive=True
+            )
+        }
+        if not results_directories:
+            return pd.DataFrame()
+        combine_manifest = CombineManifest(parent_directory)
+        combined_results = combine_manifest.combine(
+            {
+                os.path.relpath(directory, parent_directory): self.get_results_path(
+                    directory
+                )
+                for directory in sorted(results_directories)
+            },
+            read_results,
+            write_results,
         )
+        print(combine_manifest)
+        return combined_results
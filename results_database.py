@@ -0,0 +1,357 @@
+import json
+import time
+
+import pandas as pd
+
+from sqlite_store import SQLiteStore
+
+RESULTS_DATABASE_FILE_NAME = "results.sqlite"
+# Columns that the pipeline and the review UI filter and edit, all others are kept as JSON
+PRODUCT_COLUMNS = {
+    "extracted_folder": "TEXT NOT NULL",
+    "extracted_page_number": "TEXT NOT NULL",
+    "extracted_product_name": "TEXT",
+    "extracted_original_price": "TEXT",
+    "extracted_discount_price": "TEXT",
+    "extracted_percentage_discount": "REAL",
+    "final_category": "TEXT",
+    "final_certainty": "REAL",
+    "data_checked": "INTEGER NOT NULL DEFAULT 0",
+    "category_checked": "INTEGER NOT NULL DEFAULT 0",
+}
+BOOLEAN_COLUMNS = ["data_checked", "category_checked"]
+PRODUCT_INDEXES = {
+    "products_page": "extracted_folder, extracted_page_number",
+    "products_final_category": "final_category",
+    "products_final_certainty": "final_certainty",
+    "products_data_checked": "data_checked",
+    "products_category_checked": "category_checked",
+}
+# Column of the edit log for a product that was added, e.g. one a reviewer found missing
+ADDED_PRODUCT_COLUMN = "*"
+
+
+class ResultsDatabase(SQLiteStore):
+    """
+    The results of all runs of a PDF directory, stored in SQLite: one row per run, per page and per product.
+
+    The columns that the review UI filters on are indexed, so a selection such as the unchecked
+    grill products with a low certainty is a query instead of a mask over all results. The
+    results of a folder are replaced as a whole when it is processed again.
+
+    Every change of a product is also appended to the edit log, with the old and new value and
+    when it was made. Saving an edit only writes the changed rows and the log, so it takes the
+    same time however many results there are, and the log is the audit trail of the review.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path (str): The SQLite file with the runs, pages, products and edit log of one PDF directory.
+        """
+        columns = ", ".join(
+            f"{column} {column_type}" for column, column_type in PRODUCT_COLUMNS.items()
+        )
+        super().__init__(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "started REAL NOT NULL, pdf_dir TEXT NOT NULL, arguments TEXT NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS pages (extracted_folder TEXT NOT NULL, "
+                "extracted_page_number TEXT NOT NULL, run_id INTEGER REFERENCES runs (run_id), "
+                "product_count INTEGER NOT NULL, PRIMARY KEY (extracted_folder, extracted_page_number))",
+                "CREATE TABLE IF NOT EXISTS products (product_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                f"run_id INTEGER REFERENCES runs (run_id), {columns}, extra TEXT NOT NULL DEFAULT '{{}}')",
+                *[
+                    f"CREATE INDEX IF NOT EXISTS {index} ON products ({index_columns})"
+                    for index, index_columns in PRODUCT_INDEXES.items()
+                ],
+                # Append-only, the products table always has the latest values
+                "CREATE TABLE IF NOT EXISTS edits (edit_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "product_id INTEGER NOT NULL, column_name TEXT NOT NULL, old_value, new_value, "
+                "edited REAL NOT NULL)",
+                "CREATE INDEX IF NOT EXISTS edits_product ON edits (product_id, column_name)",
+            ],
+        )
+        self._writes = 0
+
+    def __str__(self) -> str:
+        with self._lock:
+            runs, pages, products, edits = self._connection.execute(
+                "SELECT (SELECT COUNT(*) FROM runs), (SELECT COUNT(*) FROM pages), "
+                "(SELECT COUNT(*) FROM products), (SELECT COUNT(*) FROM edits)"
+            ).fetchone()
+        return (
+            f"Results database: {products} products on {pages} pages from {runs} runs, "
+            f"{edits} edits"
+        )
+
+    def get_version(self) -> tuple[int, int]:
+        """Changes whenever the results change, through this or any other connection."""
+        with self._lock:
+            (data_version,) = self._connection.execute("PRAGMA data_version").fetchone()
+            return data_version, self._writes
+
+    def start_run(self, pdf_dir: str, arguments: dict) -> int:
+        """Records a run of the pipeline and returns its id."""
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (started, pdf_dir, arguments) VALUES (?, ?, ?)",
+                (time.time(), pdf_dir, json.dumps(arguments, default=str)),
+            )
+            self._connection.commit()
+            return cursor.lastrowid
+
+    def get_folders(self) -> set[str]:
+        with self._lock:
+            return {
+                folder
+                for (folder,) in self._connection.execute(
+                    "SELECT DISTINCT extracted_folder FROM pages"
+                )
+            }
+
+    def replace_folders(self, results: pd.DataFrame, run_id: int | None) -> None:
+        """
+        Replaces the pages and products of all folders in the results with the results. The edits
+        of the replaced products are deleted with them, the new products were not reviewed yet.
+        """
+        if len(results) == 0:
+            return
+        rows = self._to_rows(results)
+        folders = sorted({row[0] for row in rows})
+        pages = (
+            results.groupby(
+                [
+                    results["extracted_folder"].astype(str),
+                    results["extracted_page_number"].astype(str),
+                ],
+                observed=True,
+            )
+            .size()
+            .items()
+        )
+        placeholders = ",".join("?" * len(folders))
+        with self._lock, self._connection:
+            self._writes += 1
+            self._connection.execute(
+                "DELETE FROM edits WHERE product_id IN (SELECT product_id FROM products "
+                f"WHERE extracted_folder IN ({placeholders}))",
+                folders,
+            )
+            self._connection.execute(
+                f"DELETE FROM products WHERE extracted_folder IN ({placeholders})",
+                folders,
+            )
+            self._connection.execute(
+                f"DELETE FROM pages WHERE extracted_folder IN ({placeholders})",
+                folders,
+            )
+            self._connection.executemany(
+                "INSERT INTO pages (extracted_folder, extracted_page_number, run_id, product_count) "
+                "VALUES (?, ?, ?, ?)",
+                [(folder, page, run_id, count) for (folder, page), count in pages],
+            )
+            self._connection.executemany(
+                f"INSERT INTO products (run_id, {', '.join(PRODUCT_COLUMNS)}, extra) "
+                f"VALUES ({','.join('?' * (len(PRODUCT_COLUMNS) + 2))})",
+                [(run_id, *row) for row in rows],
+            )
+
+    def add_product(self, product: dict, run_id: int | None = None) -> int:
+        """Adds a single product, e.g. one that a reviewer found missing, and returns its id."""
+        (row,) = self._to_rows(pd.DataFrame([product]))
+        with self._lock, self._connection:
+            self._writes += 1
+            cursor = self._connection.execute(
+                f"INSERT INTO products (run_id, {', '.join(PRODUCT_COLUMNS)}, extra) "
+                f"VALUES ({','.join('?' * (len(PRODUCT_COLUMNS) + 2))})",
+                (run_id, *row),
+            )
+            self._connection.execute(
+                "INSERT INTO pages (extracted_folder, extracted_page_number, run_id, product_count) "
+                "VALUES (?, ?, ?, 1) ON CONFLICT (extracted_folder, extracted_page_number) "
+                "DO UPDATE SET product_count = product_count + 1",
+                (row[0], row[1], run_id),
+            )
+            product_id = cursor.lastrowid
+            self._log_edits(
+                [
+                    (
+                        product_id,
+                        ADDED_PRODUCT_COLUMN,
+                        None,
+                        json.dumps(product, default=str),
+                    )
+                ]
+            )
+            return product_id
+
+    def update_products(self, product_ids: list[int], values: dict) -> None:
+        """
+        Sets the values of the products, columns that are not in PRODUCT_COLUMNS are set in the
+        JSON. The values that change are appended to the edit log.
+        """
+        assignments = []
+        parameters = []
+        extra_parameters = []
+        current_values = []
+        current_parameters = []
+        new_values = {}
+        for column, value in values.items():
+            if column in PRODUCT_COLUMNS:
+                assignments.append(f"{column} = ?")
+                current_values.append(column)
+                new_values[column] = (
+                    int(value) if column in BOOLEAN_COLUMNS else self._to_sql(value)
+                )
+                parameters.append(new_values[column])
+            else:
+                extra_parameters.extend([f'$."{column}"', self._to_sql(value)])
+                current_values.append("json_extract(extra, ?)")
+                current_parameters.append(f'$."{column}"')
+                new_values[column] = self._to_sql(value)
+        if extra_parameters:
+            assignments.append(
+                f"extra = json_set(extra, {', '.join('?' * len(extra_parameters))})"
+            )
+            parameters.extend(extra_parameters)
+        ids = [int(product_id) for product_id in product_ids]
+        if not ids or not values:
+            return
+        with self._lock, self._connection:
+            self._writes += 1
+            rows = self._connection.execute(
+                f"SELECT product_id, {', '.join(current_values)} FROM products "
+                f"WHERE product_id IN ({','.join('?' * len(ids))})",
+                [*current_parameters, *ids],
+            ).fetchall()
+            self._log_edits(
+                [
+                    (product_id, column, old_value, new_values[column])
+                    for product_id, *old_values in rows
+                    for column, old_value in zip(new_values, old_values)
+                    if old_value != new_values[column]
+                ]
+            )
+            self._connection.executemany(
+                f"UPDATE products SET {', '.join(assignments)} WHERE product_id = ?",
+                [(*parameters, product_id) for product_id in ids],
+            )
+
+    def _log_edits(self, edits: list[tuple]) -> None:
+        """Appends (product id, column, old value, new value) to the edit log, in the open transaction."""
+        edited = time.time()
+        self._connection.executemany(
+            "INSERT INTO edits (product_id, column_name, old_value, new_value, edited) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(*edit, edited) for edit in edits],
+        )
+
+    def get_edits(self, product_ids: list[int] | None = None) -> pd.DataFrame:
+        """The edit log of the products, or of all products, oldest edit first."""
+        where = ""
+        parameters = []
+        if product_ids is not None:
+            parameters = [int(product_id) for product_id in product_ids]
+            where = f"WHERE product_id IN ({','.join('?' * len(parameters))})"
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT edit_id, product_id, column_name, old_value, new_value, edited "
+                f"FROM edits {where} ORDER BY edit_id",
+                parameters,
+            ).fetchall()
+        edits = pd.DataFrame(
+            rows,
+            columns=[
+                "edit_id",
+                "product_id",
+                "column_name",
+                "old_value",
+                "new_value",
+                "edited",
+            ],
+        ).set_index("edit_id")
+        edits["edited"] = pd.to_datetime(edits["edited"], unit="s")
+        return edits
+
+    def compact_edits(self) -> int:
+        """
+        Folds the edits of every column of a product into one, from the first old value to the
+        last new value, and drops the ones that ended where they started. Returns the number of
+        edits removed.
+        """
+        with self._lock, self._connection:
+            (before,) = self._connection.execute(
+                "SELECT COUNT(*) FROM edits"
+            ).fetchone()
+            self._connection.execute(
+                "UPDATE edits SET old_value = (SELECT first.old_value FROM edits AS first "
+                "WHERE first.product_id = edits.product_id "
+                "AND first.column_name = edits.column_name ORDER BY first.edit_id LIMIT 1) "
+                "WHERE edit_id IN (SELECT MAX(edit_id) FROM edits "
+                "GROUP BY product_id, column_name HAVING COUNT(*) > 1)"
+            )
+            self._connection.execute(
+                "DELETE FROM edits WHERE edit_id NOT IN "
+                "(SELECT MAX(edit_id) FROM edits GROUP BY product_id, column_name)"
+            )
+            self._connection.execute("DELETE FROM edits WHERE old_value IS new_value")
+            (after,) = self._connection.execute("SELECT COUNT(*) FROM edits").fetchone()
+        return before - after
+
+    def select(
+        self, conditions: list[str] | None = None, parameters: list | None = None
+    ) -> pd.DataFrame:
+        """
+        Returns the products that meet all conditions, indexed by product id.
+
+        Parameters:
+            conditions (list[str] | None): SQL conditions on the columns of PRODUCT_COLUMNS, with ? for the parameters.
+            parameters (list | None): The values of the ? in the conditions, in order.
+        """
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT product_id, {', '.join(PRODUCT_COLUMNS)}, extra FROM products "
+                f"{where} ORDER BY product_id",
+                parameters or [],
+            ).fetchall()
+        products = pd.DataFrame(
+            [row[:-1] for row in rows],
+            columns=["product_id", *PRODUCT_COLUMNS],
+        ).set_index("product_id")
+        for column in BOOLEAN_COLUMNS:
+            products[column] = products[column].astype(bool)
+        extra = pd.DataFrame(
+            [json.loads(row[-1]) for row in rows], index=products.index
+        )
+        return pd.concat([products, extra], axis=1)
+
+    @staticmethod
+    def _to_sql(value):
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return None
+        return value.item() if hasattr(value, "item") else value
+
+    @classmethod
+    def _to_rows(cls, results: pd.DataFrame) -> list[tuple]:
+        """The values of PRODUCT_COLUMNS and the JSON of all other columns of every row."""
+        results = results.reset_index(drop=True)
+        extra_columns = [
+            column for column in results.columns if column not in PRODUCT_COLUMNS
+        ]
+        extra = (
+            results[extra_columns].to_json(orient="records", lines=True).splitlines()
+            if extra_columns
+            else ["{}"] * len(results)
+        )
+        core = results.reindex(columns=list(PRODUCT_COLUMNS)).astype(object)
+        for column in BOOLEAN_COLUMNS:
+            core[column] = core[column].map(lambda checked: int(checked == 1))
+        for column in ["extracted_folder", "extracted_page_number"]:
+            core[column] = core[column].astype(str)
+        return [
+            (*(cls._to_sql(value) for value in values), extra_json)
+            for values, extra_json in zip(core.itertuples(index=False), extra)
+        ]
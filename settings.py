@@ -6,4 +6,57 @@ EXTRACTED_DATA_COLUMNS = [
     "percentage_discount",
 ]
 NUMBER_OF_CHATGPT_VALIDATIONS = 0
+# Prices and discounts of validations that differ by at most this much count as the same value
+VALIDATION_NUMERIC_TOLERANCE = 0.005
+# Percentage points that a percentage discount may differ from its prices, e.g. "-33%" for 3.00 instead of 4.50
+PLAUSIBLE_DISCOUNT_TOLERANCE = 2
 PDF_FILES_DIR = "pdf-files"
+# Maximum number of pages that are sent to the LLM at the same time, 1 is serial
+MAX_CONCURRENCY = 4
+# Number of processes used to render PDF pages to images
+RENDER_WORKERS = 4
+# Maximum number of items waiting between two stages of the streaming pipeline
+STREAM_QUEUE_SIZE = 8
+# Number of product names that are categorized together by the streaming pipeline
+STREAMING_CATEGORIZATION_BATCH_SIZE = 20
+# Product names per categorization request, longer lists make the LLM lose track.
+# The prompts were tuned with 5, check tests/category_test.py with the real model before raising it
+CATEGORIZATION_MAX_BATCH_SIZE = 5
+# Directory for data that is kept between runs, such as the LLM response cache
+CACHE_DIR = ".cache"
+LLM_CACHE_MAX_BYTES = 500 * 1024 * 1024
+# Categories of product names from earlier runs and reviewer corrections, shared by the pipeline and the review UI
+CATEGORY_STORE_PATH = CACHE_DIR + "/categories.sqlite"
+# Character n-gram classifier that categorizes product names before the LLM, see categorization/local_classifier.py
+LOCAL_CLASSIFIER_PATH = CACHE_DIR + "/local_classifier.npz"
+# Names whose local category and is_grill certainties are both at least this high (0-100) are not sent to the LLM
+LOCAL_CLASSIFIER_MIN_CERTAINTY = 70
+# Number of most similar known names that vote on the category of a name
+LOCAL_CLASSIFIER_NEIGHBOURS = 5
+# How often the status of a submitted OpenAI batch is checked
+BATCH_POLL_INTERVAL_SECS = 60
+# Initial OpenAI quota per model, corrected at runtime with the rate limit headers
+RATE_LIMIT_REQUESTS_PER_MINUTE = 500
+RATE_LIMIT_TOKENS_PER_MINUTE = 30_000
+# Upper bound for the adaptive number of concurrent requests per model
+MAX_LLM_CONCURRENCY = 16
+# How the pages are uploaded to the vision model: PNG, JPEG or WEBP, with the quality of JPEG and WEBP
+IMAGE_FORMAT = "PNG"
+IMAGE_QUALITY = 85
+# Detail setting of the vision model: high, low or auto
+IMAGE_DETAIL = "high"
+# Grid of overlapping tiles a page is split into in tiling mode, overlap as a share of the tile size
+TILE_ROWS = 2
+TILE_COLUMNS = 2
+TILE_OVERLAP = 0.1
+# How often a tile whose response was cut off is split in half again
+MAX_TRUNCATION_SPLITS = 2
+# Products from overlapping tiles with the same price and names at least this similar are merged
+DUPLICATE_NAME_SIMILARITY = 0.8
+# Pages whose perceptual hashes differ in at most this many of PAGE_HASH_SIZE**2 bits reuse the products of the known page
+PAGE_REUSE_MAX_DISTANCE = 4
+PAGE_HASH_SIZE = 16
+# Pages with matching hashes are compared at this size, a block of PAGE_REUSE_BLOCK_SIZE pixels whose grey values differ by more than PAGE_REUSE_MAX_BLOCK_DIFFERENCE on average (e.g. a changed price) prevents the reuse
+PAGE_REUSE_THUMBNAIL_SIZE = 1024
+PAGE_REUSE_BLOCK_SIZE = 4
+PAGE_REUSE_MAX_BLOCK_DIFFERENCE = 16
@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """
+    Base of the stores that keep data between runs in a SQLite file.
+
+    All threads share one connection, every access to it holds the lock. Stores that answer
+    lookups count them as hits and misses.
+    """
+
+    def __init__(self, path: str, schema: list[str]):
+        """
+        Parameters:
+            path (str): The SQLite file, its directory is created if needed.
+            schema (list[str]): Statements that create the tables and indexes, if they do not exist yet.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        for statement in schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
@@ -1,13 +1,13 @@
 import os
+import time
 
 import streamlit as st
-import pandas as pd
 
+from results_database import ResultsDatabase
 from settings import PDF_FILES_DIR
 from streamlit_pages.helper_functions import (
     get_results,
     get_unique_images,
-    check_result_columns,
     get_filtered_data_by_selection,
     show_current_image,
     get_filtered_page_data,
@@ -18,6 +18,7 @@ from streamlit_pages.helper_functions import (
     reset_state_values,
     show_forward_backward_buttons,
     show_mark_products_as_checked,
+    show_timings,
 )
 from streamlit_pages.helper_strings import (
     HELP_INCLUDE_CHECKED_PROD,
@@ -27,22 +28,12 @@ from streamlit_pages.helper_strings import (
     HELP_ONLY_CATEGORIES,
 )
 
-result_csv_path = os.path.join(PDF_FILES_DIR, "results.csv")
-required_columns = [
-    "extracted_folder",
-    "extracted_page_number",
-    "extracted_product_name",
-    "extracted_original_price",
-    "extracted_discount_price",
-    "extracted_percentage_discount",
-    "final_category",
-]
-
 
 def show_check_results_page():
-    # Load the data from csv file
-    data = get_results(result_csv_path)
-    check_result_columns(data, required_columns)
+    # The results are queried from the results database, with the filters chosen below
+    start = time.perf_counter()
+    database = get_results()
+    load_secs = time.perf_counter() - start
 
     st.write("### What do you want to check?")
     col1, col2, col3 = st.columns(3)  # Adjust column width proportions as needed
@@ -77,12 +68,15 @@ def show_check_results_page():
             on_change=reset_state_values,
             help=HELP_LLM_CONFIDENCE,
         )
-    show_check_results_frame(data)
+    show_check_results_frame(database, load_secs)
 
 
-def show_check_results_frame(data: pd.DataFrame) -> None:
+def show_check_results_frame(database: ResultsDatabase, load_secs: float = 0) -> None:
 
-    filtered_data = get_filtered_data_by_selection(data)
+    start = time.perf_counter()
+    filtered_data, cached = get_filtered_data_by_selection(database)
+    load_secs += time.perf_counter() - start
+    start = time.perf_counter()
     # Get the unique combinations of folder and page number
     unique_images = get_unique_images(filtered_data)
 
@@ -100,27 +94,24 @@ def show_check_results_frame(data: pd.DataFrame) -> None:
         current_page_number = current_image["extracted_page_number"]
 
         filtered_page_data = get_filtered_page_data(
-            data, current_folder, current_page_number
+            filtered_data, current_folder, current_page_number
         )
 
         # Hack to handle individual images
-        current_folder = (
+        image_folder = (
             os.path.join(PDF_FILES_DIR, current_folder)
             if current_folder != PDF_FILES_DIR
             else PDF_FILES_DIR
         )
-        show_current_image(current_folder, current_page_number)
-        show_edit_options(data, filtered_page_data, result_csv_path)
+        show_current_image(image_folder, current_page_number)
+        show_edit_options(database, filtered_page_data)
 
-        show_mark_products_as_checked(
-            data, current_folder, current_page_number, result_csv_path
-        )
-        show_add_missing_product(
-            data, current_folder, current_page_number, result_csv_path
-        )
+        show_mark_products_as_checked(database, filtered_page_data)
+        show_add_missing_product(database, current_folder, current_page_number)
 
         show_forward_backward_buttons(len(unique_images), "Bottom")
-        show_page_results_df(data, current_folder, current_page_number)
-        show_download(data)
+        show_page_results_df(database, current_folder, current_page_number)
+        show_download(database)
     else:
         st.write("Everything is already checked with this type of check!")
+    show_timings(load_secs, time.perf_counter() - start, cached)
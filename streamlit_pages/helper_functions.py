@@ -1,36 +1,58 @@
 import os
+import time
 from io import BytesIO
 
 import pandas as pd
 import streamlit as st
 from PIL import Image
 
+from categorization.category_store import CategoryStore
+from categorization.product_categorizer import ProductCategorizer
 from llms.models import FinalProductCategory
+from result_saver import ResultSaver, read_results
+from results_database import RESULTS_DATABASE_FILE_NAME, ResultsDatabase
+from settings import CATEGORY_STORE_PATH, PDF_FILES_DIR
+from streamlit_pages.selection_cache import SelectionCache
+from utils import log_message
 
 
 category_options: list[str] = [cat.value for cat in FinalProductCategory]
+RERUN_TIMINGS_SHOWN = 20
 
 
-def get_results(result_csv_path: str) -> pd.DataFrame:
-    # Ensure 'extracted_folder', 'extracted_page_number', and 'categorization_all_same' columns are present
-    if os.path.exists(result_csv_path):
-        data = pd.read_csv(result_csv_path)
-    else:
-        st.error(f"There is no results file at the path {result_csv_path}.")
-        st.stop()
+@st.cache_resource
+def open_results_database(path: str, file_id: int | None) -> ResultsDatabase:
+    database = ResultsDatabase(path)
+    # Results of runs before the database existed are only in the results file
+    results_path = ResultSaver().get_results_path(os.path.dirname(path))
+    if not database.get_folders() and results_path is not None:
+        database.replace_folders(read_results(results_path), None)
+    return database
+
 
-    if not "data_checked" in data.columns:
-        data["data_checked"] = False
-    if not "category_checked" in data.columns:
-        data["category_checked"] = False
-    return data
+def get_results_database() -> ResultsDatabase:
+    path = os.path.join(PDF_FILES_DIR, RESULTS_DATABASE_FILE_NAME)
+    # A new upload clears the directory, the new database file needs a new connection
+    file_id = os.stat(path).st_ino if os.path.exists(path) else None
+    return open_results_database(path, file_id)
 
 
-def check_result_columns(data: pd.DataFrame, required_columns: list[str]) -> None:
-    # check columns
-    if not all(col in data.columns for col in required_columns):
-        st.error(f"The dataframe must have {required_columns} columns.")
+def get_results() -> ResultsDatabase:
+    database = get_results_database()
+    if not database.get_folders():
+        st.error(f"There are no results in {PDF_FILES_DIR} yet.")
         st.stop()
+    return database
+
+
+@st.cache_resource
+def get_category_store() -> CategoryStore:
+    return CategoryStore(CATEGORY_STORE_PATH, ProductCategorizer.get_prompt_version())
+
+
+def record_category_correction(product_name: str, final_category: str) -> None:
+    # Later runs use the category of the reviewer instead of asking the LLM again
+    get_category_store().add_correction(product_name, final_category)
 
 
 def reset_state_values() -> None:
@@ -42,15 +64,51 @@ def get_unique_images(data: pd.DataFrame) -> pd.DataFrame:
     return data[["extracted_folder", "extracted_page_number"]].drop_duplicates()
 
 
-def get_filtered_data_by_selection(data: pd.DataFrame) -> pd.DataFrame:
-    return data[get_mask_selection(data)]
+def get_selection_cache() -> SelectionCache:
+    if "selection_cache" not in st.session_state:
+        st.session_state.selection_cache = SelectionCache()
+    return st.session_state.selection_cache
+
+
+def get_filtered_data_by_selection(
+    database: ResultsDatabase,
+) -> tuple[pd.DataFrame, bool]:
+    # Returns the selected products and whether they came from the cache of the session
+    return get_selection_cache().get(database, get_conditions_selection())
+
+
+def refresh_filtered_data(database: ResultsDatabase, product_ids: list[int]) -> None:
+    # The edited products are updated in the cache, instead of querying the selection again
+    get_selection_cache().refresh(database, get_conditions_selection(), product_ids)
 
 
 def get_filtered_page_data(
-    data: pd.DataFrame, current_folder: str, current_page_number: int
+    data: pd.DataFrame, current_folder: str, current_page_number: str
 ) -> pd.DataFrame:
-    # Filter the dataframe based on the current folder, page number, and categorization_all_same == True
-    return data[get_mask_page(data, current_folder, current_page_number)]
+    # Filter the selected products based on the current folder and page number
+    return data[get_mask_current_image(data, current_folder, current_page_number)]
+
+
+def show_timings(load_secs: float, render_secs: float, cached: bool) -> None:
+    # Timings of the last reruns, to see how long a reviewer waits after every click
+    timings = st.session_state.setdefault("rerun_timings", [])
+    timings.append(
+        {
+            "time": time.strftime("%H:%M:%S"),
+            "load_ms": round(load_secs * 1000, 1),
+            "render_ms": round(render_secs * 1000, 1),
+            "cached": cached,
+        }
+    )
+    del timings[:-RERUN_TIMINGS_SHOWN]
+    log_message(
+        f"Check page rerun: loaded in {load_secs * 1000:.1f} ms "
+        f"({'cached' if cached else 'queried'}), rendered in {render_secs * 1000:.1f} ms",
+        display_mode=False,
+    )
+    with st.sidebar.expander("Rerun timings"):
+        st.write(str(get_selection_cache()))
+        st.dataframe(pd.DataFrame(timings[::-1]), hide_index=True)
 
 
 def show_current_image(current_folder: str, current_page_number: int) -> None:
@@ -84,20 +142,22 @@ def show_current_image(current_folder: str, current_page_number: int) -> None:
 
 
 def show_edit_options(
-    data: pd.DataFrame, filtered_page_data: pd.DataFrame, result_path: str
+    database: ResultsDatabase, filtered_page_data: pd.DataFrame
 ) -> None:
     # Display filtered rows and provide options for editing them
     if not filtered_page_data.empty:
         for idx in filtered_page_data.index:
             if st.session_state.only_categories:
-                edit_product_category(idx, data, result_path)
+                edit_product_category(idx, filtered_page_data, database)
             else:
-                edit_product_data(idx, data, result_path)
+                edit_product_data(idx, filtered_page_data, database)
     else:
         st.write("No rows available for the current image")
 
 
-def edit_product_category(index: int, data: pd.DataFrame, storage_path: str) -> None:
+def edit_product_category(
+    index: int, data: pd.DataFrame, database: ResultsDatabase
+) -> None:
     with st.form(key=f"form_{index}"):
         # st.write(f"Editing Row {index + 1} (Category confidence = {data.loc[index, "final_certainty"]})")
 
@@ -118,12 +178,18 @@ def edit_product_category(index: int, data: pd.DataFrame, storage_path: str) ->
         submitted = st.form_submit_button("Save Changes")
 
         if submitted:
-            data.loc[index, "final_category"] = final_category
-            data.loc[index, "extracted_product_name"] = product_name
-            data.loc[index, "category_checked"] = True
+            database.update_products(
+                [index],
+                {
+                    "final_category": final_category,
+                    "extracted_product_name": product_name,
+                    "category_checked": True,
+                },
+            )
+            refresh_filtered_data(database, [index])
+            record_category_correction(product_name, final_category)
 
-            data.to_csv(storage_path, index=False)
-            st.success(f"Row {index + 1} updated successfully!")
+            st.success(f"Product {index} updated successfully!")
 
 
 def display_parsed_value(value) -> str:
@@ -135,10 +201,12 @@ def display_parsed_value(value) -> str:
         return value
 
 
-def edit_product_data(index: int, data: pd.DataFrame, storage_path: str) -> None:
+def edit_product_data(
+    index: int, data: pd.DataFrame, database: ResultsDatabase
+) -> None:
     with st.form(key=f"form_{index}"):
         confidence = data.loc[index, "final_certainty"]
-        st.write(f"Editing Row {index + 1}. Category confidence: {confidence}")
+        st.write(f"Editing Product {index}. Category confidence: {confidence}")
 
         # Create editable input fields for each relevant column in the row
         col1, col2 = st.columns([2, 1])
@@ -187,35 +255,40 @@ def edit_product_data(index: int, data: pd.DataFrame, storage_path: str) -> None
         submitted = st.form_submit_button("Save Changes")
 
         if submitted:
-            # Update the dataframe with the new values
-            data.loc[index, "extracted_product_name"] = product_name
-            data.loc[index, "extracted_original_price"] = original_price
-            data.loc[index, "extracted_discount_price"] = discount_price
-            data.loc[index, "extracted_percentage_discount"] = percentage_discount
-            data.loc[index, "final_category"] = final_category
-            data.loc[index, "data_checked"] = True
-            data.loc[index, "category_checked"] = True
+            # Update the product with the new values
+            database.update_products(
+                [index],
+                {
+                    "extracted_product_name": product_name,
+                    "extracted_original_price": original_price,
+                    "extracted_discount_price": discount_price,
+                    "extracted_percentage_discount": percentage_discount,
+                    "final_category": final_category,
+                    "data_checked": True,
+                    "category_checked": True,
+                },
+            )
+            refresh_filtered_data(database, [index])
+            record_category_correction(product_name, final_category)
 
-            data.to_csv(storage_path, index=False)
-            st.success(f"Row {index + 1} updated successfully!")
+            st.success(f"Product {index} updated successfully!")
 
 
 def show_mark_products_as_checked(
-    data: pd.DataFrame, current_folder: str, current_page_number: int, storage_path: str
+    database: ResultsDatabase, filtered_page_data: pd.DataFrame
 ) -> None:
     if st.button("Mark Products as Checked", key="mark_products_as_checked"):
-        current_data_mask = get_mask_page(data, current_folder, current_page_number)
-        data.loc[current_data_mask, "category_checked"] = True
+        checked = {"category_checked": True}
         if not st.session_state.only_categories:
-            data.loc[current_data_mask, "data_checked"] = True
-        data.to_csv(storage_path, index=False)
+            checked["data_checked"] = True
+        database.update_products(filtered_page_data.index, checked)
+        refresh_filtered_data(database, filtered_page_data.index)
 
 
 def show_add_missing_product(
-    data: pd.DataFrame,
+    database: ResultsDatabase,
     current_folder: str,
-    current_page_number: int,
-    storage_path: str,
+    current_page_number: str,
     missing_product_counter: int = 0,
 ) -> None:
     if "missing_product_counter" not in st.session_state:
@@ -271,75 +344,73 @@ def show_add_missing_product(
                         st.error(error)
                 else:
 
-                    # Create a new product DataFrame to append to the existing data
-                    new_product = pd.DataFrame(
-                        [
-                            {
-                                "extracted_product_name": product_name,
-                                "extracted_original_price": original_price,
-                                "extracted_discount_price": discount_price,
-                                "extracted_percentage_discount": percentage_discount,
-                                "final_category": final_category,
-                                "data_checked": True,
-                                "extracted_folder": current_folder,
-                                "extracted_page_number": current_page_number,
-                                "category_checked": True,
-                                "final_certainty": 100,
-                            }
-                        ]
-                    )
+                    # Create a new product to add to the existing data
+                    new_product = {
+                        "extracted_product_name": product_name,
+                        "extracted_original_price": original_price,
+                        "extracted_discount_price": discount_price,
+                        "extracted_percentage_discount": percentage_discount,
+                        "final_category": final_category,
+                        "data_checked": True,
+                        "extracted_folder": current_folder,
+                        "extracted_page_number": current_page_number,
+                        "category_checked": True,
+                        "final_certainty": 100,
+                    }
 
                     # Find reference row in the original data to get additional columns if they exist
-                    reference_row = data[
-                        (data["extracted_folder"] == current_folder)
-                        & (data["extracted_page_number"] == current_page_number)
-                    ]
-                    if not reference_row.empty:
-                        new_product.loc[0, "date_collected"] = reference_row.iloc[0][
-                            "date_collected"
-                        ]
-                        new_product.loc[0, "calendar_week"] = reference_row.iloc[0][
-                            "calendar_week"
-                        ]
-
-                    # Append the new product row to the original DataFrame and save it
-                    data = pd.concat([data, new_product], ignore_index=True)
-                    data.to_csv(storage_path, index=False)
+                    reference_row = select_products(
+                        database,
+                        get_conditions_current_image(
+                            current_folder, current_page_number
+                        ),
+                    )
+                    for column in ["date_collected", "calendar_week"]:
+                        if not reference_row.empty and column in reference_row:
+                            new_product[column] = reference_row.iloc[0][column]
+
+                    # Add the new product to the results
+                    product_id = database.add_product(new_product)
+                    refresh_filtered_data(database, [product_id])
+                    record_category_correction(product_name, final_category)
 
                     # Notify the user and reset the form state to allow adding more products
                     st.success("Missing product added!")
 
         # Recursive call to show the add button again after submission
         show_add_missing_product(
-            data,
+            database,
             current_folder,
             current_page_number,
-            storage_path,
             missing_product_counter + 1,
         )
 
 
 def show_page_results_df(
-    data: pd.DataFrame, current_folder: str, current_page_number: int
+    database: ResultsDatabase, current_folder: str, current_page_number: str
 ) -> None:
     # Display the updated dataframe after editing
-    updated_data = data[
-        get_mask_page_results(data, current_folder, current_page_number)
-    ]
+    updated_data = select_products(
+        database, get_conditions_page_results(current_folder, current_page_number)
+    )
     if not updated_data.empty:
         st.write("### Updated Dataframe")
         st.dataframe(updated_data)
-
-
-def show_download(data: pd.DataFrame) -> None:
-    results_as_excel = to_excel(data)
-
-    st.download_button(
-        label="Download Results File",
-        data=results_as_excel,
-        file_name="results.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+        with st.expander("Edit history"):
+            st.dataframe(database.get_edits(list(updated_data.index)))
+
+
+def show_download(database: ResultsDatabase) -> None:
+    # Exporting all results is slow, so only when asked for
+    if st.button("Export Results File", key="export_results"):
+        # The exported results have the latest values, the log only needs the net edits
+        database.compact_edits()
+        st.download_button(
+            label="Download Results File",
+            data=to_excel(database.select()),
+            file_name="results.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
 
 
 def show_forward_backward_buttons(max_len: int, position: str) -> None:
@@ -392,70 +463,76 @@ def to_excel(dataframe):
     return processed_data
 
 
-### masking filter ###
+### query filter ###
+# Every filter is a list of (SQL condition, parameters) pairs on the indexed columns of the results database
 
 
-def get_mask_bbq_products(data: pd.DataFrame) -> pd.Series:
-    if st.session_state.bbq_products:
-        return data["final_category"] != FinalProductCategory.NO_GRILL_PRODUCT.value
-    else:
-        return pd.Series([False] * len(data))
+def select_products(
+    database: ResultsDatabase, conditions: list[tuple[str, list]]
+) -> pd.DataFrame:
+    return SelectionCache.select(database, conditions)
 
 
-def get_mask_non_bbq_products(data: pd.DataFrame) -> pd.Series:
+def get_conditions_categories() -> list[tuple[str, list]]:
+    no_grill_product = FinalProductCategory.NO_GRILL_PRODUCT.value
+    if st.session_state.bbq_products and st.session_state.non_bbq_products:
+        return []
+    if st.session_state.bbq_products:
+        return [("final_category IS NOT ?", [no_grill_product])]
     if st.session_state.non_bbq_products:
-        return data["final_category"] == FinalProductCategory.NO_GRILL_PRODUCT.value
-    else:
-        return pd.Series([False] * len(data))
+        return [("final_category = ?", [no_grill_product])]
+    return [("0", [])]
 
 
-def get_mask_included_checked_products(data: pd.DataFrame) -> pd.Series:
+def get_conditions_included_checked_products() -> list[tuple[str, list]]:
     if st.session_state.include_checked_products:
-        return pd.Series([True] * len(data))
+        return []
     elif st.session_state.only_categories:
-        return data["category_checked"] == False
+        return [("category_checked = 0", [])]
     else:
-        return data["data_checked"] == False
+        return [("data_checked = 0", [])]
 
 
-def get_mask_current_image(
-    data: pd.DataFrame, current_folder: str, current_page_number: int
-) -> pd.Series:
-    return (data["extracted_folder"] == current_folder) & (
-        data["extracted_page_number"] == current_page_number
-    )
+def get_conditions_current_image(
+    current_folder: str, current_page_number: str
+) -> list[tuple[str, list]]:
+    return [
+        ("extracted_folder = ?", [str(current_folder)]),
+        ("extracted_page_number = ?", [str(current_page_number)]),
+    ]
 
 
-def get_mask_max_llm_confidence(data: pd.DataFrame) -> pd.Series:
+def get_conditions_max_llm_confidence() -> list[tuple[str, list]]:
     if isinstance(st.session_state.max_llm_confidence, int) & (
         not st.session_state.include_checked_products
     ):
-        return data["final_certainty"] <= st.session_state.max_llm_confidence
+        return [("final_certainty <= ?", [st.session_state.max_llm_confidence])]
     else:
-        return pd.Series([True] * len(data))
+        return []
 
 
-def get_mask_core(data: pd.DataFrame) -> pd.Series:
-    return (
-        get_mask_bbq_products(data) | get_mask_non_bbq_products(data)
-    ) & get_mask_max_llm_confidence(data)
+def get_conditions_core() -> list[tuple[str, list]]:
+    return get_conditions_categories() + get_conditions_max_llm_confidence()
 
 
-def get_mask_selection(data: pd.DataFrame) -> pd.Series:
-    return get_mask_core(data) & get_mask_included_checked_products(data)
+def get_conditions_selection() -> list[tuple[str, list]]:
+    return get_conditions_core() + get_conditions_included_checked_products()
 
 
-def get_mask_page(
-    data: pd.DataFrame, current_folder: str, current_page_number: int
-) -> pd.Series:
-    return get_mask_selection(data) & get_mask_current_image(
-        data, current_folder, current_page_number
+def get_conditions_page_results(
+    current_folder: str, current_page_number: str
+) -> list[tuple[str, list]]:
+    return get_conditions_core() + get_conditions_current_image(
+        current_folder, current_page_number
     )
 
 
-def get_mask_page_results(
-    data: pd.DataFrame, current_folder: str, current_page_number: int
+### masking filter ###
+
+
+def get_mask_current_image(
+    data: pd.DataFrame, current_folder: str, current_page_number: str
 ) -> pd.Series:
-    return get_mask_core(data) & get_mask_current_image(
-        data, current_folder, current_page_number
+    return (data["extracted_folder"] == str(current_folder)) & (
+        data["extracted_page_number"] == str(current_page_number)
     )
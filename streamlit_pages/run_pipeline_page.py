@@ -1,24 +1,35 @@
-import os
 import streamlit as st
 
 from file_downloaders import StreamlitDownloader
 from leaflet_reader import LeafletReader
 from main_pipeline import Pipeline
-from settings import PDF_FILES_DIR
+from settings import MAX_CONCURRENCY, PDF_FILES_DIR, RENDER_WORKERS
+from streamlit_pages.helper_functions import to_excel
 from ui import texts
 
 
 def run_pipeline(zipfile):
     st.write("Processing started...")
-    args = {"overwrite_results": True, "use_test_client": False, "no_categorize": False}
+    args = {
+        "overwrite_results": True,
+        "use_test_client": False,
+        "no_categorize": False,
+        "max_concurrency": MAX_CONCURRENCY,
+        # The download button exports the results when they are needed
+        "no_excel": True,
+    }
     pipeline = Pipeline(
         args,
-        leaflet_reader=LeafletReader(StreamlitDownloader(zipfile)),
+        leaflet_reader=LeafletReader(
+            StreamlitDownloader(zipfile), num_render_workers=RENDER_WORKERS
+        ),
         pdf_dir=PDF_FILES_DIR,
         display_mode=True,
     )
 
     st.session_state["results"] = pipeline.main()
+    # The export of earlier results is outdated
+    st.session_state.pop("results_excel", None)
     st.write("Processing finished")
 
 
@@ -34,15 +45,15 @@ def show_run_page():
         run_pipeline(uploaded_file)
 
     # Display results if available
-    if "results" in st.session_state:
-
-        # Enable file download
-        output_file = os.path.join(PDF_FILES_DIR, "results.xlsx")
-        if os.path.exists(output_file):
-            with open(output_file, "rb") as f:
-                st.download_button(
-                    label="Download Results",
-                    data=f,
-                    file_name="processed_results.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
+    if st.session_state.get("results") is not None:
+
+        # Exporting to Excel is slow, so only when asked for, and only once per run
+        if st.button("Export Results"):
+            st.session_state["results_excel"] = to_excel(st.session_state["results"])
+        if st.session_state.get("results_excel") is not None:
+            st.download_button(
+                label="Download Results",
+                data=st.session_state["results_excel"],
+                file_name="processed_results.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
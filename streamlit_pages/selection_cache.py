@@ -0,0 +1,91 @@
+import os
+
+import pandas as pd
+
+from results_database import ResultsDatabase
+
+
+class SelectionCache:
+    """
+    The products that match the filters of the check page, kept in the session between reruns.
+
+    Streamlit reruns the page on every click, but the selection is only queried again when the
+    filters, the database file or its version change. Edits of the reviewer update the cached
+    rows of the edited products instead.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.products = None
+        self.loads = 0
+        self.hits = 0
+
+    def __str__(self) -> str:
+        return (
+            f"Selection cache: {self.hits} reruns from the cache, {self.loads} queries"
+        )
+
+    @staticmethod
+    def get_key(database: ResultsDatabase, conditions: list[tuple[str, list]]) -> tuple:
+        """Identifies the selection: the database file, its version and the conditions."""
+        return (
+            database.path,
+            os.stat(database.path).st_ino,
+            database.get_version(),
+            tuple(
+                (condition, tuple(parameters)) for condition, parameters in conditions
+            ),
+        )
+
+    def get(
+        self, database: ResultsDatabase, conditions: list[tuple[str, list]]
+    ) -> tuple[pd.DataFrame, bool]:
+        """
+        Returns the products that meet the conditions, and whether they came from the cache.
+        """
+        key = self.get_key(database, conditions)
+        if key == self.key:
+            self.hits += 1
+            return self.products, True
+        self.products = self.select(database, conditions)
+        self.key = key
+        self.loads += 1
+        return self.products, False
+
+    def refresh(
+        self,
+        database: ResultsDatabase,
+        conditions: list[tuple[str, list]],
+        product_ids: list[int],
+    ) -> None:
+        """
+        Queries the products again right after they were edited or added: they are updated,
+        added or removed from the selection, the other products stay as they are.
+        """
+        ids = [int(product_id) for product_id in product_ids]
+        key = self.get_key(database, conditions)
+        if (
+            not ids
+            or self.key is None
+            or (self.key[:2], self.key[3]) != (key[:2], key[3])
+        ):
+            return
+        updated = self.select(
+            database,
+            conditions + [(f"product_id IN ({','.join('?' * len(ids))})", ids)],
+        )
+        products = pd.concat([self.products.drop(index=ids, errors="ignore"), updated])
+        self.products = products[~products.index.duplicated(keep="last")].sort_index()
+        (data_version, writes), (new_data_version, new_writes) = self.key[2], key[2]
+        # If the edit is the only change since the query, the cache is up to date again
+        if new_data_version == data_version and new_writes == writes + 1:
+            self.key = key
+
+    @staticmethod
+    def select(
+        database: ResultsDatabase, conditions: list[tuple[str, list]]
+    ) -> pd.DataFrame:
+        return database.select(
+            [condition for condition, _ in conditions],
+            [parameter for _, parameters in conditions for parameter in parameters],
+        )
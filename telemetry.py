@@ -0,0 +1,334 @@
+"""Collects timings, token usage and cost of a pipeline run."""
+
+import contextvars
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterator
+
+from utils import atomic_write
+
+# USD per million tokens: (prompt, cached prompt, completion)
+MODEL_PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+# The Batch API bills half of the regular price
+BATCH_PRICE_FACTOR = 0.5
+METRIC_PREFIX = "wwf"
+
+
+@dataclass
+class LLMCall:
+    method: str
+    model: str
+    wall_time: float
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    retries: int
+    cost: float
+    labels: dict = field(default_factory=dict)
+    # Type of the exception, for calls that failed after all retries
+    error: str | None = None
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    wall_time: float
+    labels: dict = field(default_factory=dict)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, q between 0 and 100."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def get_store_name(leaflet: str) -> str:
+    """The store is the first word of the leaflet name, e.g. "migros" for "migros_kw12"."""
+    return re.split(r"[_\-\s\d]", leaflet.lower(), maxsplit=1)[0] or leaflet
+
+
+def get_cost(
+    model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int
+) -> float:
+    prompt_price, cached_price, completion_price = MODEL_PRICES_PER_MILLION_TOKENS.get(
+        model, (0, 0, 0)
+    )
+    return (
+        (prompt_tokens - cached_tokens) * prompt_price
+        + cached_tokens * cached_price
+        + completion_tokens * completion_price
+    ) / 1_000_000
+
+
+def submit_with_labels(executor: Executor, function: Callable, *args) -> Future:
+    """Submits the call to the executor in a copy of the current context, with its labels."""
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+class Telemetry:
+    """
+    Thread-safe collector for LLM calls and pipeline stage timings.
+
+    Labels such as the leaflet and page are set with labels(), and are attached to everything
+    that is recorded inside that block. They are context variables, so work that is submitted
+    with submit_with_labels keeps the labels of the submitting thread.
+    """
+
+    def __init__(self):
+        self.calls: list[LLMCall] = []
+        self.stages: list[StageTiming] = []
+        self._lock = threading.Lock()
+        self._labels: ContextVar[dict] = ContextVar("telemetry_labels", default={})
+
+    @contextmanager
+    def labels(self, **labels) -> Iterator[None]:
+        token = self._labels.set({**self.current_labels(), **labels})
+        try:
+            yield
+        finally:
+            self._labels.reset(token)
+
+    def current_labels(self) -> dict:
+        return self._labels.get()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing = StageTiming(
+                name, time.perf_counter() - start, self.current_labels()
+            )
+            with self._lock:
+                self.stages.append(timing)
+
+    def record_call(
+        self,
+        method: str,
+        model: str,
+        wall_time: float,
+        usage,
+        retries: int,
+        batch: bool = False,
+        error: str | None = None,
+    ) -> None:
+        """
+        Records a finished LLM call, also one that failed.
+
+        Parameters:
+            usage: The usage of the chat completion, can be None.
+            batch (bool): Whether the call was part of a batch, which is billed at a discount.
+            error (str | None): Label of the error, if the call failed after all retries.
+        """
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        cost = get_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        call = LLMCall(
+            method,
+            model,
+            wall_time,
+            prompt_tokens,
+            completion_tokens,
+            cached_tokens,
+            retries,
+            cost * BATCH_PRICE_FACTOR if batch else cost,
+            self.current_labels(),
+            error,
+        )
+        with self._lock:
+            self.calls.append(call)
+
+    def snapshot(self) -> tuple[list[LLMCall], list[StageTiming]]:
+        """Copies of the calls and stage timings recorded so far, while workers may still record more."""
+        with self._lock:
+            return list(self.calls), list(self.stages)
+
+    def report(
+        self, snapshot: tuple[list[LLMCall], list[StageTiming]] | None = None
+    ) -> dict:
+        """Aggregates everything recorded so far, or in the given snapshot."""
+        calls, stages = self.snapshot() if snapshot is None else snapshot
+
+        stage_times = defaultdict(list)
+        for timing in stages:
+            stage_times[timing.stage].append(timing.wall_time)
+
+        calls_by_method = defaultdict(list)
+        for call in calls:
+            calls_by_method[(call.method, call.model)].append(call)
+
+        cost_per_page = defaultdict(float)
+        cost_per_leaflet = defaultdict(float)
+        cost_per_store = defaultdict(float)
+        for call in calls:
+            leaflet = call.labels.get("leaflet")
+            if leaflet is None:
+                continue
+            cost_per_leaflet[leaflet] += call.cost
+            cost_per_store[get_store_name(leaflet)] += call.cost
+            if call.labels.get("page") is not None:
+                cost_per_page[f"{leaflet}/{call.labels['page']}"] += call.cost
+
+        return {
+            "stages": {
+                stage: self._summarize(times) for stage, times in stage_times.items()
+            },
+            "llm_calls": [
+                {
+                    "method": method,
+                    "model": model,
+                    **self._summarize([call.wall_time for call in method_calls]),
+                    "prompt_tokens": sum(call.prompt_tokens for call in method_calls),
+                    "completion_tokens": sum(
+                        call.completion_tokens for call in method_calls
+                    ),
+                    "cached_tokens": sum(call.cached_tokens for call in method_calls),
+                    "retries": sum(call.retries for call in method_calls),
+                    "errors": self._count_errors(method_calls),
+                    "cost": sum(call.cost for call in method_calls),
+                }
+                for (method, model), method_calls in calls_by_method.items()
+            ],
+            "cost": {
+                "total": sum(call.cost for call in calls),
+                "per_page_p50": percentile(list(cost_per_page.values()), 50),
+                "per_page_p95": percentile(list(cost_per_page.values()), 95),
+                "per_page": dict(cost_per_page),
+                "per_leaflet": dict(cost_per_leaflet),
+                "per_store": dict(cost_per_store),
+            },
+        }
+
+    def write_reports(
+        self, output_dir: str, name: str = "telemetry"
+    ) -> tuple[str, str]:
+        """
+        Writes the report as JSON and as a Prometheus textfile.
+
+        Returns:
+            tuple[str, str]: Paths of the JSON and the Prometheus file.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        # One snapshot, so that the calls always add up to the totals of the report
+        snapshot = self.snapshot()
+        report = self.report(snapshot)
+        json_path = os.path.join(output_dir, f"{name}.json")
+        with open(json_path, "w", encoding="utf-8") as json_file:
+            json.dump(
+                {**report, "calls": [asdict(call) for call in snapshot[0]]},
+                json_file,
+                indent=2,
+            )
+        prometheus_path = os.path.join(output_dir, f"{name}.prom")
+        # The textfile collector must never read half a file
+        with atomic_write(prometheus_path) as temporary_path:
+            with open(temporary_path, "w", encoding="utf-8") as prometheus_file:
+                prometheus_file.write(self.to_prometheus(report))
+        return json_path, prometheus_path
+
+    @staticmethod
+    def to_prometheus(report: dict) -> str:
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_duration_seconds Wall time of the pipeline stages.",
+            f"# TYPE {METRIC_PREFIX}_stage_duration_seconds summary",
+        ]
+        for stage, summary in report["stages"].items():
+            lines += Telemetry._summary_lines(
+                f"{METRIC_PREFIX}_stage_duration_seconds", f'stage="{stage}"', summary
+            )
+
+        lines += [
+            f"# HELP {METRIC_PREFIX}_llm_call_duration_seconds Wall time of the LLM calls, including retries.",
+            f"# TYPE {METRIC_PREFIX}_llm_call_duration_seconds summary",
+        ]
+        for call in report["llm_calls"]:
+            lines += Telemetry._summary_lines(
+                f"{METRIC_PREFIX}_llm_call_duration_seconds",
+                f'method="{call["method"]}",model="{call["model"]}"',
+                call,
+            )
+
+        lines += [
+            f"# HELP {METRIC_PREFIX}_llm_tokens_total Tokens used by the LLM calls.",
+            f"# TYPE {METRIC_PREFIX}_llm_tokens_total counter",
+        ]
+        for call in report["llm_calls"]:
+            for token_type in ("prompt", "completion", "cached"):
+                lines.append(
+                    f'{METRIC_PREFIX}_llm_tokens_total{{method="{call["method"]}",model="{call["model"]}",type="{token_type}"}} '
+                    f'{call[f"{token_type}_tokens"]}'
+                )
+
+        lines += [
+            f"# HELP {METRIC_PREFIX}_llm_retries_total Retries of the LLM calls.",
+            f"# TYPE {METRIC_PREFIX}_llm_retries_total counter",
+        ]
+        for call in report["llm_calls"]:
+            lines.append(
+                f'{METRIC_PREFIX}_llm_retries_total{{method="{call["method"]}",model="{call["model"]}"}} {call["retries"]}'
+            )
+
+        lines += [
+            f"# HELP {METRIC_PREFIX}_llm_errors_total LLM calls that failed after all retries.",
+            f"# TYPE {METRIC_PREFIX}_llm_errors_total counter",
+        ]
+        for call in report["llm_calls"]:
+            for error, count in call["errors"].items():
+                lines.append(
+                    f'{METRIC_PREFIX}_llm_errors_total{{method="{call["method"]}",model="{call["model"]}",error="{error}"}} {count}'
+                )
+
+        lines += [
+            f"# HELP {METRIC_PREFIX}_llm_cost_usd Estimated LLM cost of the run.",
+            f"# TYPE {METRIC_PREFIX}_llm_cost_usd gauge",
+            f'{METRIC_PREFIX}_llm_cost_usd{{scope="total"}} {report["cost"]["total"]}',
+        ]
+        for leaflet, cost in report["cost"]["per_leaflet"].items():
+            lines.append(f'{METRIC_PREFIX}_llm_cost_usd{{leaflet="{leaflet}"}} {cost}')
+        for store, cost in report["cost"]["per_store"].items():
+            lines.append(f'{METRIC_PREFIX}_llm_cost_usd{{store="{store}"}} {cost}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _summary_lines(metric: str, labels: str, summary: dict) -> list[str]:
+        return [
+            f'{metric}{{{labels},quantile="0.5"}} {summary["p50"]}',
+            f'{metric}{{{labels},quantile="0.95"}} {summary["p95"]}',
+            f"{metric}_sum{{{labels}}} {summary['total']}",
+            f"{metric}_count{{{labels}}} {summary['count']}",
+        ]
+
+    @staticmethod
+    def _count_errors(calls: list[LLMCall]) -> dict[str, int]:
+        errors = defaultdict(int)
+        for call in calls:
+            if call.error is not None:
+                errors[call.error] += 1
+        return dict(errors)
+
+    @staticmethod
+    def _summarize(times: list[float]) -> dict:
+        return {
+            "count": len(times),
+            "total": sum(times),
+            "p50": percentile(times, 50),
+            "p95": percentile(times, 95),
+        }
@@ -0,0 +1,71 @@
+"""
+Categorizes the product names of the category test against a simulated LLM backend and reports
+API calls per product and wall time, for the batches sent concurrently and for the same batches
+sent one after another.
+"""
+
+import argparse
+import time
+
+import pandas as pd
+
+from categorization.product_categorizer import ProductCategorizer
+from llms.openai_client import OpenAIClient
+from llms.simulated_client import SimulatedOpenAI
+from tests.category_test import read_file
+
+
+class SerialOpenAIClient(OpenAIClient):
+    @staticmethod
+    def _run_concurrently(function, arguments):
+        return [function(*args) for args in arguments]
+
+
+def measure(name: str, client_class, data: pd.DataFrame, args):
+    backend = SimulatedOpenAI(
+        rate_limit_probability=args.rate_limit_probability,
+        time_scale=args.time_scale,
+        seed=args.seed,
+    )
+    openai_client = client_class(api_key="fake-key", client=backend)
+    start = time.perf_counter()
+    categorized_df = ProductCategorizer().categorize_products(data, openai_client)
+    wall_time = time.perf_counter() - start
+    assert "final_category" in categorized_df.columns
+    print(
+        f"{name:>10}: {len(data)} products in {wall_time:.2f}s, "
+        f"{backend.outcomes['ok']} API calls ({backend.outcomes['ok'] / len(data):.3f} per product), "
+        f"{backend.outcomes['rate_limited']} rate limited"
+    )
+
+
+def run():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.1,
+        help="Multiplies the simulated latencies, 1 is the speed of the real API.",
+    )
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Repeats the product names, e.g. 2 for a week with twice as many products.",
+    )
+    args = parser.parse_args()
+
+    names = list(read_file()["extracted_product_name"]) * args.repeat
+    # Distinct names, so that the products are not deduplicated
+    data = pd.DataFrame(
+        {"extracted_product_name": [f"{name} {i}" for i, name in enumerate(names)]}
+    )
+    measure("serial", SerialOpenAIClient, data, args)
+    measure("concurrent", OpenAIClient, data, args)
+
+
+if __name__ == "__main__":
+    run()
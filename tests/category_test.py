@@ -5,6 +5,7 @@ import pandas as pd
 import utils
 from categorization.product_categorizer import ProductCategorizer
 from llms.openai_client import OpenAIClient
+from settings import CATEGORIZATION_MAX_BATCH_SIZE
 
 TEST_DATA_DIR = "tests/data/"
 TEST_FILE = os.path.join(TEST_DATA_DIR, "category_test.csv")
@@ -33,6 +34,8 @@ def calculate_statistics(df: pd.DataFrame):
         accuracy = correct / total if total > 0 else 0
         print(f"{label}: {correct}/{total} correct ({accuracy:.2%})")
 
+    # The accuracy depends on how many product names share a request
+    print(f"Up to {CATEGORIZATION_MAX_BATCH_SIZE} products per request")
     print("=== Overall Match Stats ===")
     print_match_stats("Category Match", df["check_category"])
     print_match_stats("Is Grill Match", df["check_is_grill"])
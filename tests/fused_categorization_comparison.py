@@ -0,0 +1,80 @@
+"""
+Categorizes the products of the category test in the two step mode and in the fused mode and
+compares their accuracy against the solutions, their wall time, API calls and cost.
+
+Runs against the OpenAI API, so it needs an API key. With --simulated it runs against the
+simulated backend instead, which only compares latency and calls, as its answers are made up.
+"""
+
+import argparse
+import time
+
+import pandas as pd
+
+import utils
+from categorization.product_categorizer import ProductCategorizer
+from llms.openai_client import OpenAIClient
+from llms.simulated_client import SimulatedOpenAI
+from telemetry import Telemetry
+from tests.category_test import check_results, read_file
+
+
+def compare(data: pd.DataFrame, fused: bool, simulated: bool, time_scale: float):
+    telemetry = Telemetry()
+    openai_client = (
+        OpenAIClient(
+            api_key="fake-key",
+            telemetry=telemetry,
+            client=SimulatedOpenAI(time_scale=time_scale),
+        )
+        if simulated
+        else OpenAIClient(api_key=utils.get_api_key(), telemetry=telemetry)
+    )
+    start = time.perf_counter()
+    categorized_df = ProductCategorizer(fused=fused).categorize_products(
+        data.copy(), openai_client
+    )
+    wall_time = time.perf_counter() - start
+
+    report = telemetry.report()
+    num_calls = sum(calls["count"] for calls in report["llm_calls"])
+    line = (
+        f"{'fused' if fused else 'two step':>8}: {wall_time:.2f}s, {num_calls} API calls, "
+        f"${report['cost']['total']:.4f}"
+    )
+    if "category" not in categorized_df.columns:
+        print(f"{line}, the categories did not match the products")
+        return
+    categorized_df = check_results(categorized_df)
+    final_category_match = (
+        categorized_df["final_category"] == categorized_df["solution_final_category"]
+    )
+    print(
+        f"{line}, category {categorized_df['check_category'].mean():.2%}, "
+        f"is_grill {categorized_df['check_is_grill'].mean():.2%}, "
+        f"final category {final_category_match.mean():.2%}"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--simulated",
+        action="store_true",
+        help="Use the simulated backend instead of the OpenAI API, accuracy is meaningless then.",
+    )
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.1,
+        help="Multiplies the simulated latencies, 1 is the speed of the real API.",
+    )
+    args = parser.parse_args()
+
+    data = read_file()
+    for fused in [False, True]:
+        compare(data, fused, args.simulated, args.time_scale)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,124 @@
+"""
+Compares image upload settings by payload size and, with --with-api, by how many of the expected
+products per page are still extracted. The expected counts are the ones of items_per_page_test.
+
+Without --with-api no requests are sent and only the bytes and estimated tokens are reported.
+"""
+
+import argparse
+import base64
+import glob
+import io
+import os
+import tempfile
+
+import pandas as pd
+from PIL import Image
+
+from file_downloaders import NoopDownloader
+from image_preprocessor import ImagePreprocessor
+from leaflet_reader import LeafletReader
+from main_pipeline import Pipeline
+from settings import RENDER_WORKERS
+from tests.items_per_page_test import RESULTS_FILE, load_gt
+from tests.throughput_benchmark import prepare_pdf_dir, render_test_pdfs
+import utils
+
+# (image format, quality, detail, resize)
+SETTINGS = [
+    ("PNG", 85, "high", False),
+    ("PNG", 85, "high", True),
+    ("JPEG", 90, "high", True),
+    ("JPEG", 75, "high", True),
+    ("WEBP", 80, "high", True),
+    ("JPEG", 75, "low", True),
+]
+
+
+def measure_payload(preprocessor: ImagePreprocessor, image_paths: list[str]):
+    """Returns the mean base64 payload in bytes and the mean image tokens per page."""
+    payload_bytes, tokens = 0, 0
+    for image_path in image_paths:
+        with open(image_path, "rb") as image_file:
+            image_data = image_file.read()
+        prepared = preprocessor.prepare(image_data)
+        payload_bytes += len(base64.b64encode(prepared))
+        tokens += preprocessor.count_image_tokens(
+            *Image.open(io.BytesIO(prepared)).size
+        )
+    return payload_bytes / len(image_paths), tokens / len(image_paths)
+
+
+def measure_recall(
+    preprocessor: ImagePreprocessor, rendered_dir: str, expected: pd.DataFrame
+) -> float:
+    """
+    Extracts all test pages with the real API and returns the share of expected products found.
+    Finding more products than expected on a page does not count.
+    """
+    args = {
+        "overwrite_results": True,
+        "use_test_client": False,
+        "no_categorize": True,
+        "image_format": preprocessor.image_format,
+        "image_quality": preprocessor.quality,
+        "image_detail": preprocessor.detail,
+    }
+    with tempfile.TemporaryDirectory() as pdf_dir:
+        prepare_pdf_dir(pdf_dir, rendered_dir)
+        pipeline = Pipeline(
+            args,
+            LeafletReader(NoopDownloader(), num_render_workers=RENDER_WORKERS),
+            pdf_dir=pdf_dir,
+        )
+        if not preprocessor.resize:
+            pipeline.openai_client.image_preprocessor = preprocessor
+        actual = pipeline.main()
+
+    actual_counts = (
+        actual[["extracted_product_name", "extracted_page_number"]]
+        .groupby("extracted_page_number")
+        .count()
+    )
+    actual_counts = actual_counts.reindex(expected.index, fill_value=0)
+    found = actual_counts.clip(upper=expected, axis=0)
+    return found.sum().sum() / expected.sum().sum()
+
+
+def run():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--with-api",
+        action="store_true",
+        help="Also extract the products with the OpenAI API to measure the recall.",
+    )
+    args = parser.parse_args()
+
+    expected = load_gt(RESULTS_FILE)
+    with tempfile.TemporaryDirectory() as rendered_dir:
+        render_test_pdfs(rendered_dir)
+        image_paths = [
+            path
+            for directory in glob.glob(os.path.join(rendered_dir, "*"))
+            for path in utils.get_all_image_paths(directory)
+        ]
+        # The expected results also cover pages that are not in tests/data
+        expected = expected[
+            expected.index.isin([os.path.basename(path) for path in image_paths])
+        ]
+        for image_format, quality, detail, resize in SETTINGS:
+            preprocessor = ImagePreprocessor(image_format, quality, detail, resize)
+            payload_bytes, tokens = measure_payload(preprocessor, image_paths)
+            line = (
+                f"{image_format:>4} q{quality:<3} {detail:>4} detail, "
+                f"{'resized' if resize else 'original size'}: "
+                f"{payload_bytes / 1024:8.0f} KiB/page, ~{tokens:.0f} image tokens/page"
+            )
+            if args.with_api:
+                line += f", recall {measure_recall(preprocessor, rendered_dir, expected) * 100:.1f}%"
+            print(line)
+
+
+if __name__ == "__main__":
+    run()
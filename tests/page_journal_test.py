@@ -0,0 +1,38 @@
+"""
+Resumes from the page journal only if the page image did not change since it was journaled.
+"""
+
+import os
+import tempfile
+
+from page_journal import PageJournal
+from settings import NUMBER_OF_CHATGPT_VALIDATIONS
+
+
+def test_changed_image_is_processed_again():
+    """A page rendered again with different bytes must not get the journaled products."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        image_path = os.path.join(output_dir, "page_1.png")
+        with open(image_path, "wb") as image_file:
+            image_file.write(b"first render")
+        page_result = (
+            [{"product_name": "Cervelas"}],
+            [[{"product_name": "Cervelas"}]] * NUMBER_OF_CHATGPT_VALIDATIONS,
+        )
+        PageJournal(output_dir).append(image_path, page_result)
+        assert PageJournal(output_dir).get(image_path) == page_result
+
+        with open(image_path, "wb") as image_file:
+            image_file.write(b"second render")
+        assert PageJournal(output_dir).get(image_path) is None
+        assert PageJournal(output_dir).get(image_path, b"first render") == page_result
+
+
+def run():
+    """Run test."""
+    test_changed_image_is_processed_again()
+    print("Page journal: OK")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,53 @@
+"""
+Compares the PDF rendering speed of a single process with the process pool.
+"""
+
+import glob
+import os
+import tempfile
+import time
+
+from file_downloaders import NoopDownloader
+from leaflet_reader import LeafletReader
+from settings import RENDER_WORKERS
+
+TEST_DATA_DIR = "tests/data/"
+
+
+def get_pdf_jobs(output_root: str) -> list[tuple[str, str]]:
+    pdf_paths = sorted(glob.glob(os.path.join(TEST_DATA_DIR, "*.pdf")))
+    return [
+        (
+            pdf_path,
+            os.path.join(output_root, os.path.splitext(os.path.basename(pdf_path))[0]),
+        )
+        for pdf_path in pdf_paths
+    ]
+
+
+def measure_pages_per_second(num_render_workers: int) -> float:
+    """Renders all test PDFs into a temporary directory and returns the pages/sec."""
+    reader = LeafletReader(NoopDownloader(), num_render_workers=num_render_workers)
+    with tempfile.TemporaryDirectory() as output_root:
+        start = time.perf_counter()
+        image_paths = reader.convert_pdfs_to_images(
+            get_pdf_jobs(output_root), overwrite_images=True
+        )
+        elapsed = time.perf_counter() - start
+    num_pages = sum(len(paths) for paths in image_paths.values())
+    print(
+        f"{num_render_workers} worker(s): {num_pages} pages in {elapsed:.2f}s "
+        f"({num_pages / elapsed:.2f} pages/sec)"
+    )
+    return num_pages / elapsed
+
+
+def run():
+    """Run benchmark."""
+    serial = measure_pages_per_second(1)
+    parallel = measure_pages_per_second(RENDER_WORKERS)
+    print(f"Speedup: {parallel / serial:.2f}x")
+
+
+if __name__ == "__main__":
+    run()
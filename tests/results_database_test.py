@@ -0,0 +1,58 @@
+"""
+Reprocesses a folder of the results database after a reviewer edited one of its products.
+"""
+
+import os
+import tempfile
+
+import pandas as pd
+
+from results_database import ResultsDatabase
+
+
+def get_results(folder: str, discount_price: str) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "extracted_folder": [folder],
+            "extracted_page_number": ["page_1.png"],
+            "extracted_product_name": ["Cervelas"],
+            "extracted_discount_price": [discount_price],
+        }
+    )
+
+
+def test_reprocessed_folder_drops_its_edits():
+    """The edits of the replaced products are gone, the edits of the other folders are kept."""
+    with tempfile.TemporaryDirectory() as directory:
+        database = ResultsDatabase(os.path.join(directory, "results.sqlite"))
+        database.replace_folders(get_results("denner", "2.00"), None)
+        database.replace_folders(get_results("coop", "2.00"), None)
+        products = database.select()
+        database.update_products(list(products.index), {"data_checked": True})
+        database.update_products(
+            list(products[products["extracted_folder"] == "denner"].index),
+            {"extracted_discount_price": "2.50"},
+        )
+
+        database.replace_folders(get_results("denner", "2.20"), None)
+        denner = database.select(["extracted_folder = ?"], ["denner"])
+        assert list(denner["extracted_discount_price"]) == ["2.20"]
+        assert not denner["data_checked"].any()
+        edits = database.get_edits()
+        coop_ids = set(
+            database.select(["extracted_folder = ?"], ["coop"]).index.tolist()
+        )
+        assert len(edits) == 1
+        assert set(edits["product_id"]) == coop_ids
+        assert database.compact_edits() == 0
+        assert len(database.get_edits()) == 1
+
+
+def run():
+    """Run test."""
+    test_reprocessed_folder_drops_its_edits()
+    print("Results database: OK")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,5 +1,16 @@
-from tests import items_per_page_test, category_test
+from tests import (
+    items_per_page_test,
+    category_test,
+    page_journal_test,
+    results_database_test,
+    streamlit_upload_test,
+    validation_comparison_test,
+)
 
 if __name__ == "__main__":
+    streamlit_upload_test.run()
+    page_journal_test.run()
+    validation_comparison_test.run()
+    results_database_test.run()
     items_per_page_test.run()
     category_test.run()
@@ -0,0 +1,69 @@
+"""
+Runs the pipeline on a zip file uploaded through the Streamlit UI, like the run page does.
+"""
+
+import io
+import os
+import shutil
+import zipfile
+
+from file_downloaders import StreamlitDownloader
+from leaflet_reader import LeafletReader
+from main_pipeline import Pipeline
+from results_database import RESULTS_DATABASE_FILE_NAME, ResultsDatabase
+
+TEST_DATA_DIR = "tests/data/"
+# Relative, the downloader only clears directories inside the project
+UPLOAD_DIR = os.path.join(TEST_DATA_DIR, "streamlit_upload")
+
+
+def get_uploaded_zip(pdf_name: str) -> io.BytesIO:
+    """The uploaded file as Streamlit hands it over, a zip file with the PDF."""
+    uploaded_file = io.BytesIO()
+    with zipfile.ZipFile(uploaded_file, "w") as zf:
+        zf.write(os.path.join(TEST_DATA_DIR, pdf_name), pdf_name)
+    uploaded_file.seek(0)
+    return uploaded_file
+
+
+def run_upload(pdf_name: str):
+    """Runs the pipeline with the test client on the uploaded PDF, with the arguments of the run page."""
+    args = {
+        "overwrite_results": True,
+        "use_test_client": True,
+        "no_categorize": False,
+        "no_cache": True,
+        "no_excel": True,
+    }
+    pipeline = Pipeline(
+        args,
+        leaflet_reader=LeafletReader(StreamlitDownloader(get_uploaded_zip(pdf_name))),
+        pdf_dir=UPLOAD_DIR,
+        display_mode=False,
+    )
+    return pipeline.main()
+
+
+def test_streamlit_upload():
+    """Two uploads in a row, the second one replaces the directory with the results database of the first."""
+    try:
+        for _ in range(2):
+            results = run_upload("denner.pdf")
+            assert len(results) > 0
+            database = ResultsDatabase(
+                os.path.join(UPLOAD_DIR, RESULTS_DATABASE_FILE_NAME)
+            )
+            assert database.get_folders() == {"denner"}
+            assert len(database.select()) == len(results)
+    finally:
+        shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+
+
+def run():
+    """Run test."""
+    test_streamlit_upload()
+    print("Streamlit upload: OK")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,121 @@
+"""
+Runs the whole pipeline over the test PDFs against a simulated LLM backend and reports
+pages/sec, makespan and API calls per page for the staged and the streaming mode.
+
+The pages are rendered once up front, so that the numbers measure the orchestration and not
+the rendering. Pass --include-render to measure both.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from file_downloaders import NoopDownloader
+from leaflet_reader import LeafletReader
+from llms.simulated_client import SimulatedOpenAI
+from main_pipeline import Pipeline
+from settings import MAX_CONCURRENCY, RENDER_WORKERS
+from tests.render_benchmark import get_pdf_jobs
+import utils
+
+TEST_DATA_DIR = "tests/data/"
+MODES = {"staged": {}, "streaming": {"streaming": True}}
+
+
+def prepare_pdf_dir(pdf_dir: str, rendered_dir: str | None) -> None:
+    """Copies the test PDFs, and the images rendered from them if given, into pdf_dir."""
+    for pdf_path in glob.glob(os.path.join(TEST_DATA_DIR, "*.pdf")):
+        shutil.copy(pdf_path, pdf_dir)
+    if rendered_dir is not None:
+        shutil.copytree(rendered_dir, pdf_dir, dirs_exist_ok=True)
+
+
+def render_test_pdfs(rendered_dir: str) -> None:
+    reader = LeafletReader(NoopDownloader(), num_render_workers=RENDER_WORKERS)
+    reader.convert_pdfs_to_images(get_pdf_jobs(rendered_dir))
+
+
+def count_pages(pdf_dir: str) -> int:
+    return sum(
+        len(utils.get_all_image_paths(entry.path))
+        for entry in os.scandir(pdf_dir)
+        if entry.is_dir()
+    )
+
+
+def measure_throughput(mode: str, max_concurrency: int, args, rendered_dir) -> None:
+    backend = SimulatedOpenAI(
+        rate_limit_probability=args.rate_limit_probability,
+        timeout_probability=args.timeout_probability,
+        time_scale=args.time_scale,
+        seed=args.seed,
+    )
+    pipeline_args = {
+        "overwrite_results": True,
+        "use_test_client": False,
+        "no_cache": True,
+        "no_category_store": True,
+        "no_categorize": False,
+        "max_concurrency": max_concurrency,
+        **MODES[mode],
+    }
+    with tempfile.TemporaryDirectory() as pdf_dir:
+        prepare_pdf_dir(pdf_dir, rendered_dir)
+        pipeline = Pipeline(
+            pipeline_args,
+            LeafletReader(NoopDownloader(), num_render_workers=RENDER_WORKERS),
+            pdf_dir=pdf_dir,
+            llm_backend=backend,
+        )
+        start = time.perf_counter()
+        pipeline.main()
+        makespan = time.perf_counter() - start
+        num_pages = count_pages(pdf_dir)
+
+    print(
+        f"{mode:>9}, concurrency {max_concurrency:>2}: {num_pages} pages in {makespan:.2f}s "
+        f"({num_pages / makespan:.2f} pages/sec), "
+        f"{backend.outcomes['ok'] / num_pages:.2f} API calls/page, "
+        f"{backend.outcomes['rate_limited']} rate limited, {backend.outcomes['timeout']} timed out"
+    )
+
+
+def run():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.1,
+        help="Multiplies the simulated latencies, 1 is the speed of the real API.",
+    )
+    parser.add_argument("--rate-limit-probability", type=float, default=0.02)
+    parser.add_argument("--timeout-probability", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        nargs="+",
+        default=[1, MAX_CONCURRENCY],
+    )
+    parser.add_argument("--include-render", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as rendered_dir:
+        if not args.include_render:
+            render_test_pdfs(rendered_dir)
+        for mode in MODES:
+            for max_concurrency in args.max_concurrency:
+                measure_throughput(
+                    mode,
+                    max_concurrency,
+                    args,
+                    None if args.include_render else rendered_dir,
+                )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,62 @@
+"""
+Compares the extraction with its validations, for a page that adaptive validation skipped and one
+that was validated.
+"""
+
+import math
+
+import pandas as pd
+
+from validation.validation_comparison import compare_validation
+
+NUM_VALIDATIONS = 3
+
+
+def get_row(product: dict, validations: list[dict], validations_sent: int) -> dict:
+    """One row like Pipeline.create_results_dataframe builds it, the unsent validations repeat the extraction."""
+    validations = validations + [product] * (NUM_VALIDATIONS - len(validations))
+    row = {f"extracted_{column}": value for column, value in product.items()}
+    row["validations_sent"] = validations_sent
+    for i, validation in enumerate(validations):
+        row.update(
+            {
+                f"validated{i + 1}_{column}": value
+                for column, value in validation.items()
+            }
+        )
+    return row
+
+
+def test_skipped_page_has_no_confidence():
+    product = {
+        "product_name": "Cervelas",
+        "original_price": "3.00",
+        "discount_price": "2.00",
+        "percentage_discount": 33,
+    }
+    corrected = {**product, "discount_price": "2.50"}
+    data = pd.DataFrame(
+        [
+            get_row(product, [], 0),
+            get_row(product, [corrected, corrected, product], NUM_VALIDATIONS),
+        ]
+    )
+    compare_validation(data, NUM_VALIDATIONS)
+
+    skipped, validated = data.iloc[0], data.iloc[1]
+    assert skipped["final_discount_price"] == "2.00"
+    assert math.isnan(skipped["confidence_discount_price"])
+    assert math.isnan(skipped["confidence_product_name"])
+    assert validated["final_discount_price"] == "2.50"
+    assert validated["confidence_discount_price"] == 2 / 3
+    assert validated["confidence_product_name"] == 1.0
+
+
+def run():
+    """Run test."""
+    test_skipped_page_has_no_confidence()
+    print("Validation comparison: OK")
+
+
+if __name__ == "__main__":
+    run()
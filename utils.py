@@ -2,6 +2,9 @@
 
 import os
 import shutil
+from contextlib import contextmanager
+from typing import Iterator
+
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -9,6 +12,8 @@ from natsort import natsorted
 
 from settings import API_KEY_ENV_VAR_NAME
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
 
 def delete_directory_contents(directory: str):
     if directory.startswith("/") or ".." in directory:
@@ -45,11 +50,31 @@ def get_api_key() -> str:
 def get_all_image_paths(directory: str):
     paths = []
     for file in os.listdir(directory):
-        if file.lower().endswith((".png", ".jpg", ".jpeg")):
+        if file.lower().endswith(IMAGE_EXTENSIONS):
             paths.append(os.path.join(directory, file))
     return natsorted(paths)
 
 
+def read_image(image_path: str) -> bytes:
+    with open(image_path, "rb") as image_file:
+        return image_file.read()
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[str]:
+    """
+    Yields a temporary path to write the file to, which replaces the file at path once the
+    block is done. Readers, and the next run after a crash, never see half a file.
+    """
+    temporary_path = path + ".tmp"
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
 def log_message(message, display_mode):
     """Logs messages to console or Streamlit depending on display mode."""
     if display_mode:
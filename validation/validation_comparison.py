@@ -1,49 +1,215 @@
+import numpy as np
 import pandas as pd
-from collections import Counter
-import random
 
-from settings import NUMBER_OF_CHATGPT_VALIDATIONS, EXTRACTED_DATA_COLUMNS
+from llms.models import Results
+from normalization import NUMBER_PATTERN, parse_number
+from settings import (
+    NUMBER_OF_CHATGPT_VALIDATIONS,
+    EXTRACTED_DATA_COLUMNS,
+    PLAUSIBLE_DISCOUNT_TOLERANCE,
+    VALIDATION_NUMERIC_TOLERANCE,
+)
 
+# Compared as numbers, so that "3.–", "3.00" and "3,00 CHF" are the same price
+NUMERIC_COLUMNS = {"original_price", "discount_price", "percentage_discount"}
+
+
+def is_plausible(response: Results) -> bool:
+    """
+    Cheap check of an extraction that does not need the image: every product has a name, an
+    original and a discount price, the discount price is lower and a given percentage discount
+    matches the prices within PLAUSIBLE_DISCOUNT_TOLERANCE percentage points.
+    """
+    if not response.all_products:
+        return False
+    for product in response.all_products:
+        original_price = parse_number(product.original_price)
+        discount_price = parse_number(product.discount_price)
+        if not product.product_name.strip() or not original_price or not discount_price:
+            return False
+        if discount_price >= original_price:
+            return False
+        if product.percentage_discount is not None and (
+            abs(
+                (1 - discount_price / original_price) * 100
+                - product.percentage_discount
+            )
+            > PLAUSIBLE_DISCOUNT_TOLERANCE
+        ):
+            return False
+    return True
 
-def determine_final_column_and_confidence(
-    row: pd.Series, column_name: str
-) -> tuple[str, float]:
-    # Get all validation values in a list
-    validation_columns = [
-        f"validated{i + 1}_{column_name}" for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)
-    ]
-    validation_values = [row[col] for col in validation_columns]
 
-    # Count occurrences of each value
-    counts = Counter(validation_values)  # TODO handle NaN values better
-    most_common_value, max_count = counts.most_common(1)[0]
+def validations_agree(
+    extracted_products: list[dict], validation_results: list[list[dict]]
+) -> bool:
+    """Whether all validations found the same products with the same values as the extraction."""
+    if any(
+        len(validation) != len(extracted_products) for validation in validation_results
+    ):
+        return False
+    for column in EXTRACTED_DATA_COLUMNS:
+        values = pd.DataFrame(
+            [
+                [product.get(column) for product in products]
+                for products in [extracted_products, *validation_results]
+            ],
+            dtype=object,
+        ).T
+        keys = get_comparison_keys(values, column in NUMERIC_COLUMNS)
+        if not get_agreement(
+            tuple(key[:, :1] for key in keys), tuple(key[:, 1:] for key in keys)
+        ).all():
+            return False
+    return True
+
 
-    # Check if there is a tie
-    tied_values = [val for val, count in counts.items() if count == max_count]
+def get_comparison_keys(
+    values: pd.DataFrame, numeric: bool
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Turns the values into arrays that can be compared without Python per row. Only the distinct
+    values are normalized, as the same prices and names repeat across many rows.
 
-    if len(tied_values) == 1:
-        final_value = most_common_value
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Whether a value is missing, its number (NaN if it has none)
+        and an integer code of its normalized text.
+    """
+    value_codes, distinct_values = pd.factorize(
+        values.to_numpy(dtype=object).ravel(), use_na_sentinel=True
+    )
+    missing = value_codes == -1
+    text = (
+        pd.Series(distinct_values, dtype=object)
+        .astype(str)
+        .str.strip()
+        .str.casefold()
+        .str.replace(r"\s+", " ", regex=True)
+    )
+    text_codes, _ = pd.factorize(text)
+    if numeric:
+        numbers = (
+            text.str.extract(NUMBER_PATTERN, expand=False)
+            .str.replace(",", ".")
+            .astype(float)
+            .to_numpy()
+        )
     else:
-        # Tie exists, check extracted_original_price
-        if row[f"extracted_{column_name}"] in tied_values:
-            final_value = row[f"extracted_{column_name}"]
-        else:
-            final_value = random.choice(tied_values)  # Choose randomly if no match
+        numbers = np.full(len(distinct_values), np.nan)
+    # Index -1 of the missing values picks an arbitrary entry, which is masked by missing
+    codes = np.where(missing, -1, text_codes[value_codes] if len(text_codes) else -1)
+    numbers = (
+        np.where(missing, np.nan, numbers[value_codes])
+        if len(numbers)
+        else np.full(len(value_codes), np.nan)
+    )
+    shape = values.shape
+    return missing.reshape(shape), numbers.reshape(shape), codes.reshape(shape)
+
+
+def get_agreement(
+    left: tuple[np.ndarray, np.ndarray, np.ndarray],
+    right: tuple[np.ndarray, np.ndarray, np.ndarray],
+) -> np.ndarray:
+    """
+    Whether the values of left and right are the same, element-wise with broadcasting: two
+    missing values agree, numbers agree within VALIDATION_NUMERIC_TOLERANCE, everything else
+    agrees if the normalized text does.
+    """
+    left_missing, left_numbers, left_codes = left
+    right_missing, right_numbers, right_codes = right
+    both_present = ~left_missing & ~right_missing
+    both_numeric = ~np.isnan(left_numbers) & ~np.isnan(right_numbers)
+    with np.errstate(invalid="ignore"):
+        numbers_agree = np.abs(left_numbers - right_numbers) <= (
+            VALIDATION_NUMERIC_TOLERANCE
+        )
+    return (left_missing & right_missing) | (
+        both_present & np.where(both_numeric, numbers_agree, left_codes == right_codes)
+    )
+
+
+def determine_final_column_and_confidence(
+    data: pd.DataFrame, column_name: str, num_validations: int
+) -> tuple[pd.Series, pd.Series]:
+    """
+    Majority vote of the validations for one column, for all rows at once.
+
+    Every validation gets the votes of all validations that agree with it. Ties go to a value
+    that agrees with the extraction, otherwise to the first validation, so the result never
+    depends on chance. If the winner agrees with the extraction, the extracted value is kept.
+
+    Only the first validations_sent validations of a row vote, the others repeat the extraction
+    (see Pipeline.validate_page). Rows without any validation keep the extracted value and
+    have no confidence.
+
+    Returns:
+        tuple[pd.Series, pd.Series]: The winning value and the share of the validations that agree with it.
+    """
+    validation_columns = [
+        f"validated{i + 1}_{column_name}" for i in range(num_validations)
+    ]
+    # A validation without any products has no columns at all
+    validations = data.reindex(columns=validation_columns)
+    extracted = data.reindex(columns=[f"extracted_{column_name}"])
+    numeric = column_name in NUMERIC_COLUMNS
+    keys = get_comparison_keys(pd.concat([validations, extracted], axis=1), numeric)
+    validation_keys = tuple(key[:, :num_validations] for key in keys)
+    extracted_keys = tuple(key[:, num_validations:] for key in keys)
+
+    sent = (
+        data["validations_sent"].fillna(num_validations).to_numpy(dtype=float)
+        if "validations_sent" in data.columns
+        else np.full(len(data), float(num_validations))
+    )
+    # (rows x validations)
+    voting = np.arange(num_validations)[None, :] < sent[:, None]
 
-    # Calculate confidence
-    confidence = counts[final_value] / NUMBER_OF_CHATGPT_VALIDATIONS
+    # (rows x validations x validations)
+    pairwise = get_agreement(
+        tuple(key[:, :, None] for key in validation_keys),
+        tuple(key[:, None, :] for key in validation_keys),
+    )
+    votes = np.where(voting, (pairwise & voting[:, None, :]).sum(axis=2), -1)
+    max_votes = votes.max(axis=1)
+    tied = voting & (votes == max_votes[:, None])
+    agrees_with_extraction = get_agreement(validation_keys, extracted_keys)
+    preferred = tied & agrees_with_extraction
+    winner = np.where(
+        preferred.any(axis=1), preferred.argmax(axis=1), tied.argmax(axis=1)
+    )
 
-    return final_value, confidence
+    rows = np.arange(len(data))
+    validated = sent > 0
+    final_values = np.where(
+        agrees_with_extraction[rows, winner] | ~validated,
+        extracted.to_numpy(dtype=object)[:, 0],
+        validations.to_numpy(dtype=object)[rows, winner],
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        confidence = np.where(validated, max_votes / sent, np.nan)
+    return (
+        pd.Series(final_values, index=data.index).infer_objects(),
+        pd.Series(confidence, index=data.index),
+    )
 
 
-def compare_validation(data: pd.DataFrame) -> None:
+def compare_validation(
+    data: pd.DataFrame, num_validations: int = NUMBER_OF_CHATGPT_VALIDATIONS
+) -> None:
     """
     compares the values between the extraction and all validation steps
     :param data: dataframe with extracted data and validation data
+    :param num_validations: number of validations in the dataframe
     :return: None, since the original dataframe is edited
     """
+    if num_validations == 0:
+        return
     for column in EXTRACTED_DATA_COLUMNS:
-        data[[f"final_{column}", f"confidence_{column}"]] = data.apply(
-            lambda row: pd.Series(determine_final_column_and_confidence(row, column)),
-            axis=1,
+        if len(data) == 0:
+            data[f"final_{column}"] = pd.Series(dtype=object)
+            data[f"confidence_{column}"] = pd.Series(dtype=float)
+            continue
+        data[f"final_{column}"], data[f"confidence_{column}"] = (
+            determine_final_column_and_confidence(data, column, num_validations)
         )